@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import sys
+import socket
+import struct
+import select
+import errno
+import threading
+import time
+
+try:
+    from dvbcss.protocol.wc import WCMessage
+except ImportError:
+    sys.stderr.write("""
+    Could not import pydvbcss library. Suggest installing using pip, e.g. on Linux/Mac:
+    
+    $ sudo pip install pydvbcss
+    """)
+    sys.exit(1)
+
+import ctypes
+import ctypes.util
+
+import ProxyMetrics
+
+
+_HEADER_STRUCT = struct.Struct(">BBbBL")       # version, msgtype, precision, reserved, maxFreqError
+_TIME_STRUCT = struct.Struct(">LL")            # seconds, nanoseconds
+_ORIGINATE_OFFSET = _HEADER_STRUCT.size
+_RECEIVE_OFFSET = _ORIGINATE_OFFSET + _TIME_STRUCT.size
+_TRANSMIT_OFFSET = _RECEIVE_OFFSET + _TIME_STRUCT.size
+
+_SOCKADDR_SIZE = 128    # sizeof(struct sockaddr_storage)
+
+_SIZE_T = { 4:"I", 8:"Q" }[ctypes.sizeof(ctypes.c_size_t)]
+_CMSGHDR_STRUCT = struct.Struct("@"+_SIZE_T+"ii")   # struct cmsghdr: cmsg_len, cmsg_level, cmsg_type
+_TIMESPEC_STRUCT = struct.Struct("@ll")             # struct timespec: tv_sec, tv_nsec
+_CMSG_ALIGN = ctypes.sizeof(ctypes.c_size_t)
+_CONTROL_SIZE = 64      # room for a cmsghdr carrying a timespec, with alignment
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [ ("iov_base", ctypes.c_void_p),
+                 ("iov_len", ctypes.c_size_t) ]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [ ("msg_name", ctypes.c_void_p),
+                 ("msg_namelen", ctypes.c_uint32),
+                 ("msg_iov", ctypes.POINTER(_iovec)),
+                 ("msg_iovlen", ctypes.c_size_t),
+                 ("msg_control", ctypes.c_void_p),
+                 ("msg_controllen", ctypes.c_size_t),
+                 ("msg_flags", ctypes.c_int) ]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [ ("msg_hdr", _msghdr),
+                 ("msg_len", ctypes.c_uint) ]
+
+
+def _loadBatchedSocketCalls():
+    """\
+    :returns: tuple (recvmmsg, sendmmsg) functions from the C library, or None if they are not available.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p ]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int ]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+_BATCHED_CALLS = _loadBatchedSocketCalls()
+
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0x40)
+
+if hasattr(socket, "SO_REUSEPORT"):
+    SO_REUSEPORT = socket.SO_REUSEPORT
+elif sys.platform.startswith("linux"):
+    SO_REUSEPORT = 15   # not defined by the socket module in python 2.7
+else:
+    SO_REUSEPORT = None
+
+if hasattr(socket, "SO_TIMESTAMPNS"):
+    SO_TIMESTAMPNS = socket.SO_TIMESTAMPNS
+elif sys.platform.startswith("linux"):
+    SO_TIMESTAMPNS = 35   # not defined by the socket module in python 2.7
+else:
+    SO_TIMESTAMPNS = None
+SCM_TIMESTAMPNS = SO_TIMESTAMPNS
+
+
+def _cmsgAlign(length):
+    return (length + _CMSG_ALIGN - 1) & ~(_CMSG_ALIGN - 1)
+
+
+class BatchedWallClockServer(object):
+    """\
+    A CSS-WC server that can be used in place of pydvbcss's
+    :class:`~dvbcss.protocol.server.wc.WallClockServer`, for when there are
+    many companions.
+
+    Instead of receiving and responding to one request at a time, it receives
+    all requests waiting on the socket (up to the batch size) in one go, and
+    sends all the responses in one go. On Linux this uses the `recvmmsg` and
+    `sendmmsg` system calls, so each batch costs only two system calls. On
+    other platforms it falls back to reading the socket until it is empty and
+    then sending each response. Requests are decoded and responses encoded
+    in place in buffers allocated when the server is created, without creating
+    :class:`~dvbcss.protocol.wc.WCMessage` objects.
+
+    All requests in a batch are given the same receive time, read from the
+    wall clock when the batch is received. All responses in a batch are given
+    the same transmit time, read from the wall clock immediately before they
+    are sent.
+
+    Requests that are not valid wall clock requests are ignored.
+
+    Optionally, on Linux, the receive time of each request can instead be
+    taken from the time the kernel received it (using SO_TIMESTAMPNS), so
+    that time spent waiting for the GIL, garbage collection pauses and
+    batching does not add error to it. The precision reported in responses
+    is then the larger of the precision of the wall clock and the measured
+    error of stamping (see :data:`stampingError`).
+
+    The number of responses sent is counted in :data:`responseCount`, and the
+    rate at which they were sent, measured over the most recent second, is
+    available as :data:`responsesPerSecond`. Responses, and the time between
+    receiving each request and sending its response, are also recorded in the
+    metrics (see :mod:`ProxyMetrics`). When the server runs in a separate
+    process (see :class:`WallClockWorkers`) they are recorded in that process.
+    """
+
+    def __init__(self, wallClock, precision=None, maxFreqError=None, bindaddr="0.0.0.0", bindport=6677, batchSize=64, reusePort=False, kernelTimestamps=False):
+        """\
+        :param wallClock:    (:class:`dvbcss.clock.ClockBase`) The clock to be used as the wall clock for protocol interactions
+        :param precision:    (float) Optional. The precision (in seconds) to be reported. If not specified, the dispersion of the wall clock, when the server is created, is used.
+        :param maxFreqError: (float) Optional. The maximum frequency error (in ppm) to be reported. If not specified, the :func:`~dvbcss.clock.ClockBase.getRootMaxFreqError` of the clock is used.
+        :param bindaddr:     (str, ip address) The ip address of the network interface to bind to. Defaults to "0.0.0.0" which binds to all interfaces.
+        :param bindport:     (int) The port number to bind to (defaults to 6677)
+        :param batchSize:    (int) The maximum number of requests received and responded to at a time.
+        :param reusePort:    (bool) Set the SO_REUSEPORT option on the socket, so that several servers (e.g. in different processes) can bind to the same port, with requests shared between them by the operating system.
+        :param kernelTimestamps: (bool) Take receive times from the timestamps recorded by the kernel when requests are received.
+        :throws NotImplementedError: if `reusePort` is True but SO_REUSEPORT is not supported on this platform, or if `kernelTimestamps` is True but kernel timestamps (or the recvmmsg system call) are not supported on this platform.
+        """
+        super(BatchedWallClockServer,self).__init__()
+        self.wallClock = wallClock
+        if precision is None:
+            precision = wallClock.dispersionAtTime(wallClock.ticks)
+        if maxFreqError is None:
+            maxFreqError = wallClock.getRootMaxFreqError()
+        self.precision = precision
+        self._maxFreqError = WCMessage.encodeMaxFreqError(maxFreqError)
+        self.batchSize = batchSize
+
+        self.responseCount = 0
+        self.responsesPerSecond = 0.0
+        self._responses = ProxyMetrics.wallClockResponses("udp")
+        self._turnaround = ProxyMetrics.wallClockTurnaroundSeconds("udp")
+        self._windowStampingError = 0.0
+        self._prevWindowStampingError = 0.0
+
+        self._socket = self._createSocket(bindaddr, bindport, reusePort)
+        self._buffer = ctypes.create_string_buffer(WCMessage.MSG_SIZE * batchSize)
+        self._view = memoryview(self._buffer)
+        self._lengths = [0] * batchSize
+        self._addrs = [None] * batchSize
+        self._rxKernelNanos = [None] * batchSize
+        self._useBatchedCalls = _BATCHED_CALLS is not None
+        self.kernelTimestamps = kernelTimestamps
+        if kernelTimestamps:
+            if not self._useBatchedCalls or SO_TIMESTAMPNS is None:
+                raise NotImplementedError("Kernel receive timestamps are not supported on this platform")
+            self._socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+        if self._useBatchedCalls:
+            self._prepareMessageHeaders()
+
+        self._thread = None
+        self._pleaseStop = False
+
+    @property
+    def precision(self):
+        """\
+        (read/write :class:`float`) The precision (in seconds) reported in responses. Can be changed while the server is running.
+        """
+        return self._precisionSecs
+
+    @precision.setter
+    def precision(self, value):
+        self._precision = WCMessage.encodePrecision(value)
+        self._precisionSecs = value
+
+    def _createSocket(self, bindaddr, bindport, reusePort):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reusePort:
+            if SO_REUSEPORT is None:
+                raise NotImplementedError("SO_REUSEPORT is not supported on this platform")
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        s.setblocking(False)
+        s.bind((bindaddr, bindport))
+        return s
+
+    def _prepareMessageHeaders(self):
+        """\
+        Set up the vectors of message headers used with recvmmsg and sendmmsg,
+        each pointing at its slot in the buffer and at storage for the source
+        (and hence destination) address.
+        """
+        n = self.batchSize
+        self._names = ctypes.create_string_buffer(_SOCKADDR_SIZE * n)
+        self._iovecs = (_iovec * n)()
+        self._recvHdrs = (_mmsghdr * n)()
+        self._sendHdrs = (_mmsghdr * n)()
+        self._controls = ctypes.create_string_buffer(_CONTROL_SIZE * n)
+        bufferAddr = ctypes.addressof(self._buffer)
+        namesAddr = ctypes.addressof(self._names)
+        controlsAddr = ctypes.addressof(self._controls)
+        for i in range(0, n):
+            if self.kernelTimestamps:
+                self._recvHdrs[i].msg_hdr.msg_control = controlsAddr + i * _CONTROL_SIZE
+            self._iovecs[i].iov_base = bufferAddr + i * WCMessage.MSG_SIZE
+            self._iovecs[i].iov_len = WCMessage.MSG_SIZE
+            for hdrs in (self._recvHdrs, self._sendHdrs):
+                hdrs[i].msg_hdr.msg_name = namesAddr + i * _SOCKADDR_SIZE
+                hdrs[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+                hdrs[i].msg_hdr.msg_iovlen = 1
+
+    def start(self):
+        """\
+        Starts the wall clock server running. It runs in a thread in the background.
+        """
+        if self._thread is not None:
+            return
+        self._pleaseStop = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """\
+        Stops the wall clock server running. Does not return until the thread has terminated.
+        """
+        if self._thread is None:
+            return
+        self._pleaseStop = True
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        windowStart = time.time()
+        windowCount = 0
+        while not self._pleaseStop:
+            readable, _, _ = select.select([self._socket], [], [], 0.25)
+            if readable:
+                windowCount += self.serviceRequests()
+            now = time.time()
+            if now - windowStart >= 1.0:
+                self.responsesPerSecond = windowCount / (now - windowStart)
+                self._prevWindowStampingError = self._windowStampingError
+                self._windowStampingError = 0.0
+                windowStart = now
+                windowCount = 0
+
+    @property
+    def stampingError(self):
+        """\
+        (read only) When using kernel timestamps, the largest error (in seconds)
+        recently measured in stamping receive and transmit times. This is the
+        sum of the uncertainty in relating the kernel timestamps to the wall
+        clock and the time taken to send responses after they have been stamped.
+        """
+        return max(self._windowStampingError, self._prevWindowStampingError)
+
+    def _noteStampingError(self, error):
+        if error > self._windowStampingError:
+            self._windowStampingError = error
+
+    def _measureRealtimeOffset(self):
+        """\
+        :returns: tuple (offset, error) where offset is the difference (in
+          nanoseconds) between the wall clock and the real time clock used for
+          kernel timestamps, and error is the uncertainty in it (in seconds).
+        """
+        before = time.time()
+        wallNanos = self.wallClock.nanos
+        after = time.time()
+        return wallNanos - int((before + after) * 500000000), (after - before) / 2
+
+    def serviceRequests(self):
+        """\
+        Receive the requests waiting on the socket (up to the batch size) and
+        respond to them. Does not block.
+
+        :returns: The number of responses sent.
+        """
+        if self._useBatchedCalls:
+            count = self._receiveBatched()
+        else:
+            count = self._receivePortable()
+        if count == 0:
+            return 0
+        rxNanos = self.wallClock.nanos
+
+        precision = self._precision
+        if self.kernelTimestamps:
+            offset, offsetError = self._measureRealtimeOffset()
+            self._noteStampingError(offsetError)
+            precision = WCMessage.encodePrecision(max(self.precision, self.stampingError))
+
+        valid = []
+        validRxNanos = []
+        for i in range(0, count):
+            kernelNanos = self._rxKernelNanos[i]
+            if kernelNanos is not None:
+                msgRxNanos = kernelNanos + offset
+            else:
+                msgRxNanos = rxNanos
+            if self._prepareResponse(i, msgRxNanos, precision):
+                valid.append(i)
+                validRxNanos.append(msgRxNanos)
+        if not valid:
+            return 0
+
+        # stamp transmit time as late as possible: immediately before sending
+        txNanos = self.wallClock.nanos
+        ts, tn = divmod(txNanos, 1000000000)
+        for i in valid:
+            _TIME_STRUCT.pack_into(self._buffer, i * WCMessage.MSG_SIZE + _TRANSMIT_OFFSET, ts, tn)
+
+        sendStart = time.time()
+        if self._useBatchedCalls:
+            sent = self._sendBatched(valid)
+        else:
+            sent = self._sendPortable(valid)
+        if self.kernelTimestamps:
+            self._noteStampingError(offsetError + time.time() - sendStart)
+        self.responseCount += sent
+        self._responses.inc(sent)
+        if self.kernelTimestamps:
+            for msgRxNanos in validRxNanos[:sent]:
+                self._turnaround.observe((txNanos - msgRxNanos) / 1000000000.0)
+        elif sent:
+            self._turnaround.observe((txNanos - rxNanos) / 1000000000.0, sent)
+        return sent
+
+    def _prepareResponse(self, i, rxNanos, precision):
+        """\
+        Turn the request in slot i of the buffer into a response, in place, except for the transmit time.
+
+        :returns: True if it was a valid request.
+        """
+        if self._lengths[i] != WCMessage.MSG_SIZE:
+            return False
+        offset = i * WCMessage.MSG_SIZE
+        version, msgtype, _, _, _ = _HEADER_STRUCT.unpack_from(self._buffer, offset)
+        if version != 0 or msgtype != WCMessage.TYPE_REQUEST:
+            return False
+        _HEADER_STRUCT.pack_into(self._buffer, offset, 0, WCMessage.TYPE_RESPONSE, precision, 0, self._maxFreqError)
+        # originate time is left exactly as the client sent it
+        rs, rn = divmod(rxNanos, 1000000000)
+        _TIME_STRUCT.pack_into(self._buffer, offset + _RECEIVE_OFFSET, rs, rn)
+        return True
+
+    def _receiveBatched(self):
+        recvmmsg = _BATCHED_CALLS[0]
+        for i in range(0, self.batchSize):
+            self._recvHdrs[i].msg_hdr.msg_namelen = _SOCKADDR_SIZE
+            if self.kernelTimestamps:
+                self._recvHdrs[i].msg_hdr.msg_controllen = _CONTROL_SIZE
+        count = recvmmsg(self._socket.fileno(), self._recvHdrs, self.batchSize, _MSG_DONTWAIT, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return 0
+            raise OSError(err, "recvmmsg failed")
+        for i in range(0, count):
+            self._lengths[i] = self._recvHdrs[i].msg_len
+            if self.kernelTimestamps:
+                self._rxKernelNanos[i] = self._kernelTimestamp(i)
+        return count
+
+    def _kernelTimestamp(self, i):
+        """\
+        :returns: The receive timestamp (in nanoseconds, real time clock) found in the control messages received with the request in slot i, or None if there is none.
+        """
+        base = i * _CONTROL_SIZE
+        end = base + self._recvHdrs[i].msg_hdr.msg_controllen
+        offset = base
+        while offset + _CMSGHDR_STRUCT.size <= end:
+            length, level, msgtype = _CMSGHDR_STRUCT.unpack_from(self._controls, offset)
+            if length < _CMSGHDR_STRUCT.size:
+                break
+            if level == socket.SOL_SOCKET and msgtype == SCM_TIMESTAMPNS:
+                secs, nanos = _TIMESPEC_STRUCT.unpack_from(self._controls, offset + _cmsgAlign(_CMSGHDR_STRUCT.size))
+                return secs * 1000000000 + nanos
+            offset += _cmsgAlign(length)
+        return None
+
+    def _sendBatched(self, slots):
+        sendmmsg = _BATCHED_CALLS[1]
+        n = 0
+        for i in slots:
+            hdr = self._sendHdrs[n].msg_hdr
+            hdr.msg_name = self._recvHdrs[i].msg_hdr.msg_name
+            hdr.msg_namelen = self._recvHdrs[i].msg_hdr.msg_namelen
+            hdr.msg_iov = self._recvHdrs[i].msg_hdr.msg_iov
+            n += 1
+        sent = 0
+        while sent < n:
+            result = sendmmsg(self._socket.fileno(), ctypes.byref(self._sendHdrs[sent]), n - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                break   # responses that cannot be sent are dropped, as for any UDP packet loss
+            sent += result
+        return sent
+
+    def _receivePortable(self):
+        count = 0
+        while count < self.batchSize:
+            try:
+                offset = count * WCMessage.MSG_SIZE
+                nbytes, addr = self._socket.recvfrom_into(self._view[offset:offset + WCMessage.MSG_SIZE], WCMessage.MSG_SIZE)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            self._lengths[count] = nbytes
+            self._addrs[count] = addr
+            count += 1
+        return count
+
+    def _sendPortable(self, slots):
+        sent = 0
+        for i in slots:
+            offset = i * WCMessage.MSG_SIZE
+            try:
+                self._socket.sendto(self._view[offset:offset + WCMessage.MSG_SIZE], self._addrs[i])
+                sent += 1
+            except socket.error:
+                pass    # responses that cannot be sent are dropped, as for any UDP packet loss
+        return sent
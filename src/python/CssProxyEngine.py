@@ -17,6 +17,8 @@
 
 import sys
 import json
+import logging
+import threading
 
 try:
     from dvbcss.protocol import OMIT
@@ -31,15 +33,61 @@ except ImportError:
 
 from ProxyTimelineSource import ProxyTimelineSource
 from CssProxy_ServerEndpoint import CssProxy_ServerEndpoint
+import ProxyMetrics
 
 
 from dvbcss.protocol.server.cii import CIIServer
+from dvbcss.protocol.server.ts import TSServer, ciMatchesStem, isControlTimestampChanged
 from dvbcss.protocol.cii import CII
+from dvbcss.protocol.ts import ControlTimestamp, Timestamp
+
+
+_log = logging.getLogger("CssProxyEngine")
+
 
 class BlockableCIIServer(CIIServer):
+    """\
+    CIIServer that can be blocked from sending CII messages to clients (see
+    :func:`setBlocking`), and that works out what to send to clients once for
+    each group of clients that will be sent the same message, rather than for
+    each client.
+
+    The CII state last sent to a client is kept as a single object shared by
+    all the clients that were sent it, so the identity of that object serves
+    as the version of the CII state that each client has. When clients are
+    updated, they are grouped by that version and by the form of the CII
+    customised for them (which only varies by the host and port they
+    connected to, and only if `rewriteHostPort` is used). The diff is then
+    worked out, and serialised, once per group.
+    
+    The customised CII for each host and port, and its serialised form, are
+    kept until the CII state changes. Clients that connect in the meantime
+    are sent the already serialised message, and join the group of clients
+    that were sent it.
+    
+    If a :class:`ProxySendQueues` is supplied as the `sendQueues` argument,
+    messages are queued for each client and sent by its writer threads.
+    
+    If a :class:`ProxyTracer` is supplied as the `tracer` argument, the current
+    trace (if any) is marked once the diffs have been worked out ("cii diff")
+    and after the message for each group has been sent ("cii send batch").
+    """
+    
     def __init__(self, *args, **kwargs):
+        self._sendQueues = kwargs.pop("sendQueues", None)
+        self._tracer = kwargs.pop("tracer", None)
         super(BlockableCIIServer,self).__init__(*args,**kwargs)
         self._blocking=False
+        self._renderedFrom = CII()  # the CII state from which the cached customised CII were made
+        self._customised = {}       # maps variant key to the CII customised for clients with that key
+        self._packed = {}           # maps variant key to the serialised form of the customised CII
+        
+    def _makeHandlerClass(self, *args, **kwargs):
+        handler_cls = super(BlockableCIIServer,self)._makeHandlerClass(*args, **kwargs)
+        handler_cls = ProxyMetrics.countingHandlerClass(handler_cls, "cii")
+        if self._sendQueues is not None:
+            handler_cls = self._sendQueues.handlerClass(handler_cls, "cii")
+        return handler_cls
         
     def setBlocking(self, blocking):
         if bool(self._blocking) == bool(blocking):
@@ -51,7 +99,13 @@ class BlockableCIIServer(CIIServer):
     def onClientConnect(self, webSock):
         """Force not sending, if blocking"""
         if not self._blocking:
-            super(BlockableCIIServer,self).onClientConnect(webSock)
+            with self._lock:
+                self._discardRenderedIfChanged()
+                variant = self._variantKey(webSock)
+                cii = self._customisedFor(variant, webSock)
+                payload = self._packedFor(variant)
+            webSock.send(payload)
+            self.getConnections()[webSock]["prevCII"] = cii
         else:
             self.getConnections()[webSock]["prevCII"] = CII()
         self.onNumClientsChange(len(self.getConnections()))
@@ -60,9 +114,92 @@ class BlockableCIIServer(CIIServer):
         super(BlockableCIIServer,self).onClientDisconnect(*args, **kwargs)
         self.onNumClientsChange(len(self.getConnections()))
             
-    def updateClients(self, *args, **kwargs):
-        if not self._blocking:
-            super(BlockableCIIServer, self).updateClients(*args, **kwargs)
+    def updateClients(self, sendOnlyDiff=True, sendIfEmpty=False):
+        """\
+        Send update of current CII state to all connected clients, unless blocking.
+        See :func:`CIIServer.updateClients <dvbcss.protocol.server.cii.CIIServer.updateClients>`.
+        """
+        if self._blocking:
+            return
+        with self._lock:
+            self._discardRenderedIfChanged()
+            groups = {}     # maps (variant key, id of previous CII) to tuple (previous CII, message to send or None, list of clients)
+            for webSock, connectionData in self.getConnections().items():
+                variant = self._variantKey(webSock)
+                cii = self._customisedFor(variant, webSock)
+                prevCII = connectionData["prevCII"]
+                group = (variant, id(prevCII))
+                if group not in groups:
+                    # the previous CII is held in the group, so its id cannot be reused by another object during this update
+                    groups[group] = (prevCII, self._makeMessage(prevCII, variant, sendOnlyDiff, sendIfEmpty), [])
+                groups[group][2].append(webSock)
+                connectionData["prevCII"] = cii
+        trace = self._currentTrace()
+        if trace is not None:
+            trace.mark("cii diff", groups=len(groups))
+        # sent outside the lock, so a client that is slow to receive does not hold up others connecting or disconnecting
+        for prevCII, payload, webSocks in groups.values():
+            if payload is None:
+                continue
+            for webSock in webSocks:
+                webSock.send(payload)
+            if trace is not None:
+                trace.mark("cii send batch", clients=len(webSocks))
+
+    def _currentTrace(self):
+        if self._tracer is None:
+            return None
+        return self._tracer.current
+                
+    def _variantKey(self, webSock):
+        """\
+        :returns: A key that is the same for all clients for which the CII is customised in the same way.
+        """
+        if not self._rewriteHostPort:
+            return None
+        return tuple(webSock.local_address)
+        
+    def _discardRenderedIfChanged(self):
+        """\
+        Discard the cached customised CII if the CII state has changed since they were made.
+        """
+        if CII.diff(self._renderedFrom, self.cii).definedProperties() or CII.diff(self.cii, self._renderedFrom).definedProperties():
+            self._renderedFrom = self.cii.copy()
+            self._customised = {}
+            self._packed = {}
+        
+    def _customisedFor(self, variant, webSock):
+        """\
+        :returns: The CII customised for clients with the variant key, such as `webSock`.
+        """
+        if variant not in self._customised:
+            self._customised[variant] = self._customiseCii(webSock)
+        return self._customised[variant]
+        
+    def _packedFor(self, variant):
+        """\
+        :returns: The serialised form of the CII customised for clients with the variant key. :func:`_customisedFor` must have been called first.
+        """
+        if variant not in self._packed:
+            self._packed[variant] = self._customised[variant].pack()
+        return self._packed[variant]
+        
+    def _makeMessage(self, prevCII, variant, sendOnlyDiff, sendIfEmpty):
+        """\
+        :returns: The serialised CII message to send to a client with the variant key that was last sent `prevCII`, or None if nothing is to be sent.
+        """
+        cii = self._customised[variant]
+        if not sendOnlyDiff:
+            if sendIfEmpty or cii.definedProperties():
+                return self._packedFor(variant)
+            return None
+        toSend = CII.diff(prevCII, cii)
+        # enforce requirement that contentId must be accompanied by contentIdStatus
+        if toSend.contentId != OMIT:
+            toSend.contentIdStatus = cii.contentIdStatus
+        if sendIfEmpty or toSend.definedProperties():
+            return toSend.pack()
+        return None
             
     def onNumClientsChange(self, newNumClients):
         """\
@@ -72,6 +209,124 @@ class BlockableCIIServer(CIIServer):
         pass
 
 
+class ProxyTSServer(TSServer):
+    """\
+    TSServer that sends each Control Timestamp to clients in a form serialised
+    only once, no matter how many clients it is sent to.
+
+    Timeline sources that provide a `getPackedControlTimestamp` method (such as
+    :class:`ProxyTimelineSource`) supply the serialised form. For other timeline
+    sources, it is serialised for each client as usual.
+
+    Messages sent to clients are counted in the metrics (see :mod:`ProxyMetrics`).
+
+    An index of the clients using each timeline selector is kept, so that
+    :func:`updateClientsForSelectors` only visits the clients using the
+    timelines that have changed, rather than every client.
+
+    If a :class:`ProxySendQueues` is supplied as the `sendQueues` argument,
+    Control Timestamps are queued for each client and sent by its writer
+    threads. Each client is only for one timeline, so a newer Control
+    Timestamp replaces one still waiting to be sent.
+
+    If a :class:`ProxyTracer` is supplied as the `tracer` argument,
+    :func:`updateClientsForSelectors` marks the current trace (if any) after
+    the clients of each timeline have been updated ("ts send batch").
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._sendQueues = kwargs.pop("sendQueues", None)
+        self._tracer = kwargs.pop("tracer", None)
+        self._subscribers = {}  # maps timeline selectors to sets of the connections using them
+        super(ProxyTSServer,self).__init__(*args, **kwargs)
+
+    def _makeHandlerClass(self, *args, **kwargs):
+        handler_cls = super(ProxyTSServer,self)._makeHandlerClass(*args, **kwargs)
+        handler_cls = ProxyMetrics.countingHandlerClass(handler_cls, "ts")
+        if self._sendQueues is not None:
+            handler_cls = self._sendQueues.handlerClass(handler_cls, "ts", latestWins=True)
+        return handler_cls
+
+    def onClientSetup(self, webSock):
+        with self._lock:
+            setup = self._connections[webSock]["setup"]
+            self._subscribers.setdefault(setup.timelineSelector, set()).add(webSock)
+        super(ProxyTSServer,self).onClientSetup(webSock)
+
+    def onClientDisconnect(self, webSock, connectionData):
+        with self._lock:
+            setup = connectionData["setup"]
+            if setup is not None:
+                subscribers = self._subscribers.get(setup.timelineSelector, None)
+                if subscribers is not None:
+                    subscribers.discard(webSock)
+                    if not subscribers:
+                        del self._subscribers[setup.timelineSelector]
+        super(ProxyTSServer,self).onClientDisconnect(webSock, connectionData)
+
+    def subscriberCount(self, timelineSelector):
+        """\
+        :returns: The number of clients using the timeline selector.
+        """
+        with self._lock:
+            return len(self._subscribers.get(timelineSelector, ()))
+
+    def updateClient(self, webSock):
+        with self._lock:
+            connection = self._connections[webSock]
+            setup = connection["setup"]
+            if setup is None:
+                return
+            prevCt = connection["prevCt"]
+            ct = ControlTimestamp(Timestamp(None, self._wallClock.ticks), None)
+            packed = None
+            if ciMatchesStem(self.contentId, setup.contentIdStem):
+                for source in self._timelineSources:
+                    if source.recognisesTimelineSelector(setup.timelineSelector):
+                        ct = source.getControlTimestamp(setup.timelineSelector)
+                        if hasattr(source, "getPackedControlTimestamp"):
+                            packed = source.getPackedControlTimestamp(setup.timelineSelector)
+                        else:
+                            packed = None
+            if ct is not None and isControlTimestampChanged(prevCt, ct):
+                connection["prevCt"] = ct
+                if packed is None:
+                    packed = ct.pack()
+                webSock.send(packed)
+
+    def updateClientsForSelectors(self, timelineSelectors):
+        """\
+        Update only the clients that have asked for one of the specified
+        timelines. Use this instead of :func:`updateAllClients` when only the
+        Control Timestamps for those timelines have changed.
+
+        :param timelineSelectors: list of timeline selectors whose Control Timestamps have changed.
+        """
+        if not timelineSelectors:
+            return
+        trace = self._currentTrace()
+        with self._lock:
+            for timelineSelector in timelineSelectors:
+                subscribers = self._subscribers.get(timelineSelector, None)
+                if subscribers is None:
+                    continue
+                for webSock in list(subscribers):
+                    if webSock in self._connections:
+                        self.updateClient(webSock)
+                    else:
+                        # connections are discarded without notification when the server is disabled
+                        subscribers.discard(webSock)
+                if trace is not None:
+                    trace.mark("ts send batch", timelineSelector=timelineSelector, clients=len(subscribers))
+                if not subscribers:
+                    del self._subscribers[timelineSelector]
+
+    def _currentTrace(self):
+        if self._tracer is None:
+            return None
+        return self._tracer.current
+
+
 class CssProxyEngine(object):
     """\
     Proxying server engine. Takes a CIIServer and TsServer and acts as a
@@ -100,21 +355,57 @@ class CssProxyEngine(object):
     disabled.
     
     CII messages are modified to have the URLs of the Wall Clock and TS servers.
+    
+    Clients of the TS server are only updated for timelines whose Control
+    Timestamps have actually changed, unless the content ID has changed, in
+    which case all clients are updated.
+    
+    Updates from the browser can optionally be coalesced. The first update is
+    applied immediately. Any further updates received within the coalescing
+    window are merged (CII changes are combined, and only the latest Control
+    Timestamp for each timeline is kept) and applied together at the end of the
+    window. Clients are therefore updated at most once per window, no matter
+    how quickly the browser sends updates.
+    
+    The time taken to apply each update is recorded in the metrics (see
+    :mod:`ProxyMetrics`).
+    
+    If a :class:`ProxyTracer` is supplied, each update is traced from its
+    receipt from the browser, through the sending of CII messages and Control
+    Timestamps to clients. Updates applied at the end of a coalescing window
+    are traced from the end of the window. Give the same tracer to the CII and
+    TS servers to also trace the individual batches of messages they send.
     """
     Server = CssProxy_ServerEndpoint
     TimelineSource = ProxyTimelineSource
+    Timer = staticmethod(threading.Timer)
     
-    def __init__(self, ciiServer, tsServer, ciiUrl, tsUrl, wcUrl):
+    def __init__(self, ciiServer, tsServer, ciiUrl, tsUrl, wcUrl, tsTolerance=0.0, coalesceWindow=0.0, tracer=None, recorder=None, browserBatchWindow=0.0, tsLinger=0.0, tsUnavailableTtl=0.0, serverEndpoint=None):
         """\
         :param ciiServer: A running BlockableCIIServer. Does not have to be enabled.
-        :param tsServer:  A running TSServer. Does not have to be enabled.
+        :param tsServer:  A running TSServer (preferably a ProxyTSServer). Does not have to be enabled.
         :param ciiUrl:    The URL of the CII server to be supplied to applications.
         :param tsUrl:     The URL of the TSServer endpoint.
         :param wcUrl:     The URL of WCServer endpoint.
+        :param tsTolerance: Control Timestamps from the browser that differ from the extrapolation of the last one relayed by less than this (in seconds) are not relayed to TS clients. See :class:`ProxyTimelineSource`.
+        :param coalesceWindow: Period (in seconds) over which updates from the browser are coalesced. Zero means every update is applied as soon as it is received.
+        :param tracer: Optional :class:`ProxyTracer` in which to record traces of updates. None means no tracing.
+        :param recorder: Optional :class:`SessionRecorder` in which to record the messages to and from the browser. None means no recording.
+        :param browserBatchWindow: Period (in seconds) over which changes to the timelines required by clients, and to the number of clients, are batched before being sent to the browser. Zero means they are sent as soon as they happen. See :class:`CssProxy_ServerEndpoint`.
+        :param tsLinger: Period (in seconds) for which a timeline no longer needed by any TS client is still requested from the browser, in case it is needed again. See :class:`ProxyTimelineSource`.
+        :param tsUnavailableTtl: Period (in seconds) for which a timeline the browser reported as unavailable is answered as such without asking the browser again, while the content ID is unchanged. See :class:`ProxyTimelineSource`.
+        :param serverEndpoint: Optional source of updates to use instead of a :class:`CssProxy_ServerEndpoint` for a browser to connect to, such as an :class:`~ProxyRelay.UpstreamFeed`. It must have the same callbacks and methods. If supplied, `tracer`, `recorder` and `browserBatchWindow` do not apply to it.
         """
-        initialMessage = json.dumps({
+        initialMessage = {
             "ciiUrl": ciiUrl
-        })
+        }
+        
+        self._coalesceWindow = coalesceWindow
+        self._lock = threading.RLock()
+        self._timer = None
+        self._pending = None    # tuple (cii, controlTimestamps, options) of updates merged while timer is running
+        self._updateSeconds = ProxyMetrics.updateSeconds()
+        self._tracer = tracer
         
         # create wallclock server
         self.ciiServer = ciiServer
@@ -125,8 +416,10 @@ class CssProxyEngine(object):
         
         self.ciiServer.onNumClientsChange = self._onNumCiiClientsChanged
         
-        self.tsSource = self.TimelineSource()
-        self.serverEndpoint = self.Server(initialMessage)
+        self.tsSource = self.TimelineSource(tolerance=tsTolerance, linger=tsLinger, unavailableTtl=tsUnavailableTtl)
+        if serverEndpoint is None:
+            serverEndpoint = self.Server(initialMessage, tracer=tracer, recorder=recorder, batchWindow=browserBatchWindow)
+        self.serverEndpoint = serverEndpoint
         
         self.tsServer.attachTimelineSource(self.tsSource)
         
@@ -145,6 +438,64 @@ class CssProxyEngine(object):
         self.serverEndpoint.sendTimelinesRequest(selectors, added,removed)
         
     def _onUpdateFromServer(self, cii, controlTimestamps, options):
+        with self._lock:
+            if self._coalesceWindow <= 0:
+                self._applyUpdate(cii, controlTimestamps, options)
+            elif self._timer is None:
+                self._applyUpdate(cii, controlTimestamps, options)
+                self._startTimer()
+            else:
+                if self._pending is None:
+                    pendingCii = CII()
+                    pendingCii.update(cii)
+                    self._pending = (pendingCii, dict(controlTimestamps), dict(options))
+                else:
+                    pendingCii, pendingCts, pendingOptions = self._pending
+                    pendingCii.update(cii)
+                    pendingCts.update(controlTimestamps)
+                    pendingOptions.update(options)
+                trace = self._currentTrace()
+                if trace is not None:
+                    trace.mark("coalesced")
+                
+    def _startTimer(self):
+        self._timer = self.Timer(self._coalesceWindow, self._onCoalesceWindowEnd)
+        self._timer.daemon = True
+        self._timer.start()
+        
+    def _onCoalesceWindowEnd(self):
+        with self._lock:
+            self._timer = None
+            if self._pending is not None:
+                cii, controlTimestamps, options = self._pending
+                self._pending = None
+                if self._tracer is None:
+                    self._applyUpdate(cii, controlTimestamps, options)
+                else:
+                    self._tracer.begin("coalesced update", "window end")
+                    try:
+                        self._applyUpdate(cii, controlTimestamps, options)
+                    finally:
+                        self._tracer.end()
+                self._startTimer()
+                
+    def _cancelCoalescing(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._pending = None
+        
+    def _currentTrace(self):
+        if self._tracer is None:
+            return None
+        return self._tracer.current
+        
+    def _applyUpdate(self, cii, controlTimestamps, options):
+        with self._updateSeconds.time():
+            self._applyUpdateUntimed(cii, controlTimestamps, options, self._currentTrace())
+        
+    def _applyUpdateUntimed(self, cii, controlTimestamps, options, trace):
         # don't allow these to be overridden - keep the values we first supplied
         cii.tsUrl = OMIT
         cii.wcUrl = OMIT
@@ -158,15 +509,39 @@ class CssProxyEngine(object):
             self.ciiServer.setBlocking(False)
 
         self.ciiServer.updateClients(sendOnlyDiff=True)
+        if trace is not None:
+            trace.mark("cii send")
         
         # Update the TS server
+        contentIdChanged = self.tsServer.contentId != self.ciiServer.cii.contentId
         self.tsServer.contentId = self.ciiServer.cii.contentId
-        self.tsSource.timelinesUpdate(controlTimestamps)
-        self.tsServer.updateAllClients()
+        self.tsSource.setContentId(self.ciiServer.cii.contentId)
+        self.tsSource.setTimelineOptions(self.ciiServer.cii.timelines)
+        changedSelectors = self.tsSource.timelinesUpdate(controlTimestamps)
+        if trace is not None:
+            trace.mark("ts change detection", changed=len(changedSelectors))
+        if contentIdChanged or not hasattr(self.tsServer, "updateClientsForSelectors"):
+            self.tsServer.updateAllClients()
+        else:
+            self.tsServer.updateClientsForSelectors(changedSelectors)
+        if trace is not None:
+            trace.mark("ts send", allClients=contentIdChanged)
         
     def _onServerConnectionStateChange(self):
         connected = self.serverEndpoint.serverConnected
+        if not connected:
+            self._cancelCoalescing()
         self.ciiServer.enabled=connected
         self.tsServer.enabled=connected
-        print "CII & TS Servers enabled?", connected
-                    
+        _log.info("CII & TS Servers enabled? %s", connected)
+        self.onServerConnectionStateChange(connected)
+
+    def onServerConnectionStateChange(self, connected):
+        """\
+        Stub. Override in your implementation to be notified when the browser
+        connects to, or disconnects from, the server endpoint.
+
+        :param connected: True if the browser is now connected, otherwise False.
+        """
+        pass
+
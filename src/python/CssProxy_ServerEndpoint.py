@@ -29,17 +29,99 @@ except ImportError:
 
 import cherrypy
 import json
+import logging
+import threading
 from dvbcss.protocol.server import WSServerTool
 from dvbcss.protocol.server import WSServerBase
 from dvbcss.protocol.cii import CII
+from dvbcss.protocol.ts import Timestamp
+from dvbcss.protocol.transformers import decodeOneOf, Transformer
+
+import ProxyCodecs
+import ProxyMetrics
+import ProxyLogging
 
 cherrypy.tools.css_proxy = WSServerTool()
 
+_messageLog = logging.getLogger(ProxyLogging.MESSAGES_LOGGER)
+
+
+def decodeCii(struct):
+    """\
+    Build a :class:`~dvbcss.protocol.cii.CII` object from a CII message that
+    has already been parsed from JSON. Equivalent to
+    :func:`CII.unpack(json.dumps(struct)) <dvbcss.protocol.cii.CII.unpack>`
+    but without serialising and parsing the message again.
+    
+    :throws ValueError: if not possible.
+    """
+    kwargs={}
+    for name, transformers in CII._propertyTransform.items():
+        if name in struct:
+            kwargs[name] = decodeOneOf(struct[name], "Value of "+name+" property not valid.", *transformers)
+    return CII(**kwargs)
+
+
+def decodeControlTimestamp(struct):
+    """\
+    Build a :class:`~dvbcss.protocol.ts.ControlTimestamp` object from a Control
+    Timestamp that has already been parsed from JSON. Equivalent to
+    :func:`ControlTimestamp.unpack(json.dumps(struct)) <dvbcss.protocol.ts.ControlTimestamp.unpack>`
+    but without serialising and parsing it again.
+    
+    :throws ValueError: if not possible.
+    """
+    try:
+        contentTime             = decodeOneOf(_intAsString(struct["contentTime"]),             "Not a valid Control Timestamp contentTime.",             Transformer.null, Transformer.intAsString)
+        wallClockTime           = decodeOneOf(_intAsString(struct["wallClockTime"]),           "Not a valid Control Timestamp wallClockTime.",           Transformer.intAsString)
+        timelineSpeedMultiplier = decodeOneOf(struct["timelineSpeedMultiplier"], "Not a valid Control Timestamp timelineSpeedMultiplier.", Transformer.null, Transformer.float)
+    except KeyError:
+        raise ValueError("Not all fields in Control Timestamp present as expected")
+    
+    if (contentTime is None) != (timelineSpeedMultiplier is None):
+        raise ValueError("Both contentTime and timelineSpeedMutliplier must be null, or neither must be null. Cannot be only one of them.")
+    
+    return ControlTimestamp(Timestamp(contentTime, wallClockTime), timelineSpeedMultiplier)
+
+
+def _intAsString(value):
+    """\
+    Binary codecs can carry integers directly, rather than as strings as in JSON.
+    """
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+
+def isBinaryMessage(message):
+    """\
+    :returns: True if the message received from a WebSocket was a binary frame.
+    """
+    return bool(getattr(message, "is_binary", False)) or isinstance(message, (bytearray, memoryview))
+
+
+def messagePayload(message):
+    """\
+    :param message: A message received from a WebSocket, as a ws4py message
+      object, or directly as :class:`str`, :class:`bytearray` or :class:`memoryview`.
+    :returns: The payload of the message, suitable for passing to :func:`json.loads`,
+      without copying it if it is already a :class:`str`.
+    """
+    data = getattr(message, "data", message)
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    elif isinstance(data, (str, unicode)):
+        return data
+    else:
+        return str(data)
+
 
 class CssProxy_ServerEndpoint(object):
     """\
     Websocket server that provides an endpoint for a single CSS server
-    (e.g. TV in a browser) to connect to.
+    (e.g. TV in a browser) to connect to. Only one connection is accepted at a
+    time. To serve several browsers from one process, create an endpoint for
+    each (see :class:`ProxySessionRegistry`).
     
     Expects to receive JSON messages from the CSS server that are a JSON object
     containing zero, one or more of the following properties:
@@ -81,18 +163,85 @@ class CssProxy_ServerEndpoint(object):
             "nrOfSlaves": 2
         }
         
-    You can also provide a string as an initial message that will be sent when a client first connects.
+    You can also provide an initial message that will be sent when a client first connects.
+    If it is a :class:`dict` then it is sent as a JSON object, with an additional
+    "codecs" property listing the wire codecs available (see :mod:`ProxyCodecs`)
+    in order of preference, e.g.:
+    .. code-block:: json
+    
+        {
+            "ciiUrl" : "ws://192.168.1.5:7681/cii",
+            "codecs" : [ "msgpack", "cbor", "json" ]
+        }
+    
+    Messages are JSON until the client selects a different codec by sending a
+    JSON message with a "codec" property naming it. The choice is confirmed
+    by replying (in JSON) with a message containing the "codec" property
+    naming the codec that will now be used, which is "json" if the one asked
+    for is not available. Thereafter messages in both directions are encoded
+    with that codec, in binary frames if it is a binary encoding. In binary
+    encodings, "contentTime" and "wallClockTime" may be integers instead of
+    strings. Text frames are always treated as JSON.
+    
+    Each message received is logged at debug level to the logger named by
+    :data:`ProxyLogging.MESSAGES_LOGGER`.
+    
+    If a :class:`ProxyTracer` is supplied, a trace is begun for each message
+    received, marking when it was received and decoded. It remains the current
+    trace while :func:`onUpdate` is called, so the stages of applying the
+    update can be marked too.
+    
+    If a recorder (see :func:`ProxyRecorder.session`) is supplied, the browser
+    connecting and disconnecting, and every message received from and sent to
+    it, are recorded.
+    
+    Changes to the timelines required and the number of slaves can optionally
+    be batched. Instead of being sent as soon as they happen (i.e. while
+    handling the connection or disconnection of a companion), they are
+    accumulated and sent together, in a single message, at the end of the
+    batching window, e.g.:
+    
+    .. code-block:: json
+    
+        {
+            "add_timelineSelectors"    : [ "urn:dvb:css:timelines:pts" ],
+            "remove_timelineSelectors" : [ ],
+            "nrOfSlaves": 150
+        }
+    
+    A timeline selector that is added and then removed again (or vice versa)
+    within the window is not mentioned at all, and only the latest number of
+    slaves is sent.
     """
     ServerBase = WSServerBase
+    Timer = staticmethod(threading.Timer)
     
-    def __init__(self, initialMsg=""):
+    def __init__(self, initialMsg="", tracer=None, recorder=None, batchWindow=0.0):
+        """\
+        :param initialMsg: Message sent to the client when it first connects.
+        :param tracer: Optional :class:`ProxyTracer` to record traces of messages received. None means no tracing.
+        :param recorder: Optional :class:`SessionRecorder` to record the messages to and from the client. None means no recording.
+        :param batchWindow: Period (in seconds) over which changes to the timelines required and the number of slaves are batched. Zero means they are sent as soon as they happen.
+        """
         super(CssProxy_ServerEndpoint,self).__init__()
         self.selectors = []
         self.webSock = None
         self._initialMsg = initialMsg
+        self._codec = ProxyCodecs.JSON
         self._serverConnected = False
+        self._tracer = tracer
+        self._recorder = recorder
+        self._batchWindow = batchWindow
+        self._batchLock = threading.RLock()
+        self._timer = None
+        self._pendingAdded = []
+        self._pendingRemoved = []
+        self._pendingSlaves = None
+        self._received = ProxyMetrics.browserMessagesReceived()
+        self._sent = ProxyMetrics.messagesSent("server")
+        self._sentBytes = ProxyMetrics.bytesSent("server")
 
-        self._server = self.ServerBase(maxConnectionsAllowed=-1, enabled=True)
+        self._server = self.ServerBase(maxConnectionsAllowed=1, enabled=True)
         self._server.getDefaultConnection = self._getDefaultConnectionData
         self._server.onClientConnect = self._onClientConnect
         self._server.onClientDisconnect = self._onClientDisconnect
@@ -123,42 +272,99 @@ class CssProxy_ServerEndpoint(object):
         
     def _onClientConnect(self, webSock):
         self.webSock = webSock
+        self._codec = ProxyCodecs.JSON
+        if self._recorder is not None:
+            self._recorder.connected()
+        self._discardBatch()
         self.sendInitialInfo();
-        self.sendTimelinesRequest(self.selectors, self.selectors, [])
+        self._send({ "add_timelineSelectors":self.selectors[:], "remove_timelineSelectors":[] })
         self._serverConnected = True
         self.onServerConnected()
         
     def _onClientDisconnect(self, webSock, connectionData):
         self.webSock = None
         self._serverConnected = False
+        self._discardBatch()
+        if self._recorder is not None:
+            self._recorder.disconnected()
         self.onServerDisconnected()
     
     def _onClientMessage(self, webSock, message):
-        msg = json.loads(str(message))
-        print msg
-        print
+        if self._tracer is None:
+            self._handleClientMessage(message, None)
+        else:
+            trace = self._tracer.begin("browser message", "receive")
+            try:
+                self._handleClientMessage(message, trace)
+            finally:
+                self._tracer.end()
+        
+    def _handleClientMessage(self, message, trace):
+        self._received.inc()
+        binary = isBinaryMessage(message)
+        payload = messagePayload(message)
+        if self._recorder is not None:
+            self._recorder.received(payload, binary)
+        if binary:
+            msg = self._codec.decode(payload)
+        else:
+            msg = ProxyCodecs.JSON.decode(payload)
+        _messageLog.debug("Received from browser: %r", msg)
+        
+        if "codec" in msg:
+            self._selectCodec(msg["codec"])
+            if len(msg) == 1:
+                return
         
         if "cii" in msg:
-            cii = CII.unpack(json.dumps(msg["cii"]))
+            cii = decodeCii(msg["cii"])
         else:
             cii = CII()
             
         controlTimestamps = {}
         if "controlTimestamps" in msg:
             for timelineSelector, recvControlTimestamp in msg["controlTimestamps"].items():
-                ct = ControlTimestamp.unpack(json.dumps(recvControlTimestamp))
-                controlTimestamps[timelineSelector] = ct
+                controlTimestamps[timelineSelector] = decodeControlTimestamp(recvControlTimestamp)
             
         options = {}
         if "options" in msg:
             options = msg["options"]
             
+        if trace is not None:
+            trace.mark("decode", timelines=len(controlTimestamps))
+            
         self.onUpdate(cii,controlTimestamps, options)
         
+    def _selectCodec(self, name):
+        codec = ProxyCodecs.getCodec(name) or ProxyCodecs.JSON
+        self._codec = ProxyCodecs.JSON
+        self._send({ "codec":codec.name })
+        self._codec = codec
+        
+    def _send(self, msg):
+        payload = self._codec.encode(msg)
+        self._count(payload, self._codec.binary)
+        if self._codec.binary:
+            self.webSock.send(payload, binary=True)
+        else:
+            self.webSock.send(payload)
+        
+    def _count(self, payload, binary=False):
+        self._sent.inc()
+        self._sentBytes.inc(len(payload))
+        if self._recorder is not None:
+            self._recorder.sent(payload, binary)
+        
     def sendInitialInfo(self):
         if self.webSock and self._initialMsg != "":
             try:
-                self.webSock.send(self._initialMsg)
+                if isinstance(self._initialMsg, dict):
+                    msg = dict(self._initialMsg)
+                    msg["codecs"] = ProxyCodecs.availableCodecNames()
+                    self._send(msg)
+                else:
+                    self._count(self._initialMsg)
+                    self.webSock.send(self._initialMsg)
             except Exception as ex:
                 self.webSock.terminate()
         
@@ -173,9 +379,22 @@ class CssProxy_ServerEndpoint(object):
         :param removed: array of all no-longer required timeline selector strings.
         """
         self.selectors = allSelectors[:]
-        if self.webSock:
+        if self._batchWindow > 0:
+            with self._batchLock:
+                for selector in added:
+                    if selector in self._pendingRemoved:
+                        self._pendingRemoved.remove(selector)
+                    elif selector not in self._pendingAdded:
+                        self._pendingAdded.append(selector)
+                for selector in removed:
+                    if selector in self._pendingAdded:
+                        self._pendingAdded.remove(selector)
+                    elif selector not in self._pendingRemoved:
+                        self._pendingRemoved.append(selector)
+                self._startBatch()
+        elif self.webSock:
             msg = { "add_timelineSelectors":added, "remove_timelineSelectors":removed }
-            self.webSock.send(json.dumps(msg))
+            self._send(msg)
         
     def updateNumberOfSlaves(self, nrOfSlaves):
         """\
@@ -183,9 +402,44 @@ class CssProxy_ServerEndpoint(object):
         
         :param nrOfSlaves: integer number of slaves currently connected to CII
         """
-        if self.webSock:
+        if self._batchWindow > 0:
+            with self._batchLock:
+                self._pendingSlaves = int(nrOfSlaves)
+                self._startBatch()
+        elif self.webSock:
             msg = { "nrOfSlaves":int(nrOfSlaves) }
-            self.webSock.send(json.dumps(msg))
+            self._send(msg)
+            
+    def _startBatch(self):
+        if self._timer is None and self.webSock:
+            self._timer = self.Timer(self._batchWindow, self._onBatchWindowEnd)
+            self._timer.daemon = True
+            self._timer.start()
+            
+    def _onBatchWindowEnd(self):
+        with self._batchLock:
+            self._timer = None
+            msg = {}
+            if self._pendingAdded or self._pendingRemoved:
+                msg["add_timelineSelectors"] = self._pendingAdded
+                msg["remove_timelineSelectors"] = self._pendingRemoved
+            if self._pendingSlaves is not None:
+                msg["nrOfSlaves"] = self._pendingSlaves
+            self._pendingAdded = []
+            self._pendingRemoved = []
+            self._pendingSlaves = None
+        # sent outside the lock, so companions connecting meanwhile are not held up
+        if msg and self.webSock:
+            self._send(msg)
+                
+    def _discardBatch(self):
+        with self._batchLock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._pendingAdded = []
+            self._pendingRemoved = []
+            self._pendingSlaves = None
             
     def onUpdate(self, cii, controlTimestamps,options):
         """\
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import weakref
+
+from ws4py.exc import HandshakeError
+from ws4py.server.wsgiutils import WebSocketWSGIApplication
+
+
+def _makeEventLoopHandlerClass(handler_cls):
+    """\
+    :param handler_cls: handler class of a pydvbcss :class:`~dvbcss.protocol.server.WSServerBase`
+    :returns: subclass of the handler class that notifies its server of the
+      new connection as soon as it starts running on the event loop.
+
+    Under cherrypy the notification is triggered by the :class:`WSServerTool`
+    once cherrypy has flushed the handshake response. Under the event loop the
+    handshake response has already been flushed by the time the connection's
+    greenlet calls :func:`opened`.
+    """
+    class EventLoopHandler(handler_cls):
+        def opened(self):
+            self.openComplete()
+
+    return EventLoopHandler
+
+
+class EventLoopServer(object):
+    """\
+    Alternative to cherrypy for hosting the WebSocket server endpoints of the
+    proxy (CII, TS, WebSocket wall clock and the server/proxy interface).
+
+    Every connection is run as a greenlet on a single gevent event loop
+    instead of occupying a thread from cherrypy's thread pool. This allows a
+    single process to hold many thousands of companion connections.
+
+    The server endpoints themselves are unchanged. Mount the `handler` class of
+    each pydvbcss :class:`~dvbcss.protocol.server.WSServerBase` at a path,
+    in the same way it would be provided as the `handler_cls` for a cherrypy
+    tool:
+
+    .. code-block:: python
+
+        server = EventLoopServer("0.0.0.0", 7681)
+        server.mount("/cii", ciiServer.handler)
+        server.mount("/server", proxyEngine.serverEndpoint._server.handler, allowedAddrs=["127.0.0.1"])
+        server.start()
+
+    The same checks are made before upgrading the connection as with the
+    cherrypy :class:`~dvbcss.protocol.server.WSServerTool`: a disabled
+    endpoint is refused with 403 "Forbidden" and an endpoint that has reached
+    its connection limit is refused with 503 "Service Unavailable". Requests
+    for an unknown path, or from an address not in the allowed list for the
+    path, are refused with 404 "Not Found".
+
+    gevent monkey patching (:func:`gevent.monkey.patch_all`) must have been
+    applied before cherrypy, ws4py or pydvbcss are imported, so that their
+    threads, locks and sockets cooperate with the event loop.
+    """
+
+    def __init__(self, host, port):
+        """\
+        :param host: The address to bind to.
+        :param port: The port number to bind to.
+        """
+        super(EventLoopServer,self).__init__()
+        self._host = host
+        self._port = port
+        self._routes = {}   # maps path to (handler class, list of allowed remote addresses or None for any)
+        self._resolvers = []  # list of (path prefix, resolver function)
+        self._pages = {}      # maps path to (function returning page body, content type)
+        self._eventLoopHandlers = weakref.WeakKeyDictionary()
+        self._server = None
+
+    def mount(self, path, handler_cls, allowedAddrs=None):
+        """\
+        Mount a WebSocket endpoint at the specified path.
+
+        :param path: The path, e.g. "/cii"
+        :param handler_cls: The `handler` class of a pydvbcss :class:`~dvbcss.protocol.server.WSServerBase`
+        :param allowedAddrs: Optional list of remote IP addresses from which connections will be accepted, or None to accept from any.
+        """
+        self._routes[path] = (handler_cls, allowedAddrs)
+
+    def mountPage(self, path, function, contentType="text/plain"):
+        """\
+        Mount a plain HTTP page (not a WebSocket endpoint) at the specified path,
+        such as the metrics page.
+
+        :param path: The path, e.g. "/metrics"
+        :param function: Function called with no arguments that returns the body of the page as a :class:`str`.
+        :param contentType: The Content-Type of the page.
+        """
+        self._pages[path] = (function, contentType)
+
+    def mountResolver(self, prefix, resolver):
+        """\
+        Mount a function that determines the WebSocket endpoint for any path
+        under a prefix, such as the endpoints of each session of a
+        :class:`ProxySessionRegistry`.
+
+        Paths mounted with :func:`mount` take precedence.
+
+        :param prefix: The path prefix, e.g. "/cii"
+        :param resolver: Function called with arguments (path, remote IP address) that returns the `handler` class for the endpoint, or None if there is no endpoint for that path.
+        """
+        self._resolvers.append((prefix.rstrip("/"), resolver))
+
+    def start(self):
+        """\
+        Start listening for connections. Returns immediately. The connections are
+        serviced whenever the event loop runs (e.g. while the main greenlet sleeps).
+        """
+        from ws4py.server.geventserver import WSGIServer
+        self._server = WSGIServer((self._host, self._port), self._application, log=None)
+        self._server.start()
+
+    def stop(self):
+        """\
+        Stop listening and close all connections.
+        """
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+    def _eventLoopHandlerFor(self, handler_cls):
+        try:
+            return self._eventLoopHandlers[handler_cls]
+        except KeyError:
+            cls = _makeEventLoopHandlerClass(handler_cls)
+            self._eventLoopHandlers[handler_cls] = cls
+            return cls
+
+    def _resolve(self, path, remoteAddr):
+        """\
+        :returns: handler class for the path, or None if nothing is mounted there or the remote address is not allowed.
+        """
+        path = path.rstrip("/") or "/"
+        if path in self._routes:
+            handler_cls, allowedAddrs = self._routes[path]
+            if allowedAddrs is not None and remoteAddr not in allowedAddrs:
+                return None
+            return handler_cls
+        for prefix, resolver in self._resolvers:
+            if path == prefix or path.startswith(prefix+"/"):
+                return resolver(path, remoteAddr)
+        return None
+
+    def _application(self, environ, start_response):
+        page = self._pages.get(environ.get("PATH_INFO", ""))
+        if page is not None and environ.get("HTTP_UPGRADE", "").lower() != "websocket":
+            function, contentType = page
+            body = function()
+            start_response("200 OK", [("Content-Type", contentType), ("Content-Length", str(len(body)))])
+            return [body]
+
+        handler_cls = self._resolve(environ.get("PATH_INFO", ""), environ.get("REMOTE_ADDR"))
+        if handler_cls is None:
+            return self._refuse(start_response, "404 Not Found")
+
+        if not handler_cls.isEnabled():
+            return self._refuse(start_response, "403 Forbidden")
+        if not handler_cls.canAllocateConnection():
+            return self._refuse(start_response, "503 Service Unavailable")
+
+        app = WebSocketWSGIApplication(handler_cls=self._eventLoopHandlerFor(handler_cls))
+        try:
+            return app(environ, start_response)
+        except HandshakeError as e:
+            return self._refuse(start_response, "400 Bad Request", str(e))
+
+    def _refuse(self, start_response, status, reason=None):
+        body = reason or status
+        start_response(status, [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+        return [body]
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""\
+Wire codecs for the server/proxy interface between the proxy and the TV in a
+browser (see :class:`CssProxy_ServerEndpoint`).
+
+JSON is always available. Compact binary encodings are available if the
+library providing them is installed:
+
+* "msgpack" - `MessagePack <https://msgpack.org/>`_, requires the `msgpack` package
+* "cbor" - `CBOR <http://cbor.io/>`_, requires the `cbor2` package
+
+If the `ujson` package is installed, it is used for JSON instead of the
+standard library, as it is considerably faster.
+"""
+
+import json
+
+try:
+    import ujson as _fastjson
+except ImportError:
+    _fastjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class JsonCodec(object):
+    """\
+    Encodes messages as JSON, sent in text frames.
+    """
+    name = "json"
+    binary = False
+
+    def __init__(self):
+        super(JsonCodec,self).__init__()
+        if _fastjson is not None:
+            self._dumps = _fastjson.dumps
+            self._loads = _fastjson.loads
+        else:
+            self._dumps = json.dumps
+            self._loads = json.loads
+
+    def encode(self, msg):
+        return self._dumps(msg)
+
+    def decode(self, payload):
+        return self._loads(payload)
+
+
+class MsgPackCodec(object):
+    """\
+    Encodes messages as MessagePack, sent in binary frames.
+    """
+    name = "msgpack"
+    binary = True
+
+    def encode(self, msg):
+        return msgpack.packb(msg, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+class CborCodec(object):
+    """\
+    Encodes messages as CBOR, sent in binary frames.
+    """
+    name = "cbor"
+    binary = True
+
+    def encode(self, msg):
+        return cbor2.dumps(msg)
+
+    def decode(self, payload):
+        return cbor2.loads(payload)
+
+
+JSON = JsonCodec()
+
+CODECS = []   # available codecs, in order of preference
+if msgpack is not None:
+    CODECS.append(MsgPackCodec())
+if cbor2 is not None:
+    CODECS.append(CborCodec())
+CODECS.append(JSON)
+
+
+def availableCodecNames():
+    """\
+    :returns: list of the names of the available codecs, in order of preference.
+    """
+    return [ codec.name for codec in CODECS ]
+
+
+def getCodec(name):
+    """\
+    :returns: The codec with the specified name, or None if it is not available.
+    """
+    for codec in CODECS:
+        if codec.name == name:
+            return codec
+    return None
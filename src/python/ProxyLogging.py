@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os
+import logging
+import threading
+import Queue
+
+
+MESSAGES_LOGGER = "CssProxy_ServerEndpoint.messages"
+"""\
+Name of the logger to which each message received from a browser is logged, at debug level.
+"""
+
+
+class AsyncLogHandler(logging.Handler):
+    """\
+    Logging handler that does not write records itself. Instead it puts them
+    on a queue, from which a background thread passes them to another handler
+    (e.g. a :class:`logging.StreamHandler`) to be written.
+
+    A thread that logs is therefore never held up by a slow terminal or pipe.
+    If the queue fills up because records cannot be written fast enough,
+    further records are discarded (and counted in :data:`dropped`) until there
+    is room again.
+
+    Records logged in a child process (e.g. a wall clock worker) are passed
+    straight to the other handler, because the background thread does not
+    exist in the child.
+    """
+
+    def __init__(self, target, capacity=10000):
+        """\
+        :param target: The :class:`logging.Handler` that writes the records.
+        :param capacity: The number of records that can be waiting to be written.
+        """
+        super(AsyncLogHandler,self).__init__()
+        self.target = target
+        self.dropped = 0
+        self._queue = Queue.Queue(capacity)
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def setFormatter(self, fmt):
+        super(AsyncLogHandler,self).setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def emit(self, record):
+        if os.getpid() != self._pid:
+            self.target.handle(record)
+            return
+        try:
+            self._queue.put_nowait(self._prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _prepare(self, record):
+        # resolve the message now, in case its arguments change before it is written
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.handleError(record)
+
+    def close(self):
+        """\
+        Write any records still waiting, then stop the background thread and close the other handler.
+        """
+        if self._thread.is_alive() and os.getpid() == self._pid:
+            self._queue.put(None)
+            self._thread.join()
+        self.target.close()
+        super(AsyncLogHandler,self).close()
+
+
+class SampleFilter(logging.Filter):
+    """\
+    Logging filter that lets through only 1 in every N records.
+    """
+
+    def __init__(self, every):
+        """\
+        :param every: N. 1 lets through every record.
+        """
+        super(SampleFilter,self).__init__()
+        self.every = max(1, int(every))
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        with self._lock:
+            self._count += 1
+            if self._count >= self.every:
+                self._count = 0
+                return True
+            return False
+
+
+def configure(level, sampleMessagesEvery=1):
+    """\
+    Set up logging for the proxy, so that records are written to stderr by a
+    background thread (see :class:`AsyncLogHandler`).
+
+    :param level: The logging level, e.g. :data:`logging.WARNING`.
+    :param sampleMessagesEvery: Only log 1 in this many of the messages received from browsers (see :data:`MESSAGES_LOGGER`).
+    :returns: The :class:`AsyncLogHandler`. Close it when finishing, to write any records still waiting.
+    """
+    handler = AsyncLogHandler(logging.StreamHandler())
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    if sampleMessagesEvery > 1:
+        logging.getLogger(MESSAGES_LOGGER).addFilter(SampleFilter(sampleMessagesEvery))
+    return handler
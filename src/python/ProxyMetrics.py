@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import threading
+import time
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def _formatLabels(labels, extra=()):
+    items = sorted(labels.items()) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\","\\\\").replace('"','\\"')) for name, value in items) + "}"
+
+
+def _formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """\
+    A value that only ever increases, such as the number of messages sent.
+
+    If a function is supplied, the value is instead obtained by calling it
+    whenever the metrics are exposed.
+    """
+    type = "counter"
+
+    def __init__(self, labels, function=None):
+        super(Counter,self).__init__()
+        self.labels = labels
+        self._function = function
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+    def samples(self, name):
+        """\
+        :returns: list of (name, labels suffix, value) tuples to be exposed.
+        """
+        return [ (name, _formatLabels(self.labels), self.value) ]
+
+
+class Gauge(Counter):
+    """\
+    A value that can go up and down, such as the number of connections.
+    """
+    type = "gauge"
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram(object):
+    """\
+    Counts of observed values (e.g. durations in seconds) falling at or below
+    each of a set of bucket boundaries, plus their count and sum.
+    """
+    type = "histogram"
+
+    def __init__(self, labels, buckets=DEFAULT_BUCKETS):
+        super(Histogram,self).__init__()
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * len(self.buckets)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value, count=1):
+        """\
+        Record an observation.
+
+        :param value: The value observed.
+        :param count: The number of times it was observed.
+        """
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._counts[i] += count
+                    break
+            self._count += count
+            self._sum += value * count
+
+    def time(self):
+        """\
+        :returns: A context manager that observes the time (in seconds) spent inside it.
+        """
+        return _Timing(self)
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def samples(self, name):
+        with self._lock:
+            counts = self._counts[:]
+            count = self._count
+            total = self._sum
+        result = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            result.append((name+"_bucket", _formatLabels(self.labels, [("le", _formatValue(float(bound)))]), cumulative))
+        result.append((name+"_bucket", _formatLabels(self.labels, [("le", "+Inf")]), count))
+        result.append((name+"_sum", _formatLabels(self.labels), total))
+        result.append((name+"_count", _formatLabels(self.labels), count))
+        return result
+
+
+class _Timing(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.time()
+
+    def __exit__(self, *excInfo):
+        self._histogram.observe(time.time() - self._start)
+
+
+class MetricsRegistry(object):
+    """\
+    Collection of metrics that can be exposed as text in the format scraped
+    by Prometheus (see :func:`expose`).
+
+    Metrics are identified by their name and labels. Asking for a metric that
+    already exists returns the existing one, so each session of the proxy can
+    ask for the same metrics and they will be shared. For example:
+
+    .. code-block:: python
+
+        sent = REGISTRY.counter("dvbcss_proxy_messages_sent_total", "Messages sent.", endpoint="ts")
+        sent.inc()
+    """
+
+    def __init__(self):
+        super(MetricsRegistry,self).__init__()
+        self._families = {}     # maps name to (help, type, dict mapping label tuple to metric)
+        self._order = []
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, *args):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            if name not in self._families:
+                self._families[name] = (help, cls.type, {})
+                self._order.append(name)
+            _, metricType, metrics = self._families[name]
+            if metricType != cls.type:
+                raise ValueError("Metric "+name+" already exists as a "+metricType)
+            if key not in metrics:
+                metrics[key] = cls(labels, *args)
+            return metrics[key]
+
+    def counter(self, name, help, function=None, **labels):
+        """\
+        :param name: Name of the metric. By convention, ends with "_total".
+        :param help: Description of the metric.
+        :param function: Optional function called to obtain the value when the metrics are exposed, instead of it being incremented.
+        :param labels: Label names and values that distinguish this metric from others with the same name.
+        :returns: :class:`Counter`
+        """
+        return self._get(Counter, name, help, labels, function)
+
+    def gauge(self, name, help, function=None, **labels):
+        """\
+        As for :func:`counter` but for a value that can go down as well as up.
+
+        :returns: :class:`Gauge`
+        """
+        return self._get(Gauge, name, help, labels, function)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS, **labels):
+        """\
+        :param name: Name of the metric, which should include its unit, e.g. "_seconds".
+        :param help: Description of the metric.
+        :param buckets: Upper bounds of the buckets.
+        :param labels: Label names and values that distinguish this metric from others with the same name.
+        :returns: :class:`Histogram`
+        """
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def expose(self):
+        """\
+        :returns: :class:`str` containing all the metrics in the Prometheus text exposition format.
+        """
+        with self._lock:
+            families = [ (name, self._families[name]) for name in self._order ]
+            families = [ (name, (help, metricType, sorted(metrics.items()))) for name, (help, metricType, metrics) in families ]
+        lines = []
+        for name, (help, metricType, metrics) in families:
+            lines.append("# HELP %s %s" % (name, help.replace("\\","\\\\").replace("\n","\\n")))
+            lines.append("# TYPE %s %s" % (name, metricType))
+            for _, metric in metrics:
+                for sampleName, labels, value in metric.samples(name):
+                    lines.append("%s%s %s" % (sampleName, labels, _formatValue(value)))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+"""\
+The registry for the metrics of the whole proxy.
+"""
+
+
+def browserMessagesReceived():
+    """\
+    :returns: :class:`Counter` of messages received from browsers on the server/proxy interface.
+    """
+    return REGISTRY.counter("dvbcss_proxy_browser_messages_received_total", "Messages received from browsers via the server/proxy interface.")
+
+def messagesSent(endpoint):
+    """\
+    :param endpoint: "cii", "ts", "server" or "wcws"
+    :returns: :class:`Counter` of messages sent to clients of the endpoint.
+    """
+    return REGISTRY.counter("dvbcss_proxy_messages_sent_total", "Messages sent to clients, by endpoint.", endpoint=endpoint)
+
+def bytesSent(endpoint):
+    """\
+    :param endpoint: "cii", "ts", "server" or "wcws"
+    :returns: :class:`Counter` of the bytes of message payloads sent to clients of the endpoint.
+    """
+    return REGISTRY.counter("dvbcss_proxy_bytes_sent_total", "Bytes of message payloads sent to clients, by endpoint.", endpoint=endpoint)
+
+def sendQueueReplaced(endpoint):
+    """\
+    :param endpoint: "cii" or "ts"
+    :returns: :class:`Counter` of messages waiting to be sent that were replaced by a newer message before they could be sent (see :class:`ProxySendQueues`).
+    """
+    return REGISTRY.counter("dvbcss_proxy_send_queue_replaced_total", "Messages waiting to be sent to clients that were replaced by a newer message, by endpoint.", endpoint=endpoint)
+
+def sendQueueEvictions(endpoint):
+    """\
+    :param endpoint: "cii" or "ts"
+    :returns: :class:`Counter` of clients disconnected because they fell too far behind in receiving messages (see :class:`ProxySendQueues`).
+    """
+    return REGISTRY.counter("dvbcss_proxy_send_queue_evictions_total", "Clients disconnected for falling too far behind in receiving messages, by endpoint.", endpoint=endpoint)
+
+def wallClockResponses(transport):
+    """\
+    :param transport: "udp" or "websocket"
+    :returns: :class:`Counter` of wall clock responses sent.
+    """
+    return REGISTRY.counter("dvbcss_proxy_wallclock_responses_total", "Wall clock responses sent, by transport.", transport=transport)
+
+def updateSeconds():
+    """\
+    :returns: :class:`Histogram` of the time taken to apply an update from a browser and send the resulting CII messages and Control Timestamps to clients.
+    """
+    return REGISTRY.histogram("dvbcss_proxy_update_seconds", "Time taken to apply an update from a browser, including sending it on to CII and TS clients.")
+
+def wallClockTurnaroundSeconds(transport):
+    """\
+    :param transport: "udp" or "websocket"
+    :returns: :class:`Histogram` of the time between the receive and transmit times of wall clock responses.
+    """
+    return REGISTRY.histogram("dvbcss_proxy_wallclock_turnaround_seconds", "Time between receiving a wall clock request and sending the response, by transport.", (0.00001, 0.000025, 0.00005)+DEFAULT_BUCKETS, transport=transport)
+
+
+def countingHandlerClass(handler_cls, endpoint):
+    """\
+    :param handler_cls: handler class of a pydvbcss :class:`~dvbcss.protocol.server.WSServerBase`
+    :param endpoint: Name of the endpoint the messages are counted against, e.g. "cii"
+    :returns: subclass of the handler class that counts the messages, and bytes, it sends in the
+      :func:`messagesSent` and :func:`bytesSent` metrics for the endpoint.
+    """
+    sent = messagesSent(endpoint)
+    sentBytes = bytesSent(endpoint)
+
+    class CountingHandler(handler_cls):
+        def send(self, payload, binary=False):
+            sent.inc()
+            sentBytes.inc(len(payload))
+            return super(CountingHandler,self).send(payload, binary)
+
+    return CountingHandler
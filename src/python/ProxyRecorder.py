@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import sys
+import json
+import time as _time
+import base64
+import threading
+import Queue
+
+try:
+    from dvbcss import monotonic_time
+except ImportError:
+    sys.stderr.write("""
+    Could not import pydvbcss library. Suggest installing using pip, e.g. on Linux/Mac:
+
+    $ sudo pip install pydvbcss
+    """)
+    sys.exit(1)
+
+
+RECEIVED = "in"
+SENT = "out"
+CONNECTED = "connect"
+DISCONNECTED = "disconnect"
+
+
+class Entry(object):
+    """\
+    One event recorded on the server/proxy interface of a session.
+    """
+
+    def __init__(self, when, sessionId, kind, payload=None, binary=False):
+        super(Entry,self).__init__()
+        self.when = when            #: Time (in seconds) since recording began
+        self.sessionId = sessionId  #: Session ID, or the empty string for the default session
+        self.kind = kind            #: :data:`RECEIVED`, :data:`SENT`, :data:`CONNECTED` or :data:`DISCONNECTED`
+        self.payload = payload      #: For messages, the payload as :class:`str`. Otherwise None.
+        self.binary = binary        #: True if the message was sent in a binary frame
+
+    def __repr__(self):
+        return "Entry(%r, %r, %r, %r, %r)" % (self.when, self.sessionId, self.kind, self.payload, self.binary)
+
+
+class ProxyRecorder(object):
+    """\
+    Records the messages passing over the server/proxy interface (between the
+    TV in a browser and the proxy) to a file, so that they can later be
+    replayed (see :class:`ProxyReplayer`).
+
+    Each event is appended to the file as a line containing a JSON array:
+
+    .. code-block:: json
+
+        [ 12.345678, "lounge-tv", "in", "{\\"cii\\":{...}}" ]
+
+    The elements are: the time (in seconds, from a monotonic clock) since the
+    recording began; the session ID; the kind of event ("in" for a message
+    received from the browser, "out" for a message sent to it, "connect" or
+    "disconnect"); and, for messages, the payload. Payloads of binary frames
+    are base64 encoded, and a fifth element, 1, is added.
+
+    Pass the recorder for a particular session (see :func:`session`) to the
+    :class:`CssProxy_ServerEndpoint` of that session.
+
+    Events are written to the file by a background thread, so that recording
+    does not hold up the handling of messages. If they cannot be written fast
+    enough and the queue of events waiting fills up, further events are
+    discarded (and counted in :data:`dropped`) until there is room again.
+    The file is flushed whenever there are no more events waiting, so that
+    the recording is complete even if the process is killed without the
+    recorder being closed.
+    """
+
+    def __init__(self, file, capacity=10000):
+        """\
+        :param file: A file object opened for writing (or appending).
+        :param capacity: The number of events that can be waiting to be written.
+        """
+        super(ProxyRecorder,self).__init__()
+        self._file = file
+        self._start = monotonic_time.time()
+        self.dropped = 0
+        self._queue = Queue.Queue(capacity)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def session(self, sessionId):
+        """\
+        :param sessionId: The session ID, or the empty string for the default session.
+        :returns: :class:`SessionRecorder` that records events against that session.
+        """
+        return SessionRecorder(self, sessionId)
+
+    def record(self, sessionId, kind, payload=None, binary=False):
+        """\
+        Append an event to the recording.
+
+        :param sessionId: The session ID, or the empty string for the default session.
+        :param kind: :data:`RECEIVED`, :data:`SENT`, :data:`CONNECTED` or :data:`DISCONNECTED`
+        :param payload: The payload of the message, if the event is a message.
+        :param binary: True if the message is sent in a binary frame.
+        """
+        when = monotonic_time.time() - self._start
+        try:
+            self._queue.put_nowait((when, sessionId, kind, payload, binary))
+        except Queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            try:
+                if event is None:
+                    return
+                when, sessionId, kind, payload, binary = event
+                entry = [ round(when, 6), sessionId, kind ]
+                if payload is not None:
+                    if binary:
+                        entry.extend([ base64.b64encode(payload), 1 ])
+                    else:
+                        entry.append(payload)
+                self._file.write(json.dumps(entry, separators=(",",":")) + "\n")
+                if self._queue.empty():
+                    self._file.flush()
+            except Exception:
+                sys.stderr.write("Could not write event to recording\n")
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """\
+        Wait until all events recorded so far have been written, then flush the file.
+        """
+        self._queue.join()
+        self._file.flush()
+
+    def close(self):
+        """\
+        Write any events still waiting, then stop the background thread and close the file.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._file.close()
+
+
+class SessionRecorder(object):
+    """\
+    Records events for one session, through a :class:`ProxyRecorder`.
+    """
+
+    def __init__(self, recorder, sessionId):
+        super(SessionRecorder,self).__init__()
+        self._recorder = recorder
+        self.sessionId = sessionId
+
+    def received(self, payload, binary=False):
+        """Record a message received from the browser."""
+        self._recorder.record(self.sessionId, RECEIVED, payload, binary)
+
+    def sent(self, payload, binary=False):
+        """Record a message sent to the browser."""
+        self._recorder.record(self.sessionId, SENT, payload, binary)
+
+    def connected(self):
+        """Record the browser connecting."""
+        self._recorder.record(self.sessionId, CONNECTED)
+
+    def disconnected(self):
+        """Record the browser disconnecting."""
+        self._recorder.record(self.sessionId, DISCONNECTED)
+
+
+def readRecording(file, sessionId=None):
+    """\
+    Read a recording made by :class:`ProxyRecorder`.
+
+    :param file: A file object opened for reading.
+    :param sessionId: If not None, only return the events for this session.
+    :returns: :class:`list` of :class:`Entry` objects, in the order they were recorded.
+    :throws ValueError: if the recording is not valid.
+    """
+    entries = []
+    for line in file:
+        line = line.strip()
+        if not line:
+            continue
+        fields = json.loads(line)
+        if not isinstance(fields, list) or len(fields) < 3:
+            raise ValueError("Not a valid recorded event: "+line)
+        when, session, kind = fields[:3]
+        if sessionId is not None and session != sessionId:
+            continue
+        payload = None
+        binary = False
+        if len(fields) > 3:
+            payload = fields[3]
+            binary = len(fields) > 4 and bool(fields[4])
+            if binary:
+                payload = base64.b64decode(payload)
+            else:
+                payload = payload.encode("utf-8")
+        entries.append(Entry(when, session, kind, payload, binary))
+    return entries
+
+
+class _ReplayWebSock(object):
+    """\
+    Stands in for the browser's WebSocket connection during a replay. Messages
+    sent to it are counted and then discarded.
+    """
+
+    def __init__(self):
+        super(_ReplayWebSock,self).__init__()
+        self.sent = 0
+
+    def id(self):
+        return "replay"
+
+    def send(self, payload, binary=False):
+        self.sent += 1
+
+    def close(self, code=1000, reason=''):
+        pass
+
+    def terminate(self):
+        pass
+
+
+class ProxyReplayer(object):
+    """\
+    Feeds a recorded session (see :class:`ProxyRecorder`) into a
+    :class:`CssProxyEngine`, as if the browser were connected to it and sending
+    those messages.
+
+    Messages from the browser can be replayed at the speed at which they were
+    recorded, at a multiple of it, or as fast as possible. Messages that the
+    proxy sent to the browser in the recording are not replayed; those the
+    engine sends during the replay are counted and discarded.
+
+    .. code-block:: python
+
+        with open("session.rec") as f:
+            entries = readRecording(f, sessionId="")
+        replayer = ProxyReplayer(engine, entries, speed=10)
+        replayer.run()
+    """
+
+    time = staticmethod(monotonic_time.time)
+    sleep = staticmethod(_time.sleep)
+
+    def __init__(self, engine, entries, speed=1.0):
+        """\
+        :param engine: The :class:`CssProxyEngine` to feed.
+        :param entries: List of :class:`Entry` objects, as returned by :func:`readRecording`, for a single session.
+        :param speed: Multiple of the recorded speed to replay at, e.g. 2 for twice as fast. Zero or None means as fast as possible.
+        """
+        super(ProxyReplayer,self).__init__()
+        self._endpoint = engine.serverEndpoint
+        self._entries = entries
+        self._speed = speed
+        self.messagesReplayed = 0   #: Number of messages from the browser replayed by :func:`run`
+        self.messagesSent = 0       #: Number of messages the engine sent to the browser during :func:`run`
+        self.duration = 0.0         #: Time (in seconds) that :func:`run` took
+
+    def run(self):
+        """\
+        Replay the whole recording, returning once it is finished. If the
+        recording does not begin with the browser connecting, it is treated as
+        connected from the start. If it does not end with the browser
+        disconnecting, it is left connected.
+        """
+        webSock = _ReplayWebSock()
+        connected = False
+        if not self._entries or self._entries[0].kind != CONNECTED:
+            self._endpoint._onClientConnect(webSock)
+            connected = True
+
+        start = self.time()
+        firstWhen = self._entries[0].when if self._entries else 0.0
+        for entry in self._entries:
+            if self._speed:
+                delay = (entry.when - firstWhen) / self._speed - (self.time() - start)
+                if delay > 0:
+                    self.sleep(delay)
+
+            if entry.kind == CONNECTED and not connected:
+                self._endpoint._onClientConnect(webSock)
+                connected = True
+            elif entry.kind == DISCONNECTED and connected:
+                self._endpoint._onClientDisconnect(webSock, None)
+                connected = False
+            elif entry.kind == RECEIVED and connected:
+                if entry.binary:
+                    self._endpoint._onClientMessage(webSock, bytearray(entry.payload))
+                else:
+                    self._endpoint._onClientMessage(webSock, entry.payload)
+                self.messagesReplayed += 1
+
+        self.duration = self.time() - start
+        self.messagesSent = webSock.sent
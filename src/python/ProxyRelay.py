@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import sys
+import re
+import logging
+import threading
+
+try:
+    from dvbcss.protocol.client import ConnectionError
+    from dvbcss.protocol.client.cii import CIIClientConnection
+    from dvbcss.protocol.client.ts import TSClientConnection
+    from dvbcss.protocol.client.wc import WallClockClient
+    from dvbcss.protocol.client.wc.algorithm import LowestDispersionCandidate
+except ImportError:
+    sys.stderr.write("""
+    Could not import pydvbcss library. Suggest installing using pip, e.g. on Linux/Mac:
+
+    $ sudo pip install pydvbcss
+    """)
+    sys.exit(1)
+
+from dvbcss.protocol.cii import CII
+from dvbcss.protocol import OMIT
+
+
+_log = logging.getLogger("ProxyRelay")
+
+_UDP_URL = re.compile(r"^udp://([^:/]+):([0-9]+)/?$")
+
+
+class UpstreamFeed(object):
+    """\
+    Source of updates for a :class:`CssProxyEngine` that takes the place of
+    the :class:`CssProxy_ServerEndpoint` (and the TV in a browser connected to
+    it). Instead, CII and Control Timestamps are obtained from an upstream
+    proxy (or any other DVB CSS TV Device) by connecting to it as a companion
+    would, using the CSS-CII and CSS-TS protocols.
+
+    This allows proxies to be arranged in a tree, each relaying to its own
+    companions what it receives from the proxy above it, so that the work of
+    serving companions can be spread across processes and machines.
+
+    +-----------+              +-------+              +----------------+
+    | Companion | --CSS-*--->  | Relay | --CSS-CII--> | Upstream proxy |
+    +-----------+              +-------+ --CSS-TS---> |                |
+                                         --CSS-WC---> |                |
+                                                      +----------------+
+
+    Every CII message received from upstream is passed to the engine as an
+    update. A CSS-TS connection to the upstream proxy is opened for each
+    timeline requested by the engine's clients, and closed when it is no
+    longer requested. Each Control Timestamp received on it is passed to the
+    engine as an update for that timeline.
+
+    Control Timestamps are relative to the upstream proxy's wall clock, so
+    the relay's own wall clock must follow it (see :class:`UpstreamWallClock`).
+    The URL of the upstream wall clock server is reported by calling
+    :func:`onWallClockUrlChanged`.
+
+    The feed appears connected (and so the engine enables its CII and TS
+    servers) while the CSS-CII connection to the upstream proxy is open. If it
+    cannot be opened, or is closed, it is retried periodically until the feed
+    is disabled.
+
+    Connections are opened and closed on a separate thread, so that the
+    thread handling a client that requests a timeline is not held up.
+    """
+    CIIConnection = CIIClientConnection
+    TSConnection = TSClientConnection
+    Timer = staticmethod(threading.Timer)
+
+    def __init__(self, ciiUrl, retryInterval=5.0):
+        """\
+        :param ciiUrl: The URL of the CSS-CII server of the upstream proxy, e.g. "ws://192.168.1.5:7681/cii/lounge-tv"
+        :param retryInterval: Time (in seconds) to wait before retrying a connection to the upstream proxy that could not be opened or was closed.
+        """
+        super(UpstreamFeed,self).__init__()
+        self.selectors = []
+        self._ciiUrl = ciiUrl
+        self._retryInterval = retryInterval
+        self._lock = threading.RLock()
+        self._enabled = False
+        self._serverConnected = False
+        self._ciiConn = None
+        self._tsUrl = None
+        self._wcUrl = None
+        self._tsConns = {}      # maps timeline selectors to TS connections open (or being opened) to the upstream proxy
+        self._timer = None
+        self._timerIsRetry = False
+
+    @property
+    def enabled(self):
+        """\
+        (read/write :class:`bool`) Whether the feed is connected (or trying to connect) to the upstream proxy.
+        """
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value):
+        with self._lock:
+            self._enabled = value
+        if value:
+            self._schedule(0)
+        else:
+            self._disconnect()
+
+    @property
+    def serverConnected(self):
+        """True if the CSS-CII connection to the upstream proxy is open."""
+        return self._serverConnected
+
+    def sendTimelinesRequest(self, allSelectors, added, removed):
+        """\
+        Open or close CSS-TS connections to the upstream proxy, to match the timelines now required.
+
+        :param allSelectors: array of all timeline selector strings now required.
+        :param added: array of newly required timeline selector strings.
+        :param removed: array of all no-longer required timeline selector strings.
+        """
+        with self._lock:
+            self.selectors = allSelectors[:]
+        self._schedule(0)
+
+    def updateNumberOfSlaves(self, nrOfSlaves):
+        """\
+        Does nothing. The upstream proxy counts this relay as a single client.
+        """
+        pass
+
+    def _schedule(self, delay):
+        with self._lock:
+            if not self._enabled:
+                return
+            if self._timer is not None:
+                # a retry waits; anything else already pending will do the work
+                if not self._timerIsRetry or delay > 0:
+                    return
+                self._timer.cancel()
+            self._timer = self.Timer(delay, self._sync)
+            self._timer.daemon = True
+            self._timerIsRetry = delay > 0
+            self._timer.start()
+
+    def _sync(self):
+        """\
+        Open and close connections to the upstream proxy to match what is required.
+        """
+        with self._lock:
+            self._timer = None
+            if not self._enabled:
+                return
+            if self._ciiConn is None:
+                self._ciiConn = self._makeCiiConnection()
+                ciiConn = self._ciiConn
+            else:
+                ciiConn = None
+            if self._serverConnected and self._tsUrl is not None:
+                wanted = self.selectors
+            else:
+                wanted = []
+            closing = [ self._tsConns.pop(selector) for selector in self._tsConns.keys() if selector not in wanted ]
+            opening = []
+            for selector in wanted:
+                if selector not in self._tsConns:
+                    self._tsConns[selector] = self._makeTsConnection(self._tsUrl, selector)
+                    opening.append(self._tsConns[selector])
+
+        retry = False
+        for conn in closing:
+            self._close(conn)
+        if ciiConn is not None:
+            try:
+                ciiConn.connect()
+            except ConnectionError:
+                _log.warning("Could not connect to upstream CII server at %s", self._ciiUrl)
+                with self._lock:
+                    if self._ciiConn is ciiConn:
+                        self._ciiConn = None
+                retry = True
+        for conn in opening:
+            try:
+                conn.connect()
+            except ConnectionError:
+                _log.warning("Could not connect to upstream TS server at %s", self._tsUrl)
+                with self._lock:
+                    for selector, c in self._tsConns.items():
+                        if c is conn:
+                            del self._tsConns[selector]
+                retry = True
+        if retry:
+            self._schedule(self._retryInterval)
+
+    def _makeCiiConnection(self):
+        conn = self.CIIConnection(self._ciiUrl)
+        conn.onConnected = lambda : self._onCiiConnected(conn)
+        conn.onDisconnected = lambda code, reason=None : self._onCiiDisconnected(conn)
+        conn.onCII = lambda cii : self._onCii(conn, cii)
+        return conn
+
+    def _makeTsConnection(self, tsUrl, timelineSelector):
+        conn = self.TSConnection(tsUrl, "", timelineSelector)
+        # pydvbcss passes the closure code and reason, even though its stub takes none
+        conn.onDisconnected = lambda *args : self._onTsDisconnected(conn, timelineSelector)
+        conn.onControlTimestamp = lambda ct : self._onControlTimestamp(conn, timelineSelector, ct)
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.disconnect()
+        except Exception:
+            pass
+
+    def _disconnect(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            ciiConn = self._ciiConn
+            self._ciiConn = None
+            tsConns = self._tsConns.values()
+            self._tsConns = {}
+            wasConnected = self._serverConnected
+            self._serverConnected = False
+            self._tsUrl = None
+        for conn in tsConns:
+            self._close(conn)
+        if ciiConn is not None:
+            self._close(ciiConn)
+        if wasConnected:
+            self.onServerDisconnected()
+
+    def _onCiiConnected(self, conn):
+        with self._lock:
+            if conn is not self._ciiConn:
+                return
+            self._serverConnected = True
+        _log.info("Connected to upstream CII server at %s", self._ciiUrl)
+        self.onServerConnected()
+
+    def _onCiiDisconnected(self, conn):
+        with self._lock:
+            if conn is not self._ciiConn:
+                return
+            self._ciiConn = None
+            wasConnected = self._serverConnected
+            self._serverConnected = False
+            self._tsUrl = None
+        _log.info("Disconnected from upstream CII server at %s", self._ciiUrl)
+        self._schedule(self._retryInterval)
+        if wasConnected:
+            self.onServerDisconnected()
+
+    def _onCii(self, conn, cii):
+        with self._lock:
+            if conn is not self._ciiConn:
+                return
+            tsUrlChanged = cii.tsUrl not in (OMIT, None) and cii.tsUrl != self._tsUrl
+            if tsUrlChanged:
+                # existing TS connections are to the old TS server
+                stale = self._tsConns.values()
+                self._tsConns = {}
+                self._tsUrl = cii.tsUrl
+            wcUrl = cii.wcUrl
+            wcUrlChanged = wcUrl not in (OMIT, None) and wcUrl != self._wcUrl
+            if wcUrlChanged:
+                self._wcUrl = wcUrl
+        if tsUrlChanged:
+            for tsConn in stale:
+                self._close(tsConn)
+            self._schedule(0)
+        if wcUrlChanged:
+            self.onWallClockUrlChanged(wcUrl)
+        self.onUpdate(cii, {}, {})
+
+    def _onTsDisconnected(self, conn, timelineSelector):
+        with self._lock:
+            if self._tsConns.get(timelineSelector, None) is not conn:
+                return
+            del self._tsConns[timelineSelector]
+        self._schedule(self._retryInterval)
+
+    def _onControlTimestamp(self, conn, timelineSelector, ct):
+        with self._lock:
+            if self._tsConns.get(timelineSelector, None) is not conn:
+                return
+        self.onUpdate(CII(), { timelineSelector : ct }, {})
+
+    def onUpdate(self, cii, controlTimestamps, options):
+        """\
+        Called when an update is received from the upstream proxy.
+
+        :param cii: A CII object containing the CII properties that have changed.
+        :param controlTimestamps: A dict mapping timeline selectors to ControlTimestamp objects.
+        :param options: Always an empty dict.
+
+        Override or replace with your own handler.
+        """
+        pass
+
+    def onServerConnected(self):
+        """\
+        Called when the connection to the upstream proxy is opened.
+
+        Override or replace with your own handler.
+        """
+        pass
+
+    def onServerDisconnected(self):
+        """\
+        Called when the connection to the upstream proxy is closed.
+
+        Override or replace with your own handler.
+        """
+        pass
+
+    def onWallClockUrlChanged(self, wcUrl):
+        """\
+        Called when the upstream proxy advertises the URL of its wall clock server.
+
+        :param wcUrl: The URL, e.g. "udp://192.168.1.5:6677"
+
+        Override or replace with your own handler.
+        """
+        pass
+
+
+class UpstreamWallClock(object):
+    """\
+    Keeps a wall clock in step with the wall clock of an upstream proxy, using
+    the CSS-WC protocol. Use it for the wall clock of a relay (see
+    :class:`UpstreamFeed`), so that the Control Timestamps relayed to its
+    companions are correct for the wall clock it serves them.
+
+    The wall clock must be a :class:`~dvbcss.clock.CorrelatedClock` (such as a
+    :class:`~dvbcss.clock.TunableClock`) whose parent is the system clock.
+
+    Wall clock servers for the wall clock must report a precision that
+    includes how far it might be from the upstream wall clock. This is given
+    by :data:`precision`, and passed to :func:`onPrecisionChanged` whenever
+    the clock is adjusted and periodically (as the error grows) while
+    following an upstream wall clock.
+
+    .. code-block:: python
+
+        wallClock = TunableClock(SysClock(tickRate=1000000000), tickRate=1000000000)
+        upstreamClock = UpstreamWallClock(wallClock)
+        wcServer = BatchedWallClockServer(wallClock, upstreamClock.precision)
+        upstreamClock.onPrecisionChanged = lambda precision : setattr(wcServer, "precision", precision)
+        feed.onWallClockUrlChanged = upstreamClock.follow
+    """
+    Client = WallClockClient
+    Timer = staticmethod(threading.Timer)
+
+    MAX_PRECISION = 2.0**126
+    """Precision (in seconds) reported when the wall clock is not in step with any upstream wall clock. The largest that CSS-WC messages can carry."""
+
+    def __init__(self, wallClock, bindaddr="0.0.0.0", bindport=0, refreshInterval=1.0):
+        """\
+        :param wallClock: The wall clock to keep in step.
+        :param bindaddr: Address to bind to, to send requests to the upstream wall clock server.
+        :param bindport: Port to bind to, to send requests to the upstream wall clock server. Zero means any free port.
+        :param refreshInterval: Time (in seconds) between calls to :func:`onPrecisionChanged` while following an upstream wall clock.
+        """
+        super(UpstreamWallClock,self).__init__()
+        self.wallClock = wallClock
+        self._bind = (bindaddr, bindport)
+        self._refreshInterval = refreshInterval
+        self._lock = threading.Lock()
+        self._client = None
+        self._dest = None
+        self._timer = None
+        # not in step with anything until an upstream wall clock is followed
+        wallClock.correlation = wallClock.correlation.butWith(initialError=float("+inf"))
+
+    @property
+    def precision(self):
+        """\
+        (read only :class:`float`) The precision (in seconds) to report for the wall clock: the dispersion it will
+        have reached by the next refresh, which includes the precision of the system clock.
+        :data:`MAX_PRECISION` if the wall clock is not yet in step with an upstream wall clock.
+        """
+        ticks = self.wallClock.ticks + self._refreshInterval * self.wallClock.tickRate
+        return min(self.wallClock.dispersionAtTime(ticks), self.MAX_PRECISION)
+
+    def follow(self, wcUrl):
+        """\
+        Start following the wall clock server at the URL, instead of any that was followed before.
+
+        :param wcUrl: The URL of the wall clock server, e.g. "udp://192.168.1.5:6677"
+        :throws ValueError: if the URL is not that of a UDP wall clock server.
+        """
+        match = _UDP_URL.match(wcUrl)
+        if not match:
+            raise ValueError("Can only follow a UDP wall clock server, not: "+wcUrl)
+        dest = (match.group(1), int(match.group(2)))
+        with self._lock:
+            if dest == self._dest:
+                return
+            if self._client is not None:
+                self._client.stop()
+            algorithm = LowestDispersionCandidate(self.wallClock, repeatSecs=1.0, timeoutSecs=0.5)
+            algorithm.onClockAdjusted = lambda *args : self.onPrecisionChanged(self.precision)
+            self._client = self.Client(self._bind, dest, self.wallClock, algorithm)
+            self._dest = dest
+            self._client.start()
+            if self._timer is not None:
+                self._timer.cancel()
+            self._startTimer()
+        _log.info("Following upstream wall clock at %s", wcUrl)
+        # a new algorithm starts out not in step with the wall clock
+        self.onPrecisionChanged(self.precision)
+
+    def stop(self):
+        """\
+        Stop following the upstream wall clock.
+        """
+        with self._lock:
+            if self._client is not None:
+                self._client.stop()
+            if self._timer is not None:
+                self._timer.cancel()
+            self._client = None
+            self._dest = None
+            self._timer = None
+
+    def _startTimer(self):
+        self._timer = self.Timer(self._refreshInterval, self._refresh, [self._client])
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh(self, client):
+        with self._lock:
+            if client is not self._client:
+                return      # stopped, or now following a different server
+            self._startTimer()
+        self.onPrecisionChanged(self.precision)
+
+    def onPrecisionChanged(self, precision):
+        """\
+        Called when the precision to report for the wall clock changes (see :data:`precision`).
+
+        :param precision: The precision (in seconds).
+
+        Override or replace with your own handler.
+        """
+        pass
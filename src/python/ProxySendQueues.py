@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import time
+import threading
+import Queue
+from collections import deque
+
+import ProxyMetrics
+
+
+class ProxySendQueues(object):
+    """\
+    Gives each connection to a server endpoint its own queue of messages
+    waiting to be sent, so that a client that is slow to receive them does
+    not hold up the sending of messages to other clients.
+
+    Messages are taken from the queues and sent by a fixed number of writer
+    threads shared by all connections. A slow client therefore only occupies
+    one writer at a time.
+
+    Each queue is bounded. A client is disconnected (evicted) if its queue is
+    full, if sending to it fails, or if the oldest message waiting to be sent
+    to it (or being sent to it) has been waiting for longer than the maximum
+    lag. The lag is checked when a message is queued for the client and when
+    a writer takes a message from its queue. A client stuck in a send that
+    blocks, with nothing further queued for it, is therefore only evicted once
+    another message is queued for it.
+
+    For endpoints where only the latest message matters (such as CSS-TS,
+    where each connection is for a single timeline, and so a newer Control
+    Timestamp supersedes an older one) a new message replaces any message
+    still waiting, instead of being added to the queue.
+
+    Apply to the `handler` class of a pydvbcss server with :func:`handlerClass`.
+    Messages replaced or discarded, and clients evicted, are counted in the
+    metrics (see :mod:`ProxyMetrics`).
+    """
+
+    def __init__(self, numWriters=4, capacity=100, maxLag=2.0):
+        """\
+        :param numWriters: The number of writer threads.
+        :param capacity: The number of messages that can be waiting to be sent on a connection.
+        :param maxLag: Time (in seconds) that a message can wait to be sent before the client is evicted.
+        """
+        super(ProxySendQueues,self).__init__()
+        self.capacity = capacity
+        self.maxLag = maxLag
+        self._ready = Queue.Queue()     # connections that have messages waiting and are not already being drained
+        self._writers = []
+        for i in range(0, numWriters):
+            writer = threading.Thread(target=self._runWriter)
+            writer.daemon = True
+            writer.start()
+            self._writers.append(writer)
+
+    def stop(self):
+        """\
+        Stop the writer threads. Messages still waiting are not sent.
+        """
+        for writer in self._writers:
+            self._ready.put(None)
+        for writer in self._writers:
+            writer.join()
+        self._writers = []
+
+    def _schedule(self, handler):
+        self._ready.put(handler)
+
+    def _runWriter(self):
+        while True:
+            handler = self._ready.get()
+            if handler is None:
+                return
+            handler._drainSendQueue()
+
+    def handlerClass(self, handler_cls, endpoint, latestWins=False):
+        """\
+        :param handler_cls: handler class of a pydvbcss :class:`~dvbcss.protocol.server.WSServerBase`
+        :param endpoint: Name of the endpoint, e.g. "ts", used for the metrics.
+        :param latestWins: If True, a new message replaces any message still waiting to be sent, instead of being queued after it.
+        :returns: subclass of the handler class whose `send` method queues the message to be sent by a writer thread.
+        """
+        queues = self
+        replaced = ProxyMetrics.sendQueueReplaced(endpoint)
+        evictions = ProxyMetrics.sendQueueEvictions(endpoint)
+
+        class QueuedHandler(handler_cls):
+            def __init__(self, *args, **kwargs):
+                super(QueuedHandler,self).__init__(*args, **kwargs)
+                self._sendQueue = deque()       # of tuples (time queued, payload, binary)
+                self._sendQueueLock = threading.Lock()
+                self._sendScheduled = False
+                self._sendingSince = None       # time queued of the message being sent, or None
+                self._evicted = False
+
+            def _evict(self):
+                evictions.inc()
+                try:
+                    self.terminate()
+                except Exception:
+                    pass
+
+            def send(self, payload, binary=False):
+                now = time.time()
+                with self._sendQueueLock:
+                    if self._evicted:
+                        return
+                    oldest = self._sendingSince
+                    if self._sendQueue and (oldest is None or self._sendQueue[0][0] < oldest):
+                        oldest = self._sendQueue[0][0]
+                    evict = oldest is not None and now - oldest > queues.maxLag
+                    if latestWins and self._sendQueue and not evict:
+                        replaced.inc(len(self._sendQueue))
+                        self._sendQueue.clear()
+                    elif len(self._sendQueue) >= queues.capacity:
+                        evict = True
+                    if evict:
+                        self._evicted = True
+                        self._sendQueue.clear()
+                    else:
+                        self._sendQueue.append((now, payload, binary))
+                        schedule = not self._sendScheduled
+                        self._sendScheduled = True
+                if evict:
+                    self._evict()
+                elif schedule:
+                    queues._schedule(self)
+
+            def _drainSendQueue(self):
+                while True:
+                    with self._sendQueueLock:
+                        if self._evicted or not self._sendQueue:
+                            self._sendScheduled = False
+                            self._sendingSince = None
+                            return
+                        queued, payload, binary = self._sendQueue.popleft()
+                        lagging = time.time() - queued > queues.maxLag
+                        if lagging:
+                            self._evicted = True
+                            self._sendQueue.clear()
+                            self._sendScheduled = False
+                            self._sendingSince = None
+                        else:
+                            self._sendingSince = queued
+                    if lagging:
+                        self._evict()
+                        return
+                    try:
+                        super(QueuedHandler,self).send(payload, binary)
+                    except Exception:
+                        with self._sendQueueLock:
+                            self._evicted = True
+                            self._sendQueue.clear()
+                        self._evict()
+
+        return QueuedHandler
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import sys
+import re
+import threading
+
+try:
+    from dvbcss.protocol.server import WSServerTool
+except ImportError:
+    sys.stderr.write("""
+    Could not import pydvbcss library. Suggest installing using pip, e.g. on Linux/Mac:
+
+    $ sudo pip install pydvbcss
+    """)
+    sys.exit(1)
+
+import cherrypy
+
+from CssProxyEngine import CssProxyEngine, BlockableCIIServer, ProxyTSServer
+
+
+_SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_.~-]{0,64}$")
+
+
+def splitSessionPath(path):
+    """\
+    Split a request path into the endpoint name and session ID.
+
+    :param path: request path, e.g. "/cii/lounge-tv" or "/cii"
+    :returns: tuple (endpoint name, session id). The session id is the empty string for the default session.
+    """
+    parts = path.strip("/").split("/", 1)
+    if len(parts) == 1:
+        return parts[0], ""
+    else:
+        return parts[0], parts[1]
+
+
+class ProxySessionRegistry(object):
+    """\
+    Registry of proxy sessions sharing a single process.
+
+    Each session corresponds to one TV in a browser. When a browser connects to
+    the server/proxy interface at `/server/<session>` a new session is created
+    (once the browser's connection has opened) with its own :class:`CssProxyEngine`, and hence its own CII state, CII server,
+    TS server and :class:`ProxyTimelineSource`. Companions connect to
+    `/cii/<session>` and `/ts/<session>`. The wall clock, and the connection
+    handling (cherrypy or event loop), are shared by all sessions.
+
+    Connecting without a session ID (i.e. to `/server`, `/cii` and `/ts`) uses
+    the default session, whose ID is the empty string.
+
+    A session is discarded when its browser disconnects. The CII and TS servers
+    of a session are disabled while no browser is connected anyway, so no
+    companion can be connected to it at that time.
+    """
+    Engine = CssProxyEngine
+
+    def __init__(self, wallClock, baseUrl, wcUrl, rewriteHostPort=[], recorder=None, sendQueues=None, **engineOptions):
+        """\
+        :param wallClock: The wall clock, shared by the TS servers of all sessions.
+        :param baseUrl: The URL for the websocket server that companions will be told to contact, without a path. E.g. "ws://{{host}}:7681"
+        :param wcUrl: The URL of the WC server endpoint.
+        :param rewriteHostPort: List of CII properties for which the CII servers will substitute {{host}} and {{port}} (see :class:`~dvbcss.protocol.server.cii.CIIServer`).
+        :param recorder: Optional :class:`ProxyRecorder` in which to record the messages to and from the browsers of all sessions.
+        :param sendQueues: Optional :class:`ProxySendQueues` through which the CII and TS servers of all sessions send messages to clients. None means they are sent directly.
+        :param engineOptions: Any other keyword arguments are passed on to the :class:`CssProxyEngine` of each session (e.g. `tsTolerance`).
+        """
+        super(ProxySessionRegistry,self).__init__()
+        self._wallClock = wallClock
+        self._baseUrl = baseUrl
+        self._wcUrl = wcUrl
+        self._rewriteHostPort = rewriteHostPort[:]
+        self._recorder = recorder
+        self._sendQueues = sendQueues
+        self._engineOptions = engineOptions
+        self._sessions = {}
+        self._lock = threading.RLock()
+
+    def endpointUrl(self, endpointName, sessionId):
+        """\
+        :param endpointName: "server", "cii" or "ts"
+        :param sessionId: The session ID, or the empty string for the default session.
+        :returns: The URL for that endpoint of that session.
+        """
+        url = self._baseUrl + "/" + endpointName
+        if sessionId:
+            url = url + "/" + sessionId
+        return url
+
+    @property
+    def sessions(self):
+        """\
+        :returns: a :class:`dict` mapping session IDs to :class:`CssProxyEngine` objects. This is a snapshot of the sessions at the moment the call is made.
+        """
+        with self._lock:
+            return self._sessions.copy()
+
+    def connectionCounts(self):
+        """\
+        :returns: a :class:`dict` mapping each endpoint name ("server", "cii" and "ts") to the number of connections to it, summed over all sessions.
+        """
+        counts = { "server":0, "cii":0, "ts":0 }
+        for engine in self.sessions.values():
+            if engine.serverEndpoint.serverConnected:
+                counts["server"] += 1
+            counts["cii"] += len(engine.ciiServer.getConnections())
+            counts["ts"] += len(engine.tsServer.getConnections())
+        return counts
+
+    def getSession(self, sessionId):
+        """\
+        :returns: The :class:`CssProxyEngine` for the session, or None if there is no such session.
+        """
+        with self._lock:
+            return self._sessions.get(sessionId, None)
+
+    def createSession(self, sessionId, serverEndpoint=None):
+        """\
+        Get the session with the specified ID, creating it if it does not yet exist.
+
+        :param serverEndpoint: Optional source of updates for a new session, used
+          instead of a browser connecting to its server endpoint (e.g. an
+          :class:`~ProxyRelay.UpstreamFeed`). Such a session is not discarded when
+          its source disconnects.
+        :returns: The :class:`CssProxyEngine` for the session.
+        :throws ValueError: if the session ID is not valid.
+        """
+        if not _SESSION_ID_PATTERN.match(sessionId):
+            raise ValueError("Invalid session id: "+repr(sessionId))
+        with self._lock:
+            if sessionId not in self._sessions:
+                self._sessions[sessionId] = self._newEngine(sessionId, serverEndpoint)
+            return self._sessions[sessionId]
+
+    def _newEngine(self, sessionId, serverEndpoint=None):
+        tracer = self._engineOptions.get("tracer", None)
+        ciiServer = BlockableCIIServer(maxConnectionsAllowed=-1, enabled=False, rewriteHostPort=self._rewriteHostPort, sendQueues=self._sendQueues, tracer=tracer)
+        tsServer  = ProxyTSServer(None, self._wallClock, maxConnectionsAllowed=-1, enabled=False, sendQueues=self._sendQueues, tracer=tracer)
+        engineOptions = dict(self._engineOptions)
+        if self._recorder is not None:
+            engineOptions["recorder"] = self._recorder.session(sessionId)
+        if serverEndpoint is not None:
+            engineOptions["serverEndpoint"] = serverEndpoint
+        engine = self.Engine(ciiServer, tsServer,
+                             self.endpointUrl("cii", sessionId),
+                             self.endpointUrl("ts", sessionId),
+                             self._wcUrl,
+                             **engineOptions)
+        if serverEndpoint is None:
+            engine.onServerConnectionStateChange = lambda connected: self._onSessionConnectionStateChange(sessionId, engine, connected)
+        return engine
+
+    def removeSession(self, sessionId):
+        """\
+        Discard a session. Any browser or companions connected to it are disconnected.
+        """
+        with self._lock:
+            engine = self._sessions.pop(sessionId, None)
+        if engine is not None:
+            self._disable(engine)
+
+    def _disable(self, engine):
+        engine.serverEndpoint.enabled = False
+        engine.ciiServer.enabled = False
+        engine.tsServer.enabled = False
+
+    def _onSessionConnectionStateChange(self, sessionId, engine, connected):
+        if connected:
+            with self._lock:
+                current = self._sessions.setdefault(sessionId, engine)
+            if current is not engine:
+                # another browser created the session first
+                self._disable(engine)
+        else:
+            with self._lock:
+                # only discard if it has not already been replaced
+                if self._sessions.get(sessionId, None) is not engine:
+                    return
+            self.removeSession(sessionId)
+
+    def handlerFor(self, endpointName, sessionId, remoteAddr=None, allowedAddrs=None):
+        """\
+        Look up the handler class (as would be supplied as the `handler_cls` for a
+        cherrypy tool) for a connection to an endpoint of a session.
+
+        Connecting to the "server" endpoint creates the session if it does not
+        already exist, provided the connection is from an allowed address. The
+        session is only added to the registry once the browser's connection has
+        opened, so nothing is left behind if the WebSocket handshake fails.
+
+        :param endpointName: "server", "cii" or "ts"
+        :param sessionId: The session ID, or the empty string for the default session.
+        :param remoteAddr: The IP address the connection is coming from.
+        :param allowedAddrs: List of addresses from which connections to the "server" endpoint are accepted, or None to accept from any.
+        :returns: The handler class, or None if there is no such endpoint, or the session does not exist, or the connection is not allowed.
+        """
+        if endpointName == "server":
+            if allowedAddrs is not None and remoteAddr not in allowedAddrs:
+                return None
+            engine = self.getSession(sessionId)
+            if engine is None:
+                if not _SESSION_ID_PATTERN.match(sessionId):
+                    return None
+                engine = self._newEngine(sessionId)
+            server = getattr(engine.serverEndpoint, "_server", None)
+            if server is None:
+                # session is fed from elsewhere (e.g. relayed from an upstream proxy)
+                return None
+            return server.handler
+
+        engine = self.getSession(sessionId)
+        if engine is None:
+            return None
+        elif endpointName == "cii":
+            return engine.ciiServer.handler
+        elif endpointName == "ts":
+            return engine.tsServer.handler
+        else:
+            return None
+
+
+    def handlerForPath(self, path, remoteAddr=None, allowedAddrs=None):
+        """\
+        As for :func:`handlerFor`, but with the endpoint and session ID determined from a request path such as "/cii/lounge-tv".
+        """
+        endpointName, sessionId = splitSessionPath(path)
+        return self.handlerFor(endpointName, sessionId, remoteAddr, allowedAddrs)
+
+
+class SessionWSServerTool(WSServerTool):
+    """\
+    Cherrypy tool that hands off WebSocket connections to the endpoints of
+    sessions in a :class:`ProxySessionRegistry`. The session ID is taken from
+    the request path.
+
+    Configure with the registry and, optionally, the list of addresses from
+    which connections to the "server" endpoint are accepted:
+
+    .. code-block:: python
+
+        { 'tools.css_session.on'           : True,
+          'tools.css_session.registry'     : registry,
+          'tools.css_session.allowedAddrs' : [ "127.0.0.1" ] }
+    """
+
+    def upgrade(self, registry=None, allowedAddrs=None, **kwargs):
+        handler_cls = registry.handlerForPath(cherrypy.request.path_info, cherrypy.request.remote.ip, allowedAddrs)
+        if handler_cls is None:
+            raise cherrypy.NotFound()
+        kwargs["handler_cls"] = handler_cls
+        return super(SessionWSServerTool,self).upgrade(**kwargs)
+
+cherrypy.tools.css_session = SessionWSServerTool()
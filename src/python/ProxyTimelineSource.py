@@ -14,6 +14,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import sys
+import re
+import threading
+
 try:
     from dvbcss.protocol.server.ts import TimelineSource
 except ImportError:
@@ -24,6 +28,60 @@ except ImportError:
     """)
     sys.exit(1)
 
+from dvbcss.protocol import OMIT
+from dvbcss import monotonic_time
+
+
+WALL_CLOCK_TICK_RATE = 1000000000   # wallClockTime in Control Timestamps is always in nanoseconds
+
+_MPD_PERIOD_REL_SELECTOR = re.compile(r"^urn:dvb:css:timeline:mpd:period:rel:([0-9]+)(:.*)?$")
+
+
+def tickRateForSelector(timelineSelector):
+    """\
+    :returns: The tick rate (ticks per second) implied by a timeline selector,
+      for those timelines where it is fixed by the selector, otherwise None.
+    """
+    if timelineSelector == "urn:dvb:css:timeline:pts":
+        return 90000
+    match = _MPD_PERIOD_REL_SELECTOR.match(timelineSelector)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def controlTimestampsEquivalent(prev, latest, tickRate, toleranceTicks=1):
+    """\
+    Checks whether two Control Timestamps describe the same relationship
+    between wall clock time and content time.
+
+    They are equivalent if both say the timeline is unavailable, or if they
+    have the same timeline speed multiplier and extrapolating the previous
+    Control Timestamp to the wall clock time of the latest one predicts its
+    content time to within the tolerance.
+
+    :param prev: The previous :class:`~dvbcss.protocol.ts.ControlTimestamp`
+    :param latest: The latest :class:`~dvbcss.protocol.ts.ControlTimestamp`
+    :param tickRate: The tick rate of the timeline (ticks per second), or None if not known.
+      If not known, then the Control Timestamps are only equivalent if identical.
+    :param toleranceTicks: The largest difference (in ticks) between predicted
+      and actual content time that is still considered equivalent. Defaults
+      to 1 tick, to allow for rounding.
+    """
+    if prev is None:
+        return False
+    prevContentTime = prev.timestamp.contentTime
+    latestContentTime = latest.timestamp.contentTime
+    if prevContentTime is None or latestContentTime is None:
+        return prevContentTime is None and latestContentTime is None
+    if prev.timelineSpeedMultiplier != latest.timelineSpeedMultiplier:
+        return False
+    if tickRate is None:
+        return prevContentTime == latestContentTime and prev.timestamp.wallClockTime == latest.timestamp.wallClockTime
+    elapsed = latest.timestamp.wallClockTime - prev.timestamp.wallClockTime
+    predicted = prevContentTime + float(elapsed) * prev.timelineSpeedMultiplier * tickRate / WALL_CLOCK_TICK_RATE
+    return abs(latestContentTime - predicted) <= toleranceTicks
+
 
 class ProxyTimelineSource(TimelineSource):
     """\
@@ -35,45 +93,248 @@ class ProxyTimelineSource(TimelineSource):
     
     Control Timestamps (for newly requested, or existing timelines) are
     pushed back via this proxy by calling :func:`timelinesUpdate`.
+    
+    The JSON serialised form of each Control Timestamp is cached, so that it
+    can be sent to any number of clients after being serialised only once
+    (see :func:`getPackedControlTimestamp`).
+    
+    A Control Timestamp that is equivalent to the one it replaces (see
+    :func:`controlTimestampsEquivalent`) is ignored, so that clients are not
+    needlessly sent an update. Tick rates of the timelines, needed to determine
+    equivalence, are provided via :func:`setTimelineOptions`.
+    
+    By default, only Control Timestamps that match the extrapolation of the
+    previous one to within a tick are ignored. A larger tolerance can be set,
+    so that small corrections (e.g. jitter in the position reported by a media
+    element) are not relayed either. The number of Control Timestamps relayed
+    and suppressed are counted in :data:`relayedCount` and :data:`suppressedCount`.
+    
+    A timeline that is no longer needed can be kept for a while (the linger
+    period) before the request for it is withdrawn. During this time it
+    continues to be updated, so that if it is needed again (e.g. because a
+    companion reconnects) the latest Control Timestamp is available straight
+    away and no new request need be made.
+    
+    The browser reports that it cannot provide a timeline with a Control
+    Timestamp whose content time is null. This can be remembered for a while
+    (the unavailable TTL), for the content ID at the time (provided via
+    :func:`setContentId`). If the timeline is needed again within the TTL,
+    while the content ID is unchanged, it is immediately answered as being
+    unavailable, without asking the browser again. Such timelines are only
+    requested from the browser once the content ID changes. The number of
+    times this happens is counted in :data:`unavailableAnsweredCount`.
     """
+    Timer = staticmethod(threading.Timer)
+    time = staticmethod(monotonic_time.time)
     
-    def __init__(self):
+    def __init__(self, tolerance=0.0, linger=0.0, unavailableTtl=0.0):
+        """\
+        :param tolerance: The largest error (in seconds) between the content time
+          extrapolated from the last relayed Control Timestamp and that of a new
+          Control Timestamp for which the new one is ignored. Zero means only
+          rounding errors (up to one tick) are ignored.
+        :param linger: Period (in seconds) for which a timeline that is no longer
+          needed is kept before the request for it is withdrawn. Zero means it is
+          withdrawn immediately.
+        :param unavailableTtl: Period (in seconds) for which a timeline that the
+          browser reported as unavailable is remembered as such. Zero means it
+          is not remembered.
+        """
         super(ProxyTimelineSource,self).__init__()
+        self.tolerance = tolerance
+        self.linger = linger
+        self.unavailableTtl = unavailableTtl
+        self.relayedCount = 0      # number of Control Timestamps accepted as changes
+        self.suppressedCount = 0   # number of Control Timestamps ignored as equivalent to the previous one
+        self.unavailableAnsweredCount = 0  # number of times a timeline was answered as unavailable without asking the browser
         self.timelines = {}    # maps selectors to ControlTimestamp objects or None if no clock available
+        self._packed = {}      # maps selectors to tuple (ControlTimestamp, its serialised form)
+        self._tickRates = {}   # maps selectors to tick rates, as advertised in CII
+        self._lingering = {}   # maps selectors no longer needed, but not yet withdrawn, to their timers
+        self._contentId = None
+        self._unavailable = {} # maps content IDs to dicts mapping selectors to tuple (time reported, ControlTimestamp saying it is unavailable)
+        self._unrequested = set()  # selectors needed but answered as unavailable without being requested from the browser
+        self._lock = threading.RLock()
         
     def timelineSelectorNeeded(self, timelineSelector):
-        if timelineSelector not in self.timelines:
-            self.timelines[timelineSelector] = None # mark as pending getting hold of it (don't know if available yet or not)
-            if self.onRequestedTimelinesChanged:
-                self.onRequestedTimelinesChanged(self.timelines.keys(),[timelineSelector],[])
+        with self._lock:
+            if timelineSelector in self._lingering:
+                self._lingering.pop(timelineSelector).cancel()
+            elif timelineSelector not in self.timelines:
+                ct = self._knownUnavailable(timelineSelector)
+                if ct is not None:
+                    self.timelines[timelineSelector] = ct
+                    self._unrequested.add(timelineSelector)
+                    self.unavailableAnsweredCount += 1
+                    return
+                self.timelines[timelineSelector] = None # mark as pending getting hold of it (don't know if available yet or not)
+                if self.onRequestedTimelinesChanged:
+                    self.onRequestedTimelinesChanged(self._requestedSelectors(),[timelineSelector],[])
+                    
+    def _requestedSelectors(self):
+        return [ selector for selector in self.timelines if selector not in self._unrequested ]
+        
+    def _knownUnavailable(self, timelineSelector):
+        """\
+        :returns: The Control Timestamp with which the browser reported the timeline as unavailable for the current content ID, or None if not reported within the TTL.
+        """
+        reports = self._unavailable.get(self._contentId, {})
+        if timelineSelector not in reports:
+            return None
+        reported, ct = reports[timelineSelector]
+        if self.time() - reported >= self.unavailableTtl:
+            del reports[timelineSelector]
+            return None
+        return ct
         
     def timelineSelectorNotNeeded(self, timelineSelector):
-        if timelineSelector in self.timelines:
-            del self.timelines[timelineSelector]
-            if self.onRequestedTimelinesChanged:
-                self.onRequestedTimelinesChanged(self.timelines.keys(),[],[timelineSelector])
+        with self._lock:
+            if timelineSelector not in self.timelines or timelineSelector in self._lingering:
+                return
+            if self.linger > 0:
+                timer = self.Timer(self.linger, self._onLingerEnd, args=[timelineSelector])
+                timer.daemon = True
+                self._lingering[timelineSelector] = timer
+                timer.start()
+            else:
+                self._withdraw(timelineSelector)
+                
+    def _onLingerEnd(self, timelineSelector):
+        with self._lock:
+            if timelineSelector in self._lingering:
+                del self._lingering[timelineSelector]
+                self._withdraw(timelineSelector)
+                
+    def _withdraw(self, timelineSelector):
+        del self.timelines[timelineSelector]
+        self._packed.pop(timelineSelector, None)
+        if timelineSelector in self._unrequested:
+            self._unrequested.discard(timelineSelector)
+        elif self.onRequestedTimelinesChanged:
+            self.onRequestedTimelinesChanged(self._requestedSelectors(),[],[timelineSelector])
+            
+    def setContentId(self, contentId):
+        """\
+        Call this method to provide the content ID, as advertised in CII.
+        
+        Timelines that were answered as unavailable (without being requested
+        from the browser) because they were unavailable for the previous
+        content ID are now requested from the browser.
+        
+        :param contentId: The content ID, or :data:`~dvbcss.protocol.OMIT` or None.
+        """
+        with self._lock:
+            if contentId == self._contentId:
+                return
+            self._contentId = contentId
+            now = self.time()
+            for cid in self._unavailable.keys():
+                reports = self._unavailable[cid]
+                for selector in reports.keys():
+                    if now - reports[selector][0] >= self.unavailableTtl:
+                        del reports[selector]
+                if not reports:
+                    del self._unavailable[cid]
+            added = list(self._unrequested)
+            self._unrequested.clear()
+            if added and self.onRequestedTimelinesChanged:
+                self.onRequestedTimelinesChanged(self._requestedSelectors(),added,[])
+            
+    def lingeringTimelineSelectors(self):
+        """\
+        :returns: A :class:`list` of the timeline selectors that are no longer needed, but not yet withdrawn.
+        """
+        with self._lock:
+            return self._lingering.keys()
         
     def recognisesTimelineSelector(self, timelineSelector):
         return timelineSelector in self.timelines
         
     def getControlTimestamp(self, timelineSelector):
-        if timelineSelector in self.timelines:
-            return self.timelines[timelineSelector]
-        else:
-            return None 
+        return self.timelines.get(timelineSelector, None)
+        
+    def getPackedControlTimestamp(self, timelineSelector):
+        """\
+        :returns: The Control Timestamp for the timeline selector serialised
+          as a CSS-TS message, or None if there is no Control Timestamp for it.
+
+        The serialised form is cached until the Control Timestamp changes.
+        """
+        ct = self.getControlTimestamp(timelineSelector)
+        if ct is None:
+            return None
+        try:
+            cachedCt, packed = self._packed[timelineSelector]
+            if cachedCt is ct:
+                return packed
+        except KeyError:
+            pass
+        packed = ct.pack()
+        self._packed[timelineSelector] = (ct, packed)
+        return packed
+        
+    def setTimelineOptions(self, timelineOptions):
+        """\
+        Call this method to provide the tick rates of timelines, as advertised
+        in the "timelines" property of CII.
+        
+        :param timelineOptions: :class:`list` of :class:`~dvbcss.protocol.cii.TimelineOption` objects, or :data:`~dvbcss.protocol.OMIT`
+        """
+        self._tickRates = {}
+        if timelineOptions != OMIT and timelineOptions is not None:
+            for option in timelineOptions:
+                self._tickRates[option.timelineSelector] = float(option.unitsPerSecond) / option.unitsPerTick
+                
+    def getTickRate(self, timelineSelector):
+        """\
+        :returns: The tick rate (ticks per second) of the timeline, or None if not known.
+        """
+        if timelineSelector in self._tickRates:
+            return self._tickRates[timelineSelector]
+        return tickRateForSelector(timelineSelector)
+        
+    def getToleranceTicks(self, timelineSelector):
+        """\
+        :returns: The tolerance for the timeline in ticks (at least one tick), or None if its tick rate is not known.
+        """
+        tickRate = self.getTickRate(timelineSelector)
+        if tickRate is None:
+            return None
+        return max(1, self.tolerance * tickRate)
         
     def timelinesUpdate(self, controlTimestamps):
         """\
         Call this method to update the set of Control Timestamps for timelines.
         
         :param controlTimestamps: A :class:`dict` mapping from timeline selectors (:class:`str`) to :class:`~dvbcss.protocol.ts.ControlTimestamp` objects
+        :returns: A :class:`list` of the timeline selectors whose Control Timestamps have changed.
+          Control Timestamps for timelines that are not needed, or that are
+          equivalent to the existing Control Timestamp, are ignored.
 
         Note: this does not trigger attached sinks to update clients.
         """
-        for selector in controlTimestamps:
-            if selector in self.timelines:
-                ct = controlTimestamps[selector]
-                self.timelines[selector] = ct
+        changed = []
+        with self._lock:
+            for selector in controlTimestamps:
+                if selector in self.timelines:
+                    ct = controlTimestamps[selector]
+                    if controlTimestampsEquivalent(self.timelines[selector], ct, self.getTickRate(selector), self.getToleranceTicks(selector) or 1):
+                        self.suppressedCount += 1
+                    else:
+                        self.timelines[selector] = ct
+                        self._packed.pop(selector, None)
+                        changed.append(selector)
+                        self.relayedCount += 1
+                    self._noteAvailability(selector, ct)
+        return changed
+        
+    def _noteAvailability(self, timelineSelector, ct):
+        if self.unavailableTtl <= 0:
+            return
+        if ct.timestamp.contentTime is None:
+            self._unavailable.setdefault(self._contentId, {})[timelineSelector] = (self.time(), ct)
+        else:
+            self._unavailable.get(self._contentId, {}).pop(timelineSelector, None)
 
     def onRequestedTimelinesChanged(self, timelineSelectors, selectorsAdded, selectorsRemoved):
         """\
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import threading
+import time
+from collections import deque
+
+
+class Trace(object):
+    """\
+    The times at which one update passed through each stage of being processed.
+    Create using :func:`ProxyTracer.begin`.
+    """
+
+    def __init__(self, name):
+        super(Trace,self).__init__()
+        self.name = name
+        self.start = time.time()
+        self.stages = []    # list of (stage name, time, dict of extra information)
+
+    def mark(self, stage, **info):
+        """\
+        Record that a stage has been reached now.
+
+        :param stage: Name of the stage, e.g. "decode"
+        :param info: Any extra information to record with it, e.g. the number of messages sent.
+        """
+        self.stages.append((stage, time.time(), info))
+
+    def toDict(self):
+        """\
+        :returns: :class:`dict` describing the trace, suitable for serialising as JSON.
+          The time of each stage is given in seconds since the trace began.
+        """
+        stages = []
+        for stage, when, info in self.stages:
+            entry = { "stage":stage, "offset":when - self.start }
+            entry.update(info)
+            stages.append(entry)
+        return { "name":self.name, "start":self.start, "stages":stages }
+
+
+class ProxyTracer(object):
+    """\
+    Records traces of updates as they pass from the browser, through the proxy,
+    to the CII and TS clients, to show where the time goes.
+
+    The most recent traces are kept in a ring buffer of fixed size, and can be
+    retrieved with :func:`dump`.
+
+    A trace is begun by :func:`begin` and becomes the current trace for the
+    thread (or greenlet) that began it, until :func:`end` is called. This lets
+    the stages of processing an update mark the trace without it being passed
+    between them:
+
+    .. code-block:: python
+
+        tracer.begin("browser message", "receive")
+        ...
+        trace = tracer.current
+        if trace is not None:
+            trace.mark("decode")
+        ...
+        tracer.end()
+
+    Tracing is disabled by not supplying a tracer (e.g. to
+    :class:`CssProxyEngine`), in which case the cost is a single test for None
+    at each stage.
+    """
+
+    def __init__(self, capacity=256):
+        """\
+        :param capacity: The number of traces kept.
+        """
+        super(ProxyTracer,self).__init__()
+        self._traces = deque(maxlen=capacity)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        """\
+        (read only) The trace begun by this thread that has not yet ended, or None.
+        """
+        return getattr(self._local, "trace", None)
+
+    def begin(self, name, stage="begin"):
+        """\
+        Begin a new trace, and make it the current trace for this thread. The first stage is marked immediately.
+
+        :param name: Describes what is being traced, e.g. "browser message"
+        :param stage: Name of the first stage, e.g. "receive"
+        :returns: The :class:`Trace`
+        """
+        trace = Trace(name)
+        trace.mark(stage)
+        self._local.trace = trace
+        return trace
+
+    def end(self):
+        """\
+        Mark the "end" stage of the current trace for this thread and store it in the ring buffer.
+        Does nothing if there is no current trace.
+        """
+        trace = self.current
+        if trace is None:
+            return
+        self._local.trace = None
+        trace.mark("end")
+        with self._lock:
+            self._traces.append(trace)
+
+    def dump(self):
+        """\
+        :returns: :class:`list` of the traces in the ring buffer, oldest first, each as a :class:`dict` (see :func:`Trace.toDict`).
+        """
+        with self._lock:
+            traces = list(self._traces)
+        return [ trace.toDict() for trace in traces ]
+
+    def clear(self):
+        """\
+        Discard all traces in the ring buffer.
+        """
+        with self._lock:
+            self._traces.clear()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import signal
+import time
+import traceback
+
+
+class WallClockWorkers(object):
+    """\
+    Runs UDP wall clock servers in several worker processes, all bound to the
+    same port using SO_REUSEPORT. The operating system shares requests between
+    them, so wall clock throughput scales with the number of processor cores
+    and is unaffected by the CII and TS traffic (and the GIL) of the main
+    process.
+
+    Each worker is created by forking, so it inherits the wall clock (e.g. a
+    :class:`~dvbcss.clock.SysClock`). All workers therefore read the same
+    underlying system clock.
+
+    The workers must be started before any threads are started or event loop
+    is running in the main process, as only the forking thread is copied into
+    each worker.
+
+    .. code-block:: python
+
+        workers = WallClockWorkers(4, lambda : BatchedWallClockServer(wallClock, precision, mfe, bindport=6677, reusePort=True))
+        workers.start()
+        ...
+        workers.stop()
+
+    Workers exit if the main process exits without stopping them.
+    """
+
+    def __init__(self, numWorkers, serverFactory):
+        """\
+        :param numWorkers: The number of worker processes.
+        :param serverFactory: Function called (in each worker process) to create the wall clock server for that worker. The server must provide :func:`start` and :func:`stop` methods and must bind with SO_REUSEPORT (e.g. :class:`BatchedWallClockServer` with `reusePort=True`).
+        """
+        super(WallClockWorkers,self).__init__()
+        self.numWorkers = numWorkers
+        self._serverFactory = serverFactory
+        self._pids = []
+
+    @property
+    def pids(self):
+        """\
+        :returns: list of process IDs of the running workers.
+        """
+        return self._pids[:]
+
+    def start(self):
+        """\
+        Fork the worker processes. Returns once they have been forked.
+        """
+        if self._pids:
+            return
+        parentPid = os.getpid()
+        for i in range(0, self.numWorkers):
+            pid = os.fork()
+            if pid == 0:
+                self._runWorker(parentPid)
+            self._pids.append(pid)
+
+    def stop(self):
+        """\
+        Stop all the worker processes. Does not return until they have exited.
+        """
+        for pid in self._pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self._pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._pids = []
+
+    def _runWorker(self, parentPid):
+        """\
+        Runs in the worker process. Never returns.
+        """
+        status = 0
+        self._pleaseStop = False
+        signal.signal(signal.SIGTERM, self._onTerminate)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)   # the main process handles Ctrl-C and then stops the workers
+        try:
+            server = self._serverFactory()
+            server.start()
+            try:
+                while not self._pleaseStop and os.getppid() == parentPid:
+                    time.sleep(0.5)
+            finally:
+                server.stop()
+        except BaseException:
+            traceback.print_exc()
+            sys.stderr.flush()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _onTerminate(self, signum, frame):
+        self._pleaseStop = True
@@ -29,6 +29,8 @@ import json
 from dvbcss.protocol.server import WSServerTool
 from dvbcss.protocol.server import WSServerBase
 
+import ProxyMetrics
+
 
 
 cherrypy.tools.wcws = WSServerTool()
@@ -55,6 +57,14 @@ class WebSocketWallClock_ServerEndpoint(object):
         { }
         
     But it can also include any properties it wishes.
+    
+    The receive time is read from the wall clock before anything else is done
+    with a message. The response is then serialised, except for the send
+    time, which is read from the wall clock and spliced into the serialised
+    response immediately before it is sent.
+    
+    Responses, and the time between receiving a request and sending the
+    response, are recorded in the metrics (see :mod:`ProxyMetrics`).
     """
     ServerBase = WSServerBase
     
@@ -64,6 +74,10 @@ class WebSocketWallClock_ServerEndpoint(object):
         self.wallClock = wallClock
         self.precision = precision
         self.mfe = mfe
+        self._responses = ProxyMetrics.wallClockResponses("websocket")
+        self._turnaround = ProxyMetrics.wallClockTurnaroundSeconds("websocket")
+        self._sent = ProxyMetrics.messagesSent("wcws")
+        self._sentBytes = ProxyMetrics.bytesSent("wcws")
 
         self.server = self.ServerBase(maxConnectionsAllowed=-1, enabled=True)
         self.server.onClientConnect = self._onClientConnect
@@ -94,12 +108,21 @@ class WebSocketWallClock_ServerEndpoint(object):
         msg = json.loads(str(message))
         
         msg["t"] = 1
-        msg["rt"]  = msg["remoteReceiveTime"] = rxTime
+        msg["remoteReceiveTime"] = rxTime
+        msg["rt"]  = rxTime / 1000000000.0
         msg["p"]   = msg["precision"] = self.precision
         msg["mfe"] = msg["maxFrequencyError"] = self.mfe
-        msg["tt"]  = msg["remoteSendTime"] = self.wallClock.nanos
-        msg["rt"] = msg["rt"] / 1000000000.0
-        msg["tt"] = msg["tt"] / 1000000000.0
+        msg.pop("tt", None)
+        msg.pop("remoteSendTime", None)
+        
+        # everything except the send time is serialised in advance
+        head = json.dumps(msg)[:-1]
         
+        txTime = self.wallClock.nanos
+        response = '%s, "tt": %r, "remoteSendTime": %d}' % (head, txTime / 1000000000.0, txTime)
+        webSock.send(response)
         
-        webSock.send(json.dumps(msg))
+        self._responses.inc()
+        self._turnaround.observe((txTime - rxTime) / 1000000000.0)
+        self._sent.inc()
+        self._sentBytes.inc(len(response))
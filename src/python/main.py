@@ -87,22 +87,9 @@ if __name__ == "__main__":
     import json
     import logging
 
-    import time
-    import dvbcss.clock
     import dvbcss.util
-    dvbcss.clock.time = time  # override to use normal time.time instead of monotonic_time.time
-
-    import cherrypy
-    from ws4py.server.cherrypyserver import WebSocketPlugin
-    
-    from dvbcss.protocol.server.ts import TSServer
-    from dvbcss.clock import SysClock, CorrelatedClock, measurePrecision
-    from dvbcss.protocol.server.wc import WallClockServer
     from dvbcss.util import parse_logLevel
 
-    from WebSocketWallClock_ServerEndpoint import WebSocketWallClock_ServerEndpoint
-    from CssProxyEngine import CssProxyEngine, BlockableCIIServer
-
     parser=argparse.ArgumentParser(description="""\
         Proxy server for CSS protocols. Acts as a server for CSS-CII, CSS-TS and CSS-WC
         and also provides a separate websocket server through which this server can be
@@ -146,6 +133,27 @@ if __name__ == "__main__":
         help="Run an alternative non-standard websocket based wallclock server to companions instead of a UDP based one (as defined in the DVB CSS / HbbTV specs)"
     )
     
+    parser.add_argument(
+        "--wc-batched",
+        action="store_true", dest="wc_batched",
+        default=False,
+        help="Use a UDP wallclock server that receives and responds to requests in batches (using recvmmsg/sendmmsg where available). Better suited to large numbers of companions."
+    )
+    
+    parser.add_argument(
+        "--wc-kernel-timestamps",
+        action="store_true", dest="wc_kernel_timestamps",
+        default=False,
+        help="Take the receive times of UDP wallclock requests from the time the kernel received them, instead of when this server got round to reading them (Linux only). Implies --wc-batched."
+    )
+    
+    parser.add_argument(
+        "--wc-workers",
+        action="store", dest="wc_workers",
+        type=int, default=0,
+        help="Serve the UDP wallclock protocol from this many separate worker processes, sharing the port using SO_REUSEPORT (Linux and some BSDs only). Implies --wc-batched. Default=0 (served by this process)."
+    )
+    
     parser.add_argument(
         "--proxy-listen-on",
         action="store", dest="proxy_listen_addrs",
@@ -163,10 +171,145 @@ if __name__ == "__main__":
         default=[logging.WARNING]
     )
 
+    parser.add_argument(
+        "--runtime",
+        action="store", dest="runtime",
+        choices=["cherrypy","eventloop"],
+        default="cherrypy",
+        help="Select how connections are handled: 'cherrypy' uses a thread per connection; 'eventloop' handles all connections on a single gevent event loop, allowing many thousands of companions per process (requires gevent). Default=cherrypy."
+    )
+
+    parser.add_argument(
+        "--ts-tolerance",
+        action="store", dest="ts_tolerance_ms",
+        type=float,
+        default=0.0,
+        help="Do not relay Control Timestamps from the browser to CSS-TS clients if they differ from the extrapolation of the last one relayed by less than this many milliseconds (e.g. 1). Default=0 (only rounding errors are ignored)."
+    )
+
+    parser.add_argument(
+        "--ts-linger",
+        action="store", dest="ts_linger_ms",
+        type=float,
+        default=0.0,
+        help="Keep requesting a timeline from the browser for this many milliseconds after the last CSS-TS client needing it has gone, so a companion that reconnects is answered straight away. Default=0 (stop requesting it immediately)."
+    )
+
+    parser.add_argument(
+        "--ts-unavailable-ttl",
+        action="store", dest="ts_unavailable_ttl_ms",
+        type=float,
+        default=0.0,
+        help="Remember for this many milliseconds that the browser cannot provide a timeline for the current content, and tell CSS-TS clients needing it so straight away instead of asking the browser again. Default=0 (always ask the browser)."
+    )
+
+    parser.add_argument(
+        "--coalesce-window",
+        action="store", dest="coalesce_window_ms",
+        type=float,
+        default=0.0,
+        help="Coalesce updates from the browser that arrive within this many milliseconds of each other, so CSS-CII and CSS-TS clients are updated at most once per window. Default=0 (no coalescing)."
+    )
+
+    parser.add_argument(
+        "--browser-batch-window",
+        action="store", dest="browser_batch_window_ms",
+        type=float,
+        default=0.0,
+        help="Batch changes to the timelines required by companions, and to the number of companions, over this many milliseconds and tell the browser about them in a single message. Useful when many companions connect at once. Default=0 (the browser is told of each change as it happens)."
+    )
+
+    parser.add_argument(
+        "--trace",
+        action="store", dest="trace_capacity",
+        type=int, default=0,
+        help="Record when each update from the browser reaches each stage of being processed (receipt, decoding, sending CII messages, sending Control Timestamps), keeping the most recent TRACE_CAPACITY updates. They can be retrieved, as JSON, from /traces. Default=0 (no tracing)."
+    )
+
+    parser.add_argument(
+        "--log-sample",
+        action="store", dest="log_sample",
+        type=int, default=1,
+        help="When logging at debug level, only log 1 in this many of the messages received from the browser, to limit the amount logged under load. Default=1 (log every message)."
+    )
+
+    parser.add_argument(
+        "--record",
+        action="store", dest="record_file",
+        default=None,
+        help="Append every message received from, and sent to, browsers via the server/proxy interface to this file, with the time at which it happened. The recording can be replayed against the proxy using tests/python/bench_replay.py."
+    )
+
+    parser.add_argument(
+        "--send-writers",
+        action="store", dest="send_writers",
+        type=int, default=0,
+        help="Queue the messages for each CSS-CII and CSS-TS client and send them from this many writer threads, so that a client that is slow to receive messages does not hold up the others. Default=0 (messages are sent directly)."
+    )
+
+    parser.add_argument(
+        "--relay-from",
+        action="store", dest="relay_from",
+        default=None,
+        help="Run as a relay: instead of a TV in a browser connecting to this proxy, obtain CII and timelines from the CSS-CII server at this URL (e.g. that of another proxy, ws://192.168.1.5:7681/cii/lounge-tv) and serve them to companions as the default session. The wall clock follows that of the upstream proxy."
+    )
+
+    parser.add_argument(
+        "--send-queue-capacity",
+        action="store", dest="send_queue_capacity",
+        type=int, default=100,
+        help="With --send-writers, the number of messages that can be waiting to be sent to a client before it is disconnected. Default=100."
+    )
+
+    parser.add_argument(
+        "--max-send-lag",
+        action="store", dest="max_send_lag_ms",
+        type=float, default=2000.0,
+        help="With --send-writers, disconnect a client if a message has been waiting to be sent to it for longer than this many milliseconds. Default=2000."
+    )
+
     args = parser.parse_args()
     
-    logging.basicConfig(level=args.loglevel[0])
+    # the event loop runtime must patch threads, locks and sockets before
+    # cherrypy, ws4py and the rest of pydvbcss are imported
+    if args.runtime == "eventloop":
+        try:
+            from gevent import monkey
+        except ImportError:
+            sys.stderr.write("""
+    Could not import gevent library, needed for the 'eventloop' runtime. Suggest installing using pip, e.g. on Linux/Mac:
+    
+    $ sudo pip install gevent
+    """)
+            sys.exit(1)
+        monkey.patch_all()
+
+    import time
+    import dvbcss.clock
+    dvbcss.clock.time = time  # override to use normal time.time instead of monotonic_time.time
+
+    if args.relay_from is not None and args.wc_workers > 0:
+        sys.stderr.write("--wc-workers cannot be used with --relay-from, because worker processes cannot follow the upstream wall clock\n")
+        sys.exit(1)
+
+    import cherrypy
+    from ws4py.server.cherrypyserver import WebSocketPlugin
     
+    from dvbcss.clock import SysClock, CorrelatedClock, TunableClock, measurePrecision
+    from dvbcss.protocol.server.wc import WallClockServer
+
+    from WebSocketWallClock_ServerEndpoint import WebSocketWallClock_ServerEndpoint
+    from BatchedWallClockServer import BatchedWallClockServer
+    from WallClockWorkers import WallClockWorkers
+    from ProxySessionRegistry import ProxySessionRegistry
+    from EventLoopServer import EventLoopServer
+    import ProxyMetrics
+    import ProxyLogging
+    from ProxyTracer import ProxyTracer
+    from ProxyRecorder import ProxyRecorder
+    from ProxySendQueues import ProxySendQueues
+    from ProxyRelay import UpstreamFeed, UpstreamWallClock
+
     HOST="0.0.0.0"
     WC_PORT=args.wc_port[0]
     WS_PORT=args.ws_port[0]
@@ -182,36 +325,94 @@ if __name__ == "__main__":
         ADVERTISE_HOST=args.advertise_addr[0]
         CII_REWRITE_PROPS=[]
 
-    WebSocketPlugin(cherrypy.engine).subscribe()
-
-    cherrypy.config.update({"server.socket_host":HOST})
-    cherrypy.config.update({"server.socket_port":WS_PORT})
-    cherrypy.config.update({"engine.autoreload.on":False})
-
-    wallClock= SysClock(tickRate=1000000000)
-    precision = measurePrecision(wallClock,20)  # reduced iterations because on Windows the normal clock is low precision
+    if args.relay_from is None:
+        wallClock= SysClock(tickRate=1000000000)
+        precision = measurePrecision(wallClock,20)  # reduced iterations because on Windows the normal clock is low precision
+    else:
+        # adjusted to follow the wall clock of the upstream proxy, so the precision reported includes its error
+        wallClock= TunableClock(SysClock(tickRate=1000000000), tickRate=1000000000)
+        upstreamClock = UpstreamWallClock(wallClock)
+        precision = upstreamClock.precision
     maxFreqError = 500
-    wcServer = WallClockServer(wallClock, precision, maxFreqError, bindaddr=HOST, bindport=WC_PORT)
+    if args.wc_workers > 0:
+        wcServer = WallClockWorkers(args.wc_workers, lambda : BatchedWallClockServer(wallClock, precision, maxFreqError, bindaddr=HOST, bindport=WC_PORT, reusePort=True, kernelTimestamps=args.wc_kernel_timestamps))
+    elif args.wc_batched or args.wc_kernel_timestamps:
+        wcServer = BatchedWallClockServer(wallClock, precision, maxFreqError, bindaddr=HOST, bindport=WC_PORT, kernelTimestamps=args.wc_kernel_timestamps)
+    else:
+        wcServer = WallClockServer(wallClock, precision, maxFreqError, bindaddr=HOST, bindport=WC_PORT)
     wcWsServer = WebSocketWallClock_ServerEndpoint(wallClock, precision, maxFreqError)
-    
-    ciiServer = BlockableCIIServer(maxConnectionsAllowed=-1, enabled=False, rewriteHostPort=CII_REWRITE_PROPS)
-    tsServer  = TSServer(None, wallClock, maxConnectionsAllowed=-1, enabled=False)
 
-    proxyUrl = "ws://"+HOST+":"+str(WS_PORT)+"/server"
-    ciiBoundUrl = "ws://"+HOST+":"+str(WS_PORT)+"/cii"
-    ciiUrl = "ws://"+ADVERTISE_HOST+":"+str(WS_PORT)+"/cii"
-    tsUrl = "ws://"+ADVERTISE_HOST+":"+str(WS_PORT)+"/ts"
+    if args.relay_from is not None:
+        def updatePrecision(precision):
+            if isinstance(wcServer, WallClockServer):
+                wcServer.handler.precision = precision
+            else:
+                wcServer.precision = precision
+            wcWsServer.precision = precision
+        upstreamClock.onPrecisionChanged = updatePrecision
+
+    # worker processes are forked, so must be started before the log, recorder
+    # and send queue writer threads (or any other thread) are started
+    if args.wc_workers > 0:
+        wcServer.start()
+
+    logHandler = ProxyLogging.configure(args.loglevel[0], args.log_sample)
+    
+    proxyUrl = "ws://"+HOST+":"+str(WS_PORT)+"/server[/<session>]"
+    ciiBoundUrl = "ws://"+HOST+":"+str(WS_PORT)+"/cii[/<session>]"
+    ciiUrl = "ws://"+ADVERTISE_HOST+":"+str(WS_PORT)+"/cii[/<session>]"
+    tsUrl = "ws://"+ADVERTISE_HOST+":"+str(WS_PORT)+"/ts[/<session>]"
 
     if args.use_wswc:
         wcUrl = "ws://"+ADVERTISE_HOST+":"+str(WS_PORT)+"/wcws"
     else:
         wcUrl = "udp://"+ADVERTISE_HOST+":"+str(WC_PORT)
     
-    proxyEngine = CssProxyEngine(ciiServer, tsServer, ciiUrl, tsUrl, wcUrl)
+    if args.trace_capacity > 0:
+        tracer = ProxyTracer(args.trace_capacity)
+    else:
+        tracer = None
+
+    if args.record_file is not None:
+        recorder = ProxyRecorder(open(args.record_file, "ab"))
+    else:
+        recorder = None
+
+    if args.send_writers > 0:
+        sendQueues = ProxySendQueues(args.send_writers, args.send_queue_capacity, args.max_send_lag_ms / 1000.0)
+    else:
+        sendQueues = None
+
+    def dumpTraces():
+        if tracer is None:
+            return "[]"
+        return json.dumps(tracer.dump())
+
+    sessions = ProxySessionRegistry(wallClock, "ws://"+ADVERTISE_HOST+":"+str(WS_PORT), wcUrl, rewriteHostPort=CII_REWRITE_PROPS, tsTolerance=args.ts_tolerance_ms / 1000.0, tsLinger=args.ts_linger_ms / 1000.0, tsUnavailableTtl=args.ts_unavailable_ttl_ms / 1000.0, coalesceWindow=args.coalesce_window_ms / 1000.0, browserBatchWindow=args.browser_batch_window_ms / 1000.0, tracer=tracer, recorder=recorder, sendQueues=sendQueues)
+
+    if args.relay_from is not None:
+        upstreamFeed = UpstreamFeed(args.relay_from)
+        def followWallClock(wcUrl):
+            try:
+                upstreamClock.follow(wcUrl)
+            except ValueError, e:
+                logging.getLogger("main").error("Cannot follow upstream wall clock: %s", e)
+        upstreamFeed.onWallClockUrlChanged = followWallClock
+        sessions.createSession("", serverEndpoint=upstreamFeed)
+    else:
+        upstreamFeed = None
+
+    for endpoint in ["server", "cii", "ts"]:
+        ProxyMetrics.REGISTRY.gauge("dvbcss_proxy_connections", "Connections currently open, by endpoint.", lambda endpoint=endpoint: sessions.connectionCounts()[endpoint], endpoint=endpoint)
+    ProxyMetrics.REGISTRY.gauge("dvbcss_proxy_connections", "Connections currently open, by endpoint.", lambda : len(wcWsServer.server.getConnections()), endpoint="wcws")
+    ProxyMetrics.REGISTRY.gauge("dvbcss_proxy_sessions", "Sessions (TVs in browsers) currently known to the proxy.", lambda : len(sessions.sessions))
 
     print
     print "--------------------------------------------------------------------------"
-    print "Proxying server : "+proxyUrl
+    if upstreamFeed is None:
+        print "Proxying server : "+proxyUrl
+    else:
+        print "Relaying from   : "+args.relay_from
 
     print "CII Server at   : "+ciiBoundUrl
     print "  ... to be advertised as being at   : "+ciiUrl
@@ -219,55 +420,97 @@ if __name__ == "__main__":
     print "                  and a WC Server at : "+wcUrl
     if args.advertise_addr is None:
         print "(where {{host}} is the host address/name from which the client makes contact)"
+    print "(where <session> identifies the TV in a browser, and is omitted for the default session)"
+    print "Metrics at      : http://"+HOST+":"+str(WS_PORT)+"/metrics"
+    if tracer is not None:
+        print "Traces at       : http://"+HOST+":"+str(WS_PORT)+"/traces"
     print "--------------------------------------------------------------------------"
     print
+    sys.stdout.flush()
     
-    class Root(object):
-        @cherrypy.expose
-        def cii(self):
-            pass
-        
-        @cherrypy.expose
-        def ts(self):
-            pass
+    if args.runtime == "cherrypy":
+        WebSocketPlugin(cherrypy.engine).subscribe()
+
+        cherrypy.config.update({"server.socket_host":HOST})
+        cherrypy.config.update({"server.socket_port":WS_PORT})
+        cherrypy.config.update({"engine.autoreload.on":False})
+
+        class Root(object):
+            @cherrypy.expose
+            def cii(self, session=None):
+                pass
             
-        @cherrypy.expose
-        def wcws(self):
-            pass
-    
-        @cherrypy.expose
-        def server(self):
-            if cherrypy.request.remote.ip not in SERVER_LISTEN_ON:
-                raise cherrypy.NotFound()
-            else:
+            @cherrypy.expose
+            def ts(self, session=None):
+                pass
+                
+            @cherrypy.expose
+            def wcws(self):
                 pass
         
+            @cherrypy.expose
+            def server(self, session=None):
+                pass
+                
+            @cherrypy.expose
+            def metrics(self):
+                cherrypy.response.headers["Content-Type"] = ProxyMetrics.CONTENT_TYPE
+                return ProxyMetrics.REGISTRY.expose()
+                
+            @cherrypy.expose
+            def traces(self):
+                cherrypy.response.headers["Content-Type"] = "application/json"
+                return dumpTraces()
+            
+        
+        cherrypy.tree.mount(Root(), "/", config={"/cii": {'tools.css_session.on': True,
+                                                          'tools.css_session.registry': sessions},
+                                                 
+                                                 "/ts":  {'tools.css_session.on': True,
+                                                          'tools.css_session.registry': sessions},
+                                                          
+                                                 "/wcws": {'tools.wcws.on' : True,
+                                                           'tools.wcws.handler_cls': wcWsServer.server.handler},
+                                                          
+                                                 "/server": {'tools.css_session.on' : upstreamFeed is None,
+                                                             'tools.css_session.registry': sessions,
+                                                             'tools.css_session.allowedAddrs': SERVER_LISTEN_ON}
+                                                })
+        startWebServer = cherrypy.engine.start
+        stopWebServer = cherrypy.engine.exit
+
+    else:
+        eventLoopServer = EventLoopServer(HOST, WS_PORT)
+        eventLoopServer.mountResolver("/cii", sessions.handlerForPath)
+        eventLoopServer.mountResolver("/ts", sessions.handlerForPath)
+        eventLoopServer.mount("/wcws", wcWsServer.server.handler)
+        if upstreamFeed is None:
+            eventLoopServer.mountResolver("/server", lambda path, remoteAddr: sessions.handlerForPath(path, remoteAddr, SERVER_LISTEN_ON))
+        eventLoopServer.mountPage("/metrics", ProxyMetrics.REGISTRY.expose, ProxyMetrics.CONTENT_TYPE)
+        eventLoopServer.mountPage("/traces", dumpTraces, "application/json")
+        startWebServer = eventLoopServer.start
+        stopWebServer = eventLoopServer.stop
+
+    if args.wc_workers == 0:
+        wcServer.start()
     
-    cherrypy.tree.mount(Root(), "/", config={"/cii": {'tools.dvb_cii.on': True,
-                                                      'tools.dvb_cii.handler_cls': ciiServer.handler},
-                                             
-                                             "/ts":  {'tools.dvb_ts.on': True,
-                                                      'tools.dvb_ts.handler_cls': tsServer.handler},
-                                                      
-                                             "/wcws": {'tools.wcws.on' : True,
-                                                       'tools.wcws.handler_cls': wcWsServer.server.handler},
-                                                      
-                                             "/server": {'tools.css_proxy.on' : True,
-                                                         'tools.css_proxy.handler_cls': proxyEngine.serverEndpoint._server.handler} 
-                                            })
-
-    wcServer.start()
-    
-    cherrypy.engine.start()
+    startWebServer()
+
+    if upstreamFeed is not None:
+        upstreamFeed.enabled = True
 
     try:
         while True:
             time.sleep(0.1)
-            sys.stdout.flush()
-            sys.stderr.flush()
 
     except KeyboardInterrupt:
         pass
     finally:
-        cherrypy.engine.exit()
+        if upstreamFeed is not None:
+            upstreamFeed.enabled = False
+            upstreamClock.stop()
+        stopWebServer()
         wcServer.stop()
+        if recorder is not None:
+            recorder.close()
+        logHandler.close()
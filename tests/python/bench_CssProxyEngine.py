@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""\
+Microbenchmarks of the cost of handling a message from the browser in
+CssProxyEngine: from the server endpoint receiving it, through updating CII
+and the timelines, to sending the Control Timestamps to every TS client.
+
+Runs without sockets, using the mocks used by the unit tests for the browser
+connection and the CII server, and a real ProxyTSServer with mock client
+connections. Scenarios vary the number of timelines updated per message, the
+size of the CII, and the number of TS clients (spread evenly across the
+timelines).
+
+Run from this directory:
+
+    $ python bench_CssProxyEngine.py                # just report
+    $ python bench_CssProxyEngine.py --save         # report, and store as the baseline
+    $ python bench_CssProxyEngine.py --compare      # report, and compare against the baseline
+
+When comparing, any scenario that is slower than the baseline by more than
+the threshold (default 20%) is flagged and the exit status is 1. The baseline
+is stored in bench_CssProxyEngine_baseline.json alongside this script. As
+timings depend on the machine, save a new baseline before making changes.
+"""
+
+import argparse
+import json
+import os
+import timeit
+
+import sys
+sys.path.append("../../src/python")
+from CssProxyEngine import CssProxyEngine, ProxyTSServer
+
+from dvbcss.clock import SysClock
+
+from mock_ciiServer import MockCiiServer
+from mock_wsServerBase import MockWSServerBase, Mock_WebSock
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_CssProxyEngine_baseline.json")
+
+SCENARIOS = [
+    # (timelines, CII size, TS clients)
+    (1, "small", 1),
+    (1, "small", 100),
+    (1, "large", 100),
+    (8, "small", 8),
+    (8, "small", 800),
+    (8, "large", 800),
+]
+
+
+def makeCii(size, timelineSelectors):
+    cii = {
+        "contentId" : "dvb://233a.1004.1080;21af~20131004T1015Z--PT01H00M",
+        "contentIdStatus" : "final",
+        "presentationStatus" : "okay",
+    }
+    if size == "large":
+        cii["timelines"] = [ { "timelineSelector" : sel, "timelineProperties" : { "unitsPerTick" : 1, "unitsPerSecond" : 1000 } } for sel in timelineSelectors ]
+        cii["private"] = [ { "type" : "urn:flurble:%d" % i, "value" : "x" * 64 } for i in range(0, 16) ]
+        cii["mrsUrl"] = "http://mrs.example.com/path/to/mrs"
+    return cii
+
+
+class Scenario(object):
+    def __init__(self, numTimelines, ciiSize, numClients):
+        self.name = "%d timeline(s), %s CII, %d TS client(s)" % (numTimelines, ciiSize, numClients)
+        self.selectors = [ "urn:dvb:css:timeline:temi:1:%d" % i for i in range(0, numTimelines) ]
+        self.ciiSize = ciiSize
+
+        CssProxyEngine.Server.ServerBase = self._serverBaseFactory
+        self.ciiServer = MockCiiServer()
+        self.tsServer = ProxyTSServer(None, SysClock(), maxConnectionsAllowed=-1, enabled=False)
+        self.engine = CssProxyEngine(self.ciiServer, self.tsServer, "ws://proxy/cii", "ws://proxy/ts", "udp://proxy:6677")
+        self.browser.mock_clientConnects()
+
+        self.clients = []
+        for i in range(0, numClients):
+            webSock = Mock_WebSock()
+            self.tsServer._addConnection(webSock)
+            self.tsServer._receivedMessage(webSock, json.dumps({ "contentIdStem" : "", "timelineSelector" : self.selectors[i % numTimelines] }))
+            self.clients.append(webSock)
+
+        self.ciiStruct = makeCii(ciiSize, self.selectors)
+        self.seq = 0
+        self.handleMessage()
+
+    def _serverBaseFactory(self, *args, **kwargs):
+        self.browser = MockWSServerBase(*args, **kwargs)
+        return self.browser
+
+    def handleMessage(self):
+        # each message moves every timeline to a new position, so every client is sent an update
+        self.seq += 1
+        msg = { "cii" : self.ciiStruct, "controlTimestamps" : {} }
+        for sel in self.selectors:
+            msg["controlTimestamps"][sel] = { "contentTime" : str(self.seq * 1000), "wallClockTime" : str(self.seq), "timelineSpeedMultiplier" : 1.0 }
+        self.browser.mock_clientSendsMessage(json.dumps(msg))
+        for webSock in self.clients:
+            webSock.mock_popReceivedMessages()
+
+    def cleanup(self):
+        self.tsServer.enabled = False
+
+
+def timePerMessage(scenario, iterations):
+    """\
+    :returns: Best time (in microseconds) per message, from several repeats.
+    """
+    timer = timeit.Timer(scenario.handleMessage)
+    return min(timer.repeat(repeat=5, number=iterations)) / iterations * 1000000
+
+
+def runAll(iterations):
+    """\
+    :returns: list of tuples (scenario name, microseconds per message)
+    """
+    results = []
+    origServerBase = CssProxyEngine.Server.ServerBase
+    stdout = sys.stdout
+    devnull = open(os.devnull, "w")
+    try:
+        for params in SCENARIOS:
+            sys.stdout = devnull     # the endpoint prints every message received
+            scenario = Scenario(*params)
+            try:
+                results.append((scenario.name, timePerMessage(scenario, iterations)))
+            finally:
+                scenario.cleanup()
+                sys.stdout = stdout
+    finally:
+        CssProxyEngine.Server.ServerBase = origServerBase
+        devnull.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks of CssProxyEngine handling messages from the browser.")
+    parser.add_argument("--iterations", type=int, default=200, help="Messages handled per repeat. Default=200.")
+    parser.add_argument("--save", action="store_true", default=False, help="Store the results as the baseline.")
+    parser.add_argument("--compare", action="store_true", default=False, help="Compare the results against the baseline.")
+    parser.add_argument("--threshold", type=float, default=20.0, help="Percentage slow-down, compared to the baseline, flagged as a regression. Default=20.")
+    args = parser.parse_args()
+
+    results = runAll(args.iterations)
+
+    baseline = {}
+    if args.compare:
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+
+    regressions = 0
+    for name, micros in results:
+        line = "%-45s : %10.1f us per message" % (name, micros)
+        if name in baseline:
+            change = (micros / baseline[name] - 1.0) * 100
+            line += "   (baseline %10.1f us, %+6.1f%%)" % (baseline[name], change)
+            if change > args.threshold:
+                line += "  REGRESSION"
+                regressions += 1
+        elif args.compare:
+            line += "   (not in baseline)"
+        print line
+
+    if args.save:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(dict(results), f, indent=4, sort_keys=True)
+        print "Baseline saved to", BASELINE_FILE
+
+    if regressions:
+        print "%d scenario(s) slower than the baseline by more than %.0f%%" % (regressions, args.threshold)
+        sys.exit(1)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""\
+Benchmark of the cost of decoding a message received from the browser by
+the server/proxy interface, comparing the original decoding (re-serialising
+each part of the message to JSON and unpacking it again) with decoding
+directly from the parsed message.
+
+Run from this directory:
+
+    $ python bench_decode.py [--iterations N] [--timelines N]
+"""
+
+import argparse
+import json
+import timeit
+
+import sys
+sys.path.append("../../src/python")
+from CssProxy_ServerEndpoint import decodeCii, decodeControlTimestamp, messagePayload
+
+from dvbcss.protocol.cii import CII
+from dvbcss.protocol.ts import ControlTimestamp
+
+from ws4py.messaging import TextMessage
+
+
+def makeMessage(numTimelines):
+    msg = {
+        "cii" : {
+            "contentId" : "dvb://233a.1004.1080;21af~20131004T1015Z--PT01H00M",
+            "contentIdStatus" : "final",
+            "presentationStatus" : "okay",
+        },
+        "controlTimestamps" : {},
+        "options" : { "blockCii" : False }
+    }
+    for i in range(0, numTimelines):
+        msg["controlTimestamps"]["urn:dvb:css:timeline:temi:1:%d" % i] = {
+            "contentTime" : "93824762",
+            "wallClockTime" : "13184637468146",
+            "timelineSpeedMultiplier" : 1.0
+        }
+    return TextMessage(json.dumps(msg))
+
+
+def decodeViaReserialising(message):
+    msg = json.loads(str(message))
+    cii = CII.unpack(json.dumps(msg["cii"]))
+    controlTimestamps = {}
+    for timelineSelector, recvControlTimestamp in msg["controlTimestamps"].items():
+        controlTimestamps[timelineSelector] = ControlTimestamp.unpack(json.dumps(recvControlTimestamp))
+    return cii, controlTimestamps
+
+
+def decodeDirectly(message):
+    msg = json.loads(messagePayload(message))
+    cii = decodeCii(msg["cii"])
+    controlTimestamps = {}
+    for timelineSelector, recvControlTimestamp in msg["controlTimestamps"].items():
+        controlTimestamps[timelineSelector] = decodeControlTimestamp(recvControlTimestamp)
+    return cii, controlTimestamps
+
+
+def timePerMessage(func, message, iterations):
+    """\
+    :returns: Best time (in microseconds) per message, from several repeats.
+    """
+    timer = timeit.Timer(lambda : func(message))
+    return min(timer.repeat(repeat=5, number=iterations)) / iterations * 1000000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark decoding of messages from the browser.")
+    parser.add_argument("--iterations", type=int, default=10000, help="Number of messages decoded per repeat. Default=10000.")
+    parser.add_argument("--timelines", type=int, default=1, help="Number of Control Timestamps in each message. Default=1.")
+    args = parser.parse_args()
+
+    message = makeMessage(args.timelines)
+    before = timePerMessage(decodeViaReserialising, message, args.iterations)
+    after = timePerMessage(decodeDirectly, message, args.iterations)
+
+    print "Message with %d control timestamp(s), %d bytes" % (args.timelines, len(str(message)))
+    print "  re-serialising : %8.2f us per message" % before
+    print "  direct         : %8.2f us per message" % after
+    print "  speed-up       : %8.2fx" % (before / after)
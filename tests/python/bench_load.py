@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""\
+Load test for the proxy server. Launches a proxy server (main.py) in a
+separate process, then connects to it a scripted stand-in for the TV in a
+browser and many simulated companions, all on a single gevent event loop in
+this process.
+
+The stand-in browser connects to /server, supplies CII, and then supplies a
+new Control Timestamp for the PTS timeline at the requested rate. Each
+Control Timestamp is a jump in the timeline, so the proxy relays every one.
+
+Each simulated companion connects to /cii and /ts (asking for the PTS
+timeline) and sends wall clock requests (UDP, or WebSocket if
+--ws-wallclock) at the requested rate.
+
+Reported at the end:
+ * throughput of TS messages received by companions, and wall clock responses
+ * fan-out latency percentiles: the time from the browser sending a Control
+   Timestamp to the last companion receiving it
+ * CPU usage and resident memory (RSS) of the proxy server process
+
+Requires gevent. Run from this directory:
+
+    $ python bench_load.py --companions 1000 --update-rate 10
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import gevent
+import gevent.event
+from ws4py.client.geventclient import WebSocketClient
+
+sys.path.append("../../src/python")
+from dvbcss.protocol.wc import WCMessage
+
+logging.getLogger("ws4py").addHandler(logging.NullHandler())
+
+
+PTS = "urn:dvb:css:timeline:pts"
+CONTENT_ID = "dvb://233a.1004.1080"
+MAIN_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "python", "main.py")
+
+
+class Stats(object):
+    def __init__(self):
+        self.sendTimes = {}         # maps update sequence number to time the browser sent it
+        self.lastReceipt = {}       # maps update sequence number to time the last companion received it
+        self.receiptCount = {}      # maps update sequence number to number of companions that have received it
+        self.tsMessages = 0
+        self.ciiMessages = 0
+        self.wcResponses = 0
+        self.errors = 0
+        self.companionsReady = 0
+
+    def received(self, seq):
+        now = time.time()
+        self.tsMessages += 1
+        if seq in self.sendTimes:
+            self.lastReceipt[seq] = now
+            self.receiptCount[seq] = self.receiptCount.get(seq, 0) + 1
+
+
+class Client(WebSocketClient):
+    """WebSocket client that passes each message straight to a callback"""
+    def __init__(self, url, onMessage):
+        WebSocketClient.__init__(self, url)
+        self.onMessage = onMessage
+
+    def received_message(self, message):
+        self.onMessage(str(message))
+
+
+def browser(baseUrl, updateRate, duration, stats, ready):
+    """Stand-in for the TV in a browser. Sends a new Control Timestamp updateRate times a second."""
+    wanted = []
+    def onMessage(payload):
+        msg = json.loads(payload)
+        wanted.extend(msg.get("add_timelineSelectors", []))
+    ws = Client(baseUrl + "/server", onMessage)
+    ws.connect()
+    ws.send(json.dumps({ "cii" : {
+        "contentId" : CONTENT_ID, "contentIdStatus" : "final", "presentationStatus" : "okay",
+        "timelines" : [ { "timelineSelector" : PTS, "timelineProperties" : { "unitsPerTick" : 1, "unitsPerSecond" : 90000 } } ]
+    } }))
+    ready.wait()
+
+    seq = 1
+    end = time.time() + duration
+    while time.time() < end:
+        now = time.time()
+        stats.sendTimes[seq] = now
+        # content time encodes the sequence number, and jumps each time so is always relayed
+        ws.send(json.dumps({ "controlTimestamps" : { PTS : {
+            "contentTime" : str(seq * 1000000), "wallClockTime" : str(int(now * 1000000000)), "timelineSpeedMultiplier" : 1.0
+        } } }))
+        seq += 1
+        gevent.sleep(max(0, 1.0 / updateRate - (time.time() - now)))
+    ws.close()
+
+
+def companion(baseUrl, wcAddr, wsWallClock, wcRate, stats, stop):
+    """Simulated companion: connects to CII and TS, and makes wall clock requests."""
+    def onCii(payload):
+        stats.ciiMessages += 1
+
+    def onTs(payload):
+        contentTime = json.loads(payload)["contentTime"]
+        if contentTime is not None:
+            stats.received(int(contentTime) // 1000000)
+
+    def onWc(payload):
+        stats.wcResponses += 1
+
+    try:
+        cii = Client(baseUrl + "/cii", onCii)
+        cii.connect()
+        ts = Client(baseUrl + "/ts", onTs)
+        ts.connect()
+        ts.send(json.dumps({ "contentIdStem" : "", "timelineSelector" : PTS }))
+        if wsWallClock:
+            wc = Client(baseUrl + "/wcws", onWc)
+            wc.connect()
+        else:
+            wc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            wc.settimeout(1.0)
+    except Exception:
+        stats.errors += 1
+        return
+    stats.companionsReady += 1
+
+    request = WCMessage(WCMessage.TYPE_REQUEST, 0, 0, 0, 0, 0)
+    while not stop.is_set():
+        if wsWallClock:
+            wc.send(json.dumps({ "ot" : time.time() }))
+        else:
+            request.originateNanos = int(time.time() * 1000000000)
+            wc.sendto(request.pack(), wcAddr)
+            try:
+                wc.recv(100)
+                stats.wcResponses += 1
+            except socket.timeout:
+                pass
+        stop.wait(1.0 / wcRate)
+
+    for ws in (cii, ts):
+        ws.close()
+    wc.close()
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def cpuSeconds(pid):
+    """:returns: user + system CPU time (seconds) used by the process, or None if not known"""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def rssBytes(pid):
+    """:returns: resident memory (bytes) of the process, or None if not known"""
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def waitForPort(port, timeout=10.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.5).close()
+            return
+        except socket.error:
+            gevent.sleep(0.1)
+    raise RuntimeError("Proxy server did not start listening on port %d" % port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the proxy server with many simulated companions.")
+    parser.add_argument("--companions", type=int, default=100, help="Number of simulated companions. Default=100.")
+    parser.add_argument("--update-rate", type=float, default=10.0, help="Control Timestamp updates per second sent by the browser. Default=10.")
+    parser.add_argument("--wc-rate", type=float, default=1.0, help="Wall clock requests per second sent by each companion. Default=1.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Duration (seconds) of the measurement, once all companions are connected. Default=10.")
+    parser.add_argument("--ws-wallclock", action="store_true", default=False, help="Companions use the WebSocket wall clock instead of UDP.")
+    parser.add_argument("--ws-port", type=int, default=17681, help="Port for the proxy's WebSocket server. Default=17681.")
+    parser.add_argument("--wc-port", type=int, default=16677, help="Port for the proxy's UDP wall clock server. Default=16677.")
+    parser.add_argument("proxyArgs", nargs=argparse.REMAINDER, help="Any further arguments (after --) are passed to the proxy server, e.g. -- --runtime eventloop")
+    args = parser.parse_args()
+
+    proxyArgs = [ a for a in args.proxyArgs if a != "--" ]
+    if args.ws_wallclock:
+        proxyArgs.append("--ws")
+    cmd = [ sys.executable, MAIN_PY, "--ws_port", str(args.ws_port), "--wc_port", str(args.wc_port) ] + proxyArgs
+    devnull = open(os.devnull, "w")
+    proxy = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+    try:
+        waitForPort(args.ws_port)
+        baseUrl = "ws://127.0.0.1:%d" % args.ws_port
+        wcAddr = ("127.0.0.1", args.wc_port)
+
+        stats = Stats()
+        ready = gevent.event.Event()
+        stop = gevent.event.Event()
+
+        browserGreenlet = gevent.spawn(browser, baseUrl, args.update_rate, args.duration, stats, ready)
+        gevent.sleep(0.5)
+        connectStart = time.time()
+        companions = [ gevent.spawn(companion, baseUrl, wcAddr, args.ws_wallclock, args.wc_rate, stats, stop) for i in range(0, args.companions) ]
+        while stats.companionsReady + stats.errors < args.companions and time.time() - connectStart < 60:
+            gevent.sleep(0.1)
+        connectDuration = time.time() - connectStart
+
+        cpuBefore = cpuSeconds(proxy.pid)
+        measureStart = time.time()
+        tsBefore, wcBefore = stats.tsMessages, stats.wcResponses
+        ready.set()
+        browserGreenlet.join()
+        gevent.sleep(1.0)   # allow the last updates to arrive
+        measureDuration = time.time() - measureStart
+        cpuAfter = cpuSeconds(proxy.pid)
+        rss = rssBytes(proxy.pid)
+        tsCount, wcCount = stats.tsMessages - tsBefore, stats.wcResponses - wcBefore
+
+        stop.set()
+        gevent.joinall(companions, timeout=5)
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+    latencies = [ (stats.lastReceipt[seq] - stats.sendTimes[seq]) * 1000 for seq in stats.lastReceipt ]
+    complete = sum(1 for seq in stats.sendTimes if stats.receiptCount.get(seq, 0) >= stats.companionsReady)
+
+    print "Companions connected  : %d of %d in %.1f s (%d failed)" % (stats.companionsReady, args.companions, connectDuration, stats.errors)
+    print "Updates sent          : %d (%.1f per second), %d reached every companion" % (len(stats.sendTimes), args.update_rate, complete)
+    print "TS messages received  : %10.0f per second" % (tsCount / measureDuration)
+    print "WC responses received : %10.0f per second" % (wcCount / measureDuration)
+    print "Fan-out latency (ms)  : p50 %.1f  p90 %.1f  p99 %.1f  max %.1f" % (
+        percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99), max(latencies or [float("nan")]))
+    if cpuBefore is not None and cpuAfter is not None:
+        print "Proxy CPU             : %10.1f %%" % ((cpuAfter - cpuBefore) / measureDuration * 100)
+    else:
+        print "Proxy CPU             :        n/a"
+    if rss is not None:
+        print "Proxy RSS             : %10.1f MB" % (rss / 1048576.0)
+    else:
+        print "Proxy RSS             :        n/a"
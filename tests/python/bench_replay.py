@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""\
+Replays a recording of the server/proxy interface (made by running main.py
+with --record) into a CssProxyEngine, to measure how it copes with real
+traffic from a browser.
+
+Runs without sockets, using the mock CII server and browser connection used
+by the unit tests, and a real ProxyTSServer with mock client connections.
+The TS clients are spread evenly across the timelines that appear in the
+recording.
+
+Run from this directory:
+
+    $ python bench_replay.py session.rec                    # replay at recorded speed
+    $ python bench_replay.py session.rec --speed 10         # 10x recorded speed
+    $ python bench_replay.py session.rec --speed 0          # as fast as possible
+    $ python bench_replay.py session.rec --ts-clients 1000 --session lounge-tv
+
+Reported at the end are the number of messages replayed, the time taken, the
+number of Control Timestamps sent to TS clients, and percentiles of the time
+taken to apply each update.
+"""
+
+import argparse
+import json
+
+import sys
+sys.path.append("../../src/python")
+from CssProxyEngine import CssProxyEngine, ProxyTSServer
+from ProxyRecorder import ProxyReplayer, readRecording, RECEIVED
+
+from dvbcss.clock import SysClock
+
+from mock_ciiServer import MockCiiServer
+from mock_wsServerBase import MockWSServerBase, Mock_WebSock
+
+
+def timelineSelectorsIn(entries):
+    """\
+    :returns: sorted list of the timeline selectors for which the browser supplied Control Timestamps in JSON messages.
+    """
+    selectors = set()
+    for entry in entries:
+        if entry.kind == RECEIVED and not entry.binary:
+            selectors.update(json.loads(entry.payload).get("controlTimestamps", {}).keys())
+    return sorted(selectors)
+
+
+class TimedEngine(CssProxyEngine):
+    """\
+    CssProxyEngine that also keeps the time taken to apply each update, so percentiles can be reported.
+    """
+    def __init__(self, *args, **kwargs):
+        self.updateTimes = []
+        super(TimedEngine,self).__init__(*args, **kwargs)
+
+    def _applyUpdate(self, cii, controlTimestamps, options):
+        start = ProxyReplayer.time()
+        super(TimedEngine,self)._applyUpdate(cii, controlTimestamps, options)
+        self.updateTimes.append(ProxyReplayer.time() - start)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recording of the server/proxy interface into a CssProxyEngine.")
+    parser.add_argument("recording", help="File recorded by main.py --record.")
+    parser.add_argument("--session", default="", help="ID of the session to replay. Default is the default session.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Multiple of the recorded speed to replay at. 0 means as fast as possible. Default=1.")
+    parser.add_argument("--ts-clients", dest="ts_clients", type=int, default=100, help="Number of simulated TS clients. Default=100.")
+    parser.add_argument("--coalesce-window", dest="coalesce_window_ms", type=float, default=0.0, help="Coalescing window (in milliseconds) for the engine. Default=0.")
+    args = parser.parse_args()
+
+    with open(args.recording) as f:
+        entries = readRecording(f, args.session)
+    if not entries:
+        sys.stderr.write("No events for session %r in the recording\n" % args.session)
+        sys.exit(1)
+
+    CssProxyEngine.Server.ServerBase = MockWSServerBase
+    ciiServer = MockCiiServer()
+    tsServer = ProxyTSServer(None, SysClock(), maxConnectionsAllowed=-1, enabled=False)
+    engine = TimedEngine(ciiServer, tsServer, "ws://proxy/cii", "ws://proxy/ts", "udp://proxy:6677", coalesceWindow=args.coalesce_window_ms / 1000.0)
+
+    selectors = timelineSelectorsIn(entries) or [ "urn:dvb:css:timeline:pts" ]
+    clients = []
+    for i in range(0, args.ts_clients):
+        webSock = Mock_WebSock()
+        tsServer._addConnection(webSock)
+        tsServer._receivedMessage(webSock, json.dumps({ "contentIdStem" : "", "timelineSelector" : selectors[i % len(selectors)] }))
+        clients.append(webSock)
+
+    replayer = ProxyReplayer(engine, entries, speed=args.speed)
+    replayer.run()
+    tsServer.enabled = False
+
+    tsSent = sum(len(webSock.mock_popReceivedMessages()) for webSock in clients)
+    times = [ t * 1000000 for t in engine.updateTimes ]
+    print "Replayed %d message(s) in %.3f s (%d TS client(s), %d timeline(s))" % (replayer.messagesReplayed, replayer.duration, args.ts_clients, len(selectors))
+    print "Messages sent to the browser   : %d" % replayer.messagesSent
+    print "Messages sent to TS clients    : %d" % tsSent
+    print "Updates applied                : %d" % len(times)
+    print "Time to apply update (us)      : p50 %.1f   p90 %.1f   p99 %.1f   max %.1f" % (percentile(times, 50), percentile(times, 90), percentile(times, 99), max(times or [0]))
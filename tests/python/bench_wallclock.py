@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""\
+Benchmark of the throughput of UDP wall clock servers, comparing pydvbcss's
+WallClockServer with the BatchedWallClockServer (using recvmmsg/sendmmsg if
+available, and using the portable fallback).
+
+Several client processes each keep a window of requests outstanding against
+a server on the loopback interface, and the responses per second received
+are reported.
+
+Run from this directory:
+
+    $ python bench_wallclock.py [--clients N] [--window N] [--duration SECS]
+"""
+
+import argparse
+import multiprocessing
+import socket
+import time
+
+import sys
+sys.path.append("../../src/python")
+import BatchedWallClockServer as BWCS
+from BatchedWallClockServer import BatchedWallClockServer
+
+from dvbcss.clock import SysClock
+from dvbcss.protocol.server.wc import WallClockServer
+from dvbcss.protocol.wc import WCMessage
+
+
+def runClient(serverAddr, window, duration, results):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(0.1)
+    request = WCMessage(WCMessage.TYPE_REQUEST, 0, 0, 0, 0, 0).pack()
+    for i in range(0, window):
+        s.sendto(request, serverAddr)
+    received = 0
+    end = time.time() + duration
+    while time.time() < end:
+        try:
+            s.recv(100)
+            received += 1
+        except socket.timeout:
+            # replace requests or responses that were lost
+            for i in range(0, window):
+                s.sendto(request, serverAddr)
+            continue
+        s.sendto(request, serverAddr)
+    results.put(received)
+
+
+def measure(server, serverAddr, numClients, window, duration):
+    """\
+    :returns: Responses per second received by the clients
+    """
+    server.start()
+    try:
+        results = multiprocessing.Queue()
+        clients = [ multiprocessing.Process(target=runClient, args=(serverAddr, window, duration, results)) for i in range(0, numClients) ]
+        for client in clients:
+            client.start()
+        total = sum(results.get() for client in clients)
+        for client in clients:
+            client.join()
+    finally:
+        server.stop()
+    return total / duration
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark UDP wall clock server throughput.")
+    parser.add_argument("--clients", type=int, default=4, help="Number of client processes. Default=4.")
+    parser.add_argument("--window", type=int, default=16, help="Number of requests each client keeps outstanding. Default=16.")
+    parser.add_argument("--duration", type=float, default=3.0, help="Duration of each measurement in seconds. Default=3.")
+    args = parser.parse_args()
+
+    wallClock = SysClock(tickRate=1000000000)
+    port = 16677
+
+    print "Clients: %d, each with %d requests outstanding" % (args.clients, args.window)
+
+    server = WallClockServer(wallClock, 0.001, 500, bindaddr="127.0.0.1", bindport=port)
+    print "  pydvbcss WallClockServer           : %10.0f responses/sec" % measure(server, ("127.0.0.1", port), args.clients, args.window, args.duration)
+    server.socket.close()
+
+    server = BatchedWallClockServer(wallClock, 0.001, 500, bindaddr="127.0.0.1", bindport=port+1)
+    server._useBatchedCalls = False
+    print "  BatchedWallClockServer (fallback)  : %10.0f responses/sec" % measure(server, ("127.0.0.1", port+1), args.clients, args.window, args.duration)
+
+    if BWCS._BATCHED_CALLS is not None:
+        server = BatchedWallClockServer(wallClock, 0.001, 500, bindaddr="127.0.0.1", bindport=port+2)
+        print "  BatchedWallClockServer (mmsg)      : %10.0f responses/sec" % measure(server, ("127.0.0.1", port+2), args.clients, args.window, args.duration)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#  
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#  
+#     http://www.apache.org/licenses/LICENSE-2.0
+#  
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+class MockTimer(object):
+    """\
+    This is a mock for :class:`threading.Timer`.
+    
+    The timer never fires by itself. Instead the test case fires it by calling
+    :func:`mock_fire`. All timers created are listed in :data:`MockTimer.timers`.
+    """
+    
+    timers = []
+    
+    def __init__(self, interval, function, args=[], kwargs={}):
+        super(MockTimer,self).__init__()
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.daemon = False
+        self.started = False
+        self.cancelled = False
+        MockTimer.timers.append(self)
+        
+    def start(self):
+        self.started = True
+        
+    def cancel(self):
+        self.cancelled = True
+        
+    def mock_isRunning(self):
+        return self.started and not self.cancelled
+        
+    def mock_fire(self):
+        if not self.mock_isRunning():
+            raise RuntimeError("Test Case tried to fire a timer that is not running")
+        self.cancelled = True
+        self.function(*self.args, **self.kwargs)
+        
+    @classmethod
+    def mock_running(cls):
+        """Returns list of timers that are started and not yet fired or cancelled"""
+        return [ timer for timer in cls.timers if timer.mock_isRunning() ]
+        
+    @classmethod
+    def mock_reset(cls):
+        cls.timers = []
@@ -41,6 +41,7 @@ class MockTsServer(object):
         self._timelineSources = []
         self._mostRecentControlTimestamps = {}
         self._neededTimelineSelectors = []
+        self._updatedSelectors = []
         
     @property
     def enabled(self):
@@ -79,6 +80,17 @@ class MockTsServer(object):
             self._mostRecentControlTimestamps[timelineSelector] = ct                
 
 
+    def updateClientsForSelectors(self, timelineSelectors):
+        self._updatedSelectors.extend(timelineSelectors)
+        for timelineSelector in timelineSelectors:
+            if timelineSelector in self._neededTimelineSelectors:
+                ct = ControlTimestamp(Timestamp(None, 0), None)
+                for source in self._timelineSources:
+                    if source.recognisesTimelineSelector(timelineSelector):
+                        ct = source.getControlTimestamp(timelineSelector)
+                self._mostRecentControlTimestamps[timelineSelector] = ct
+
+
     def mock_addTimelineSelector(self, timelineSelector):
         if timelineSelector not in self._neededTimelineSelectors:
             self._neededTimelineSelectors.append(timelineSelector)
@@ -109,4 +121,9 @@ class MockTsServer(object):
         tmp = self._updateAllClientsCalled
         self._updateAllClientsCalled = False
         return tmp
-        
\ No newline at end of file
+
+    def mock_popUpdatedSelectors(self):
+        """Returns list of timeline selectors passed to updateClientsForSelectors since last time this method was called"""
+        tmp = self._updatedSelectors
+        self._updatedSelectors = []
+        return tmp
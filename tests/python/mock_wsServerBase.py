@@ -30,6 +30,7 @@ class MockWSServerBase(object):
         self._enabled = enabled
         self._maxConnectionsAllowed = maxConnectionsAllowed
         self._connections = {}
+        self.handler = type("MockWebSocketHandler", (object,), {})  # unique per instance, like WSServerBase.handler
         
     def getDefaultConnectionData(self):
         return { }
@@ -64,7 +65,7 @@ class MockWSServerBase(object):
     
     def mock_clientConnects(self):
         """Mock interface to represent client connecting. Returns the 'websock' object as the handle"""
-        if len(self._connections) >= self._maxConnectionsAllowed:
+        if self._maxConnectionsAllowed >= 0 and len(self._connections) >= self._maxConnectionsAllowed:
             raise RuntimeError("Test case tried to open more connections than the server allows")
         webSock = Mock_WebSock();
         self._connections[webSock] = self.getDefaultConnectionData()
@@ -102,12 +103,25 @@ class MockWSServerBase(object):
         
 
 class Mock_WebSock(object):
+    nextId = 1
+    
     def __init__(self):
         super(Mock_WebSock,self).__init__()
         self._received = []
+        self.mock_closed = False
+        self.mock_lastSentBinary = False
+        self._id = "mock-" + str(Mock_WebSock.nextId)
+        Mock_WebSock.nextId += 1
+        
+    def id(self):
+        return self._id
         
-    def send(self, message):
+    def send(self, message, binary=False):
         self._received.append(message)
+        self.mock_lastSentBinary = binary
+        
+    def close(self, code=1000, reason=''):
+        self.mock_closed = True
         
     def mock_popReceivedMessages(self):
         tmp = self._received
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import socket
+import time
+
+import sys
+sys.path.append("../../src/python")
+import BatchedWallClockServer as BWCS
+from BatchedWallClockServer import BatchedWallClockServer
+
+from dvbcss.clock import SysClock
+from dvbcss.protocol.wc import WCMessage
+
+
+class Test_BatchedWallClockServer(unittest.TestCase):
+    """Tests of BatchedWallClockServer, using real sockets on the loopback interface"""
+
+    def setUp(self):
+        self.wallClock = SysClock(tickRate=1000000000)
+        self.server = BatchedWallClockServer(self.wallClock, precision=0.001, maxFreqError=500, bindaddr="127.0.0.1", bindport=0, batchSize=8)
+        self.serverAddr = self.server._socket.getsockname()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(0.5)
+
+    def tearDown(self):
+        self.server.stop()
+        self.server._socket.close()
+        self.client.close()
+
+    def _sendRequests(self, num):
+        for i in range(0, num):
+            request = WCMessage(WCMessage.TYPE_REQUEST, 0, 0, 1000000000*i + 5, 0, 0)
+            self.client.sendto(request.pack(), self.serverAddr)
+
+    def _receiveResponses(self):
+        responses = []
+        try:
+            while True:
+                responses.append(WCMessage.unpack(self.client.recv(100)))
+        except socket.timeout:
+            pass
+        return responses
+
+    def _checkResponses(self, num):
+        before = self.wallClock.nanos
+        self._sendRequests(num)
+        self.server.start()
+        responses = self._receiveResponses()
+        after = self.wallClock.nanos
+
+        self.assertEquals(len(responses), num)
+        self.assertEquals(sorted(r.originateNanos for r in responses), [ 1000000000*i + 5 for i in range(0, num) ])
+        for response in responses:
+            self.assertEquals(response.msgtype, WCMessage.TYPE_RESPONSE)
+            self.assertEquals(response.precision, WCMessage.encodePrecision(0.001))
+            self.assertEquals(response.maxFreqError, WCMessage.encodeMaxFreqError(500))
+            self.assertTrue(before <= response.receiveNanos <= response.transmitNanos <= after)
+        self.assertEquals(self.server.responseCount, num)
+
+    @unittest.skipIf(BWCS._BATCHED_CALLS is None, "recvmmsg/sendmmsg not available")
+    def test_respondsUsingBatchedCalls(self):
+        """Every request gets a response, when using recvmmsg/sendmmsg, including when there are more requests than the batch size"""
+        self._checkResponses(20)
+
+    def test_respondsUsingPortableFallback(self):
+        """Every request gets a response, when not using recvmmsg/sendmmsg, including when there are more requests than the batch size"""
+        self.server._useBatchedCalls = False
+        self._checkResponses(20)
+
+    def test_invalidRequestsIgnored(self):
+        """Messages that are not valid requests are ignored"""
+        self.client.sendto("flurble", self.serverAddr)
+        self.client.sendto(WCMessage(WCMessage.TYPE_RESPONSE, 0, 0, 0, 0, 0).pack(), self.serverAddr)
+        self._sendRequests(1)
+        self.server.start()
+        self.assertEquals(len(self._receiveResponses()), 1)
+
+    def test_precisionChangedWhileRunning(self):
+        """Responses report the precision most recently set, including when set while the server is running"""
+        self.server.start()
+        self.server.precision = 0.25
+        self._sendRequests(1)
+        responses = self._receiveResponses()
+        self.assertEquals([ r.precision for r in responses ], [ WCMessage.encodePrecision(0.25) ])
+        self.assertEquals(self.server.precision, 0.25)
+
+
+@unittest.skipIf(BWCS._BATCHED_CALLS is None or BWCS.SO_TIMESTAMPNS is None, "kernel timestamps not available")
+class Test_BatchedWallClockServerKernelTimestamps(unittest.TestCase):
+    """Tests of BatchedWallClockServer using kernel receive timestamps"""
+
+    def setUp(self):
+        self.wallClock = SysClock(tickRate=1000000000)
+        self.server = BatchedWallClockServer(self.wallClock, precision=0.001, maxFreqError=500, bindaddr="127.0.0.1", bindport=0, kernelTimestamps=True)
+        self.serverAddr = self.server._socket.getsockname()
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(0.5)
+
+    def tearDown(self):
+        self.server._socket.close()
+        self.client.close()
+
+    def test_receiveTimeIsWhenKernelReceived(self):
+        """The receive time is when the request arrived, not when the server got round to reading it"""
+        sent = self.wallClock.nanos
+        self.client.sendto(WCMessage(WCMessage.TYPE_REQUEST, 0, 0, 5, 0, 0).pack(), self.serverAddr)
+        time.sleep(0.2)
+        self.assertEquals(self.server.serviceRequests(), 1)
+        response = WCMessage.unpack(self.client.recv(100))
+
+        self.assertTrue(abs(response.receiveNanos - sent) < 50000000)
+        self.assertTrue(response.transmitNanos - sent >= 200000000)
+
+    def test_precisionReflectsStampingError(self):
+        """The precision reported is no better than the measured stamping error"""
+        self.client.sendto(WCMessage(WCMessage.TYPE_REQUEST, 0, 0, 5, 0, 0).pack(), self.serverAddr)
+        time.sleep(0.05)
+        self.server.serviceRequests()
+        response = WCMessage.unpack(self.client.recv(100))
+        self.assertTrue(self.server.stampingError > 0)
+        self.assertEquals(response.precision, WCMessage.encodePrecision(max(0.001, self.server.stampingError)))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import json
+import threading
+
+import sys
+sys.path.append("../../src/python")
+from CssProxyEngine import BlockableCIIServer
+from ProxyTracer import ProxyTracer
+
+from mock_wsServerBase import Mock_WebSock
+
+
+class Test_BlockableCIIServer(unittest.TestCase):
+    """Tests of BlockableCIIServer"""
+
+    def setUp(self):
+        self.ciiServer = BlockableCIIServer(maxConnectionsAllowed=-1, enabled=True, rewriteHostPort=["tsUrl"])
+        self.ciiServer.cii.contentId = "dvb://1234"
+        self.ciiServer.cii.contentIdStatus = "final"
+        self.ciiServer.cii.tsUrl = "ws://{{host}}:{{port}}/ts"
+
+    def tearDown(self):
+        self.ciiServer.enabled = False
+
+    def _clientConnects(self, host="10.0.0.1"):
+        webSock = Mock_WebSock()
+        webSock.local_address = (host, 7681)
+        self.ciiServer._addConnection(webSock)
+        return webSock
+
+    def test_sameMessageSentToClientsInSameState(self):
+        """Clients that were sent the same CII, and connected to the same host, are all sent the same serialised diff"""
+        clients = [ self._clientConnects() for i in range(0,5) ]
+        self.ciiServer.updateClients()
+        for c in clients:
+            c.mock_popReceivedMessages()
+
+        self.ciiServer.cii.presentationStatus = ["okay"]
+        self.ciiServer.updateClients()
+
+        received = [ c.mock_popReceivedMessages() for c in clients ]
+        for msgs in received:
+            self.assertEquals(len(msgs), 1)
+            self.assertIs(msgs[0], received[0][0])
+        self.assertEquals(json.loads(received[0][0]), { "presentationStatus" : "okay" })
+
+    def test_clientsInDifferentStatesSentTheirOwnDiff(self):
+        """A client that connected since the last update is sent only what has changed since it connected"""
+        early = self._clientConnects()
+        self.ciiServer.cii.presentationStatus = ["okay"]
+        self.ciiServer.updateClients()
+        late = self._clientConnects()
+        early.mock_popReceivedMessages()
+        late.mock_popReceivedMessages()
+
+        self.ciiServer.cii.contentId = "dvb://5678"
+        self.ciiServer.updateClients()
+        self.assertEquals(json.loads(early.mock_popReceivedMessages()[0]), { "contentId" : "dvb://5678", "contentIdStatus" : "final" })
+        self.assertEquals(json.loads(late.mock_popReceivedMessages()[0]), { "contentId" : "dvb://5678", "contentIdStatus" : "final" })
+
+        # now both in the same state
+        self.ciiServer.cii.presentationStatus = ["fault"]
+        self.ciiServer.updateClients()
+        self.assertIs(early.mock_popReceivedMessages()[0], late.mock_popReceivedMessages()[0])
+
+    def test_hostRewrittenForEachClient(self):
+        """Clients that connected to different hosts are sent CII with their own host substituted"""
+        a = self._clientConnects("10.0.0.1")
+        b = self._clientConnects("192.168.1.1")
+        self.assertEquals(json.loads(a.mock_popReceivedMessages()[0])["tsUrl"], "ws://10.0.0.1:7681/ts")
+        self.assertEquals(json.loads(b.mock_popReceivedMessages()[0])["tsUrl"], "ws://192.168.1.1:7681/ts")
+
+        self.ciiServer.cii.tsUrl = "ws://{{host}}:{{port}}/ts2"
+        self.ciiServer.updateClients()
+        self.assertEquals(json.loads(a.mock_popReceivedMessages()[0]), { "tsUrl" : "ws://10.0.0.1:7681/ts2" })
+        self.assertEquals(json.loads(b.mock_popReceivedMessages()[0]), { "tsUrl" : "ws://192.168.1.1:7681/ts2" })
+
+    def test_connectingClientsShareRenderedMessage(self):
+        """Clients connecting to the same host while the CII is unchanged are sent the same serialised message, which is rendered again when the CII changes"""
+        a = self._clientConnects()
+        b = self._clientConnects()
+        other = self._clientConnects("192.168.1.1")
+        msgA = a.mock_popReceivedMessages()[0]
+        self.assertIs(msgA, b.mock_popReceivedMessages()[0])
+        self.assertIsNot(msgA, other.mock_popReceivedMessages()[0])
+
+        self.ciiServer.cii.presentationStatus = ["okay"]
+        c = self._clientConnects()
+        msgC = c.mock_popReceivedMessages()[0]
+        self.assertEquals(json.loads(msgC)["presentationStatus"], "okay")
+        self.assertEquals(json.loads(msgC)["tsUrl"], "ws://10.0.0.1:7681/ts")
+
+        # the clients already connected are still sent the change, and then share the same state as the new one
+        self.ciiServer.updateClients()
+        self.assertEquals(json.loads(a.mock_popReceivedMessages()[0]), { "presentationStatus" : "okay" })
+        self.assertEquals(c.mock_popReceivedMessages(), [])
+
+    def test_diffAndEachSendBatchTraced(self):
+        """With a tracer, working out the diffs is marked, and then sending to each group of clients that share a message"""
+        tracer = ProxyTracer()
+        self.ciiServer = BlockableCIIServer(maxConnectionsAllowed=-1, enabled=True, rewriteHostPort=["tsUrl"], tracer=tracer)
+        self.ciiServer.cii.tsUrl = "ws://{{host}}:{{port}}/ts"
+        for host in [ "10.0.0.1", "10.0.0.1", "192.168.1.1" ]:
+            self._clientConnects(host)
+
+        tracer.begin("update")
+        self.ciiServer.cii.presentationStatus = ["okay"]
+        self.ciiServer.updateClients()
+        tracer.end()
+
+        stages = tracer.dump()[0]["stages"]
+        self.assertEquals([ s["stage"] for s in stages ], [ "begin", "cii diff", "cii send batch", "cii send batch", "end" ])
+        self.assertEquals(stages[1]["groups"], 2)
+        self.assertEquals(sorted(s["clients"] for s in stages[2:4]), [ 1, 2 ])
+
+    def test_nothingSentIfUnchanged(self):
+        """Clients are not sent anything if nothing has changed, unless forced"""
+        client = self._clientConnects()
+        client.mock_popReceivedMessages()
+        self.ciiServer.updateClients()
+        self.assertEquals(client.mock_popReceivedMessages(), [])
+        self.ciiServer.updateClients(sendIfEmpty=True)
+        self.assertEquals(json.loads(client.mock_popReceivedMessages()[0]), {})
+
+    def test_nothingSentWhileBlocking(self):
+        """While blocking, clients are not sent anything; when unblocked they are sent what has changed"""
+        client = self._clientConnects()
+        client.mock_popReceivedMessages()
+        self.ciiServer.setBlocking(True)
+        self.ciiServer.cii.presentationStatus = ["okay"]
+        self.ciiServer.updateClients()
+        self.assertEquals(client.mock_popReceivedMessages(), [])
+        self.ciiServer.setBlocking(False)
+        self.assertEquals(json.loads(client.mock_popReceivedMessages()[0]), { "presentationStatus" : "okay" })
+
+    def test_lockNotHeldWhileSending(self):
+        """Clients are sent updates without the server's lock held, so other clients can still connect and disconnect meanwhile"""
+        client = self._clientConnects()
+        client.mock_popReceivedMessages()
+        lockFree = []
+        def send(payload, binary=False):
+            def tryLock():
+                acquired = self.ciiServer._lock.acquire(False)
+                lockFree.append(acquired)
+                if acquired:
+                    self.ciiServer._lock.release()
+            t = threading.Thread(target=tryLock)
+            t.start()
+            t.join()
+        client.send = send
+        self.ciiServer.cii.presentationStatus = ["okay"]
+        self.ciiServer.updateClients()
+        self.assertEquals(lockFree, [ True ])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
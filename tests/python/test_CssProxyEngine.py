@@ -17,10 +17,13 @@
 import unittest
 import random
 import json
+import time
 
 import sys
 sys.path.append("../../src/python")
 from CssProxyEngine import CssProxyEngine
+import ProxyMetrics
+from ProxyTracer import ProxyTracer
 
 from dvbcss.protocol.cii import CII
 from dvbcss.protocol import OMIT
@@ -29,6 +32,7 @@ from dvbcss.protocol import OMIT
 from mock_ciiServer import MockCiiServer
 from mock_tsServer import MockTsServer
 from mock_wsServerBase import MockWSServerBase
+from mock_timer import MockTimer
 
 ciiUrl = "flurble"
 tsUrl = "blah"
@@ -51,9 +55,13 @@ class Test_CssProxy(unittest.TestCase):
         self.tsServer = MockTsServer()
         self._orig_ServerBase = CssProxyEngine.Server.ServerBase
         CssProxyEngine.Server.ServerBase = self._mockWSServerBaseFactory
+        self._orig_Timer = CssProxyEngine.__dict__["Timer"]
+        CssProxyEngine.Timer = MockTimer
+        MockTimer.mock_reset()
         
     def tearDown(self):
         CssProxyEngine.Server.ServerBase = self._orig_ServerBase
+        CssProxyEngine.Timer = self._orig_Timer
         self.tsServer.cleanup()
         self.ciiServer.cleanup()
 
@@ -493,6 +501,171 @@ class Test_CssProxy(unittest.TestCase):
         self.assertEquals(ct.timelineSpeedMultiplier, 0.5)
 
 
+    def test_onlyChangedTimelinesPushedToClients(self):
+        """Once the content ID is known, only clients of timelines whose control timestamps changed are updated"""
+        p = CssProxyEngine(self.ciiServer, self.tsServer, ciiUrl, tsUrl, wcUrl)
+        
+        # browser connects
+        self.mockServerBase.mock_clientConnects()
+        
+        self.tsServer.mock_addTimelineSelector("urn:dvb:css:timeline:pts")
+        self.tsServer.mock_addTimelineSelector("urn:dvb:css:timeline:temi:1:1")
+        msg = """\
+        {
+            "cii" : { "contentId" : "dvb://1234" },
+            "controlTimestamps" : {
+                "urn:dvb:css:timeline:pts" : {
+                    "contentTime":"90000",
+                    "wallClockTime":"1000000000",
+                    "timelineSpeedMultiplier":1.0
+                },
+                "urn:dvb:css:timeline:temi:1:1" : {
+                    "contentTime":"1",
+                    "wallClockTime":"1000000000",
+                    "timelineSpeedMultiplier":1.0
+                }
+            }
+        }
+        """
+        self.mockServerBase.mock_clientSendsMessage(msg)
+        self.assertTrue(self.tsServer.mock_wasUpdateAllClientsCalled())
+        self.tsServer.mock_popUpdatedSelectors()
+
+        # browser resends, with pts timeline unchanged (just extrapolated) but temi timeline changed
+        msg = """\
+        {
+            "cii" : { "contentId" : "dvb://1234" },
+            "controlTimestamps" : {
+                "urn:dvb:css:timeline:pts" : {
+                    "contentTime":"180000",
+                    "wallClockTime":"2000000000",
+                    "timelineSpeedMultiplier":1.0
+                },
+                "urn:dvb:css:timeline:temi:1:1" : {
+                    "contentTime":"7",
+                    "wallClockTime":"2000000000",
+                    "timelineSpeedMultiplier":1.0
+                }
+            }
+        }
+        """
+        self.mockServerBase.mock_clientSendsMessage(msg)
+        self.assertFalse(self.tsServer.mock_wasUpdateAllClientsCalled())
+        self.assertEquals(self.tsServer.mock_popUpdatedSelectors(), [ "urn:dvb:css:timeline:temi:1:1" ])
+        self.assertEquals(self.tsServer.mock_getMostRecentCt("urn:dvb:css:timeline:temi:1:1").timestamp.contentTime, 7)
+        self.assertEquals(self.tsServer.mock_getMostRecentCt("urn:dvb:css:timeline:pts").timestamp.contentTime, 90000)
+
+    def test_updateTimeRecorded(self):
+        """The time taken to apply each update from the browser is recorded in the metrics"""
+        p = CssProxyEngine(self.ciiServer, self.tsServer, ciiUrl, tsUrl, wcUrl)
+        self.mockServerBase.mock_clientConnects()
+        before = ProxyMetrics.updateSeconds().count
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "abc" } }')
+        self.assertEquals(ProxyMetrics.updateSeconds().count - before, 1)
+
+    def test_updatesNotCoalescedByDefault(self):
+        """Without a coalescing window, each message from the browser is applied immediately"""
+        p = CssProxyEngine(self.ciiServer, self.tsServer, ciiUrl, tsUrl, wcUrl)
+        self.mockServerBase.mock_clientConnects()
+        
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "abc" } }')
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "def" } }')
+        self.assertEquals(self.tsServer.contentId, "def")
+        self.assertEquals(MockTimer.timers, [])
+        
+    def test_burstCoalesced(self):
+        """Within the coalescing window, the first update is applied immediately and the rest are merged and applied at the end"""
+        p = CssProxyEngine(self.ciiServer, self.tsServer, ciiUrl, tsUrl, wcUrl, coalesceWindow=0.01)
+        self.mockServerBase.mock_clientConnects()
+        self.tsServer.mock_addTimelineSelector("urn:dvb:css:timeline:temi:1:1")
+        self.ciiServer.mock_wasUpdateClientsCalled()
+        
+        ctMsg = '{ "controlTimestamps" : { "urn:dvb:css:timeline:temi:1:1" : { "contentTime":"%d", "wallClockTime":"1000", "timelineSpeedMultiplier":1.0 } } }'
+        
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "abc" } }')
+        self.assertEquals(self.tsServer.contentId, "abc")
+        self.assertTrue(self.ciiServer.mock_wasUpdateClientsCalled())
+        self.assertEquals(len(MockTimer.mock_running()), 1)
+        self.assertEquals(MockTimer.mock_running()[0].interval, 0.01)
+        
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "presentationStatus" : "okay" } }')
+        self.mockServerBase.mock_clientSendsMessage(ctMsg % 5)
+        self.mockServerBase.mock_clientSendsMessage(ctMsg % 7)
+        self.assertFalse(self.ciiServer.mock_wasUpdateClientsCalled())
+        self.assertEquals(self.ciiServer.cii.presentationStatus, OMIT)
+        self.assertIsNone(self.tsServer.mock_getMostRecentCt("urn:dvb:css:timeline:temi:1:1"))
+        
+        # end of window: merged update applied once, and a new window started
+        MockTimer.mock_running()[0].mock_fire()
+        self.assertTrue(self.ciiServer.mock_wasUpdateClientsCalled())
+        self.assertEquals(self.ciiServer.cii.contentId, "abc")
+        self.assertEquals(self.ciiServer.cii.presentationStatus, ["okay"])
+        self.assertEquals(self.tsServer.mock_getMostRecentCt("urn:dvb:css:timeline:temi:1:1").timestamp.contentTime, 7)
+        self.assertEquals(len(MockTimer.mock_running()), 1)
+        
+        # nothing more arrives, so nothing is applied and no new window is started
+        MockTimer.mock_running()[0].mock_fire()
+        self.assertFalse(self.ciiServer.mock_wasUpdateClientsCalled())
+        self.assertEquals(MockTimer.mock_running(), [])
+        
+    def test_burstCoalescedWithRealTimer(self):
+        """Updates merged during the coalescing window are applied at its end, using a real timer"""
+        CssProxyEngine.Timer = self._orig_Timer
+        p = CssProxyEngine(self.ciiServer, self.tsServer, ciiUrl, tsUrl, wcUrl, coalesceWindow=0.02)
+        self.mockServerBase.mock_clientConnects()
+        
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "abc" } }')
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "def" } }')
+        deadline = time.time() + 2.0
+        while self.tsServer.contentId != "def" and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(self.tsServer.contentId, "def")
+        
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "ghi" } }')
+        deadline = time.time() + 2.0
+        while self.tsServer.contentId != "ghi" and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals(self.tsServer.contentId, "ghi")
+        self.mockServerBase.mock_clientDisconnects()
+        
+    def test_pendingUpdatesDiscardedWhenBrowserDisconnects(self):
+        """When the browser disconnects, updates waiting for the end of the coalescing window are discarded"""
+        p = CssProxyEngine(self.ciiServer, self.tsServer, ciiUrl, tsUrl, wcUrl, coalesceWindow=0.01)
+        self.mockServerBase.mock_clientConnects()
+        
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "abc" } }')
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "def" } }')
+        self.mockServerBase.mock_clientDisconnects()
+        self.assertEquals(MockTimer.mock_running(), [])
+        self.assertEquals(self.ciiServer.cii.contentId, "abc")
+
+    def test_updateTraced(self):
+        """With a tracer, each message from the browser is traced through decoding, sending CII and sending Control Timestamps"""
+        tracer = ProxyTracer()
+        p = CssProxyEngine(self.ciiServer, self.tsServer, ciiUrl, tsUrl, wcUrl, tracer=tracer)
+        self.mockServerBase.mock_clientConnects()
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "abc" } }')
+        
+        traces = tracer.dump()
+        self.assertEquals(len(traces), 1)
+        self.assertEquals(traces[0]["name"], "browser message")
+        self.assertEquals([ s["stage"] for s in traces[0]["stages"] ], ["receive", "decode", "cii send", "ts change detection", "ts send", "end"])
+        self.assertIsNone(tracer.current)
+        
+    def test_coalescedUpdateTraced(self):
+        """With a tracer, updates merged into a coalescing window are marked, and applying them at the end of the window is traced"""
+        tracer = ProxyTracer()
+        p = CssProxyEngine(self.ciiServer, self.tsServer, ciiUrl, tsUrl, wcUrl, coalesceWindow=0.01, tracer=tracer)
+        self.mockServerBase.mock_clientConnects()
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "abc" } }')
+        self.mockServerBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "def" } }')
+        MockTimer.mock_running()[0].mock_fire()
+        
+        traces = tracer.dump()
+        self.assertEquals([ t["name"] for t in traces ], ["browser message", "browser message", "coalesced update"])
+        self.assertEquals([ s["stage"] for s in traces[1]["stages"] ], ["receive", "decode", "coalesced", "end"])
+        self.assertEquals([ s["stage"] for s in traces[2]["stages"] ], ["window end", "cii send", "ts change detection", "ts send", "end"])
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=1)
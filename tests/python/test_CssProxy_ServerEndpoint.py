@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import json
+import time
+
+import sys
+sys.path.append("../../src/python")
+from CssProxy_ServerEndpoint import CssProxy_ServerEndpoint, decodeCii, decodeControlTimestamp, messagePayload
+import ProxyCodecs
+import ProxyMetrics
+
+from dvbcss.protocol.cii import CII
+from dvbcss.protocol.ts import ControlTimestamp
+from dvbcss.protocol import OMIT
+
+from ws4py.messaging import TextMessage, BinaryMessage
+
+from mock_wsServerBase import MockWSServerBase
+from mock_timer import MockTimer
+
+
+class Test_Decoding(unittest.TestCase):
+    """Tests of decoding messages from the browser"""
+
+    def test_decodeCiiMatchesUnpack(self):
+        """CII decoded from a parsed message is the same as if unpacked from JSON"""
+        struct = {
+            "contentId" : "dvb://1234",
+            "presentationStatus" : "okay",
+            "timelines" : [
+                { "timelineSelector" : "urn:dvb:css:timeline:pts",
+                  "timelineProperties" : { "unitsPerTick" : 1, "unitsPerSecond" : 90000 } }
+            ],
+            "private" : [ { "type" : "blah", "flurgle" : [ 1, None, "hello" ] } ]
+        }
+        decoded = decodeCii(struct)
+        self.assertEquals(json.loads(decoded.pack()), json.loads(CII.unpack(json.dumps(struct)).pack()))
+        self.assertEquals(decoded.tsUrl, OMIT)
+
+    def test_decodeCiiRejectsInvalid(self):
+        """Invalid CII properties are rejected"""
+        self.assertRaises(ValueError, decodeCii, { "presentationStatus" : 5 })
+
+    def test_decodeControlTimestampMatchesUnpack(self):
+        """Control Timestamps decoded from a parsed message are the same as if unpacked from JSON"""
+        for struct in [
+            { "contentTime":"55", "wallClockTime":"1234", "timelineSpeedMultiplier":1.0 },
+            { "contentTime":None, "wallClockTime":"1234", "timelineSpeedMultiplier":None },
+        ]:
+            self.assertEquals(decodeControlTimestamp(struct).pack(), ControlTimestamp.unpack(json.dumps(struct)).pack())
+
+    def test_decodeControlTimestampRejectsInvalid(self):
+        """Incomplete or inconsistent Control Timestamps are rejected"""
+        self.assertRaises(ValueError, decodeControlTimestamp, { "contentTime":"55", "wallClockTime":"1234" })
+        self.assertRaises(ValueError, decodeControlTimestamp, { "contentTime":"55", "wallClockTime":"1234", "timelineSpeedMultiplier":None })
+
+    def test_messagePayload(self):
+        """The payload can be taken from ws4py messages, strings, bytearrays and memoryviews"""
+        payload = '{"cii":{}}'
+        self.assertIs(messagePayload(payload), payload)
+        self.assertEquals(messagePayload(TextMessage(payload)), payload)
+        self.assertEquals(messagePayload(BinaryMessage(bytearray(payload))), payload)
+        self.assertEquals(messagePayload(memoryview(payload)), payload)
+
+    def test_decodeControlTimestampAcceptsIntegers(self):
+        """Control Timestamps from binary codecs can have integer times"""
+        ct = decodeControlTimestamp({ "contentTime":55, "wallClockTime":1234, "timelineSpeedMultiplier":1.0 })
+        self.assertEquals(ct.timestamp.contentTime, 55)
+        self.assertEquals(ct.timestamp.wallClockTime, 1234)
+
+
+class Test_CodecNegotiation(unittest.TestCase):
+    """Tests of selecting the codec used on the server/proxy interface"""
+
+    def setUp(self):
+        self._orig_ServerBase = CssProxy_ServerEndpoint.ServerBase
+        CssProxy_ServerEndpoint.ServerBase = MockWSServerBase
+        self.endpoint = CssProxy_ServerEndpoint({ "ciiUrl" : "ws://flurble/cii" })
+        self.updates = []
+        self.endpoint.onUpdate = lambda cii, cts, options: self.updates.append((cii, cts, options))
+        self.serverBase = self.endpoint._server
+        self.webSock = self.serverBase.mock_clientConnects()
+
+    def tearDown(self):
+        CssProxy_ServerEndpoint.ServerBase = self._orig_ServerBase
+
+    def test_initialMessageListsCodecs(self):
+        """The initial message is JSON and lists the available codecs"""
+        msgs = self.webSock.mock_popReceivedMessages()
+        initial = json.loads(msgs[0])
+        self.assertEquals(initial["ciiUrl"], "ws://flurble/cii")
+        self.assertEquals(initial["codecs"], ProxyCodecs.availableCodecNames())
+        self.assertEquals(initial["codecs"][-1], "json")
+
+    def test_unknownCodecFallsBackToJson(self):
+        """Asking for a codec that is not available results in JSON continuing to be used"""
+        self.webSock.mock_popReceivedMessages()
+        self.serverBase.mock_clientSendsMessage('{ "codec" : "flurble" }')
+        self.assertEquals(json.loads(self.webSock.mock_popReceivedMessages()[0]), { "codec" : "json" })
+        self.assertEquals(self.updates, [])
+
+        self.endpoint.updateNumberOfSlaves(3)
+        self.assertEquals(json.loads(self.webSock.mock_popReceivedMessages()[0]), { "nrOfSlaves" : 3 })
+
+    @unittest.skipIf(ProxyCodecs.getCodec("msgpack") is None, "msgpack not installed")
+    def test_binaryCodecUsedOnceSelected(self):
+        """Once a binary codec is selected, messages in both directions use it, in binary frames"""
+        import msgpack
+        self.webSock.mock_popReceivedMessages()
+        self.serverBase.mock_clientSendsMessage('{ "codec" : "msgpack" }')
+        self.assertEquals(json.loads(self.webSock.mock_popReceivedMessages()[0]), { "codec" : "msgpack" })
+
+        self.endpoint.updateNumberOfSlaves(3)
+        self.assertEquals(msgpack.unpackb(self.webSock.mock_popReceivedMessages()[0], raw=False), { "nrOfSlaves" : 3 })
+        self.assertTrue(self.webSock.mock_lastSentBinary)
+
+        msg = { "controlTimestamps" : { "urn:dvb:css:timeline:pts" : { "contentTime":55, "wallClockTime":1234, "timelineSpeedMultiplier":1.0 } } }
+        self.serverBase.mock_clientSendsMessage(BinaryMessage(bytearray(msgpack.packb(msg, use_bin_type=True))))
+        cii, cts, options = self.updates[-1]
+        self.assertEquals(cts["urn:dvb:css:timeline:pts"].timestamp.contentTime, 55)
+
+        # text frames are still JSON
+        self.serverBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "dvb://1234" } }')
+        cii, cts, options = self.updates[-1]
+        self.assertEquals(cii.contentId, "dvb://1234")
+
+    def test_codecResetOnReconnect(self):
+        """A new connection starts using JSON again"""
+        self.serverBase.mock_clientSendsMessage('{ "codec" : "%s" }' % ProxyCodecs.availableCodecNames()[0])
+        self.serverBase.mock_clientDisconnects()
+        webSock = self.serverBase.mock_clientConnects()
+        webSock.mock_popReceivedMessages()
+        self.endpoint.updateNumberOfSlaves(1)
+        self.assertEquals(json.loads(webSock.mock_popReceivedMessages()[0]), { "nrOfSlaves" : 1 })
+
+    def test_messagesCounted(self):
+        """Messages received from, and sent to, the browser are counted in the metrics"""
+        received = ProxyMetrics.browserMessagesReceived()
+        sent = ProxyMetrics.messagesSent("server")
+        before = received.value, sent.value
+        self.serverBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "dvb://1234" } }')
+        self.endpoint.updateNumberOfSlaves(3)
+        self.assertEquals(received.value - before[0], 1)
+        self.assertEquals(sent.value - before[1], 1)
+
+
+class Test_Batching(unittest.TestCase):
+    """Tests of batching the messages sent to the browser about timelines required and the number of slaves"""
+
+    def setUp(self):
+        self._orig_ServerBase = CssProxy_ServerEndpoint.ServerBase
+        self._orig_Timer = CssProxy_ServerEndpoint.__dict__["Timer"]
+        CssProxy_ServerEndpoint.ServerBase = MockWSServerBase
+        CssProxy_ServerEndpoint.Timer = MockTimer
+        MockTimer.mock_reset()
+        self.endpoint = CssProxy_ServerEndpoint({ "ciiUrl" : "ws://flurble/cii" }, batchWindow=0.05)
+        self.serverBase = self.endpoint._server
+        self.webSock = self.serverBase.mock_clientConnects()
+        self.webSock.mock_popReceivedMessages()
+
+    def tearDown(self):
+        CssProxy_ServerEndpoint.ServerBase = self._orig_ServerBase
+        CssProxy_ServerEndpoint.Timer = self._orig_Timer
+
+    def test_changesSentTogetherAtEndOfWindow(self):
+        """Changes are not sent until the end of the window, and are then sent in a single message"""
+        self.endpoint.sendTimelinesRequest(["a"], ["a"], [])
+        self.endpoint.updateNumberOfSlaves(1)
+        self.endpoint.sendTimelinesRequest(["a", "b"], ["b"], [])
+        self.endpoint.updateNumberOfSlaves(2)
+        self.assertEquals(self.webSock.mock_popReceivedMessages(), [])
+        self.assertEquals(len(MockTimer.mock_running()), 1)
+        self.assertEquals(MockTimer.mock_running()[0].interval, 0.05)
+
+        MockTimer.mock_running()[0].mock_fire()
+        msgs = [ json.loads(m) for m in self.webSock.mock_popReceivedMessages() ]
+        self.assertEquals(msgs, [ { "add_timelineSelectors" : ["a", "b"], "remove_timelineSelectors" : [], "nrOfSlaves" : 2 } ])
+        self.assertEquals(self.endpoint.selectors, ["a", "b"])
+        self.assertEquals(MockTimer.mock_running(), [])
+
+    def test_addedThenRemovedNotSent(self):
+        """A timeline selector added and then removed again within the window is not mentioned"""
+        self.endpoint.sendTimelinesRequest(["a"], ["a"], [])
+        self.endpoint.sendTimelinesRequest([], [], ["a"])
+        MockTimer.mock_running()[0].mock_fire()
+        self.assertEquals(self.webSock.mock_popReceivedMessages(), [])
+
+    def test_onlySlavesSent(self):
+        """If only the number of slaves has changed, only that is sent"""
+        self.endpoint.updateNumberOfSlaves(5)
+        MockTimer.mock_running()[0].mock_fire()
+        self.assertEquals([ json.loads(m) for m in self.webSock.mock_popReceivedMessages() ], [ { "nrOfSlaves" : 5 } ])
+
+    def test_sentWithRealTimer(self):
+        """Changes are sent at the end of the window, using a real timer"""
+        CssProxy_ServerEndpoint.Timer = self._orig_Timer
+        self.endpoint.sendTimelinesRequest(["a"], ["a"], [])
+        self.endpoint.updateNumberOfSlaves(1)
+        msgs = []
+        deadline = time.time() + 2.0
+        while not msgs and time.time() < deadline:
+            time.sleep(0.01)
+            msgs = self.webSock.mock_popReceivedMessages()
+        self.assertEquals([ json.loads(m) for m in msgs ], [ { "add_timelineSelectors" : ["a"], "remove_timelineSelectors" : [], "nrOfSlaves" : 1 } ])
+
+        # and a new window is started for later changes
+        self.endpoint.updateNumberOfSlaves(2)
+        msgs = []
+        deadline = time.time() + 2.0
+        while not msgs and time.time() < deadline:
+            time.sleep(0.01)
+            msgs = self.webSock.mock_popReceivedMessages()
+        self.assertEquals([ json.loads(m) for m in msgs ], [ { "nrOfSlaves" : 2 } ])
+
+    def test_pendingDiscardedOnDisconnect(self):
+        """Changes waiting to be sent are discarded when the browser disconnects, and a reconnecting browser is told all timelines required"""
+        self.endpoint.sendTimelinesRequest(["a"], ["a"], [])
+        self.serverBase.mock_clientDisconnects()
+        self.assertEquals(MockTimer.mock_running(), [])
+
+        webSock = self.serverBase.mock_clientConnects()
+        msgs = [ json.loads(m) for m in webSock.mock_popReceivedMessages() ]
+        self.assertEquals(msgs[-1], { "add_timelineSelectors" : ["a"], "remove_timelineSelectors" : [] })
+        self.assertEquals(MockTimer.mock_running(), [])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
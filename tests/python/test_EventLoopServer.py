@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+import sys
+sys.path.append("../../src/python")
+from EventLoopServer import EventLoopServer
+
+
+class MockHandlerClass(object):
+    """Stands in for the handler class of a WSServerBase"""
+    enabled = True
+    canAllocate = True
+
+    @classmethod
+    def isEnabled(cls):
+        return cls.enabled
+
+    @classmethod
+    def canAllocateConnection(cls):
+        return cls.canAllocate
+
+
+def makeEnviron(path, remoteAddr="127.0.0.1"):
+    return {
+        "REQUEST_METHOD" : "GET",
+        "PATH_INFO" : path,
+        "REMOTE_ADDR" : remoteAddr,
+        "HTTP_UPGRADE" : "websocket",
+        "HTTP_CONNECTION" : "Upgrade",
+        "HTTP_SEC_WEBSOCKET_KEY" : "dGhlIHNhbXBsZSBub25jZQ==",
+        "HTTP_SEC_WEBSOCKET_VERSION" : "13",
+        "ws4py.socket" : object(),
+    }
+
+
+class Test_EventLoopServer(unittest.TestCase):
+    """Tests of EventLoopServer request routing"""
+
+    def setUp(self):
+        class Handler(MockHandlerClass):
+            def __init__(self, sock, protocols, extensions, environ):
+                self.sock = sock
+        self.handler = Handler
+        self.server = EventLoopServer("127.0.0.1", 0)
+        self.statuses = []
+
+    def _startResponse(self, status, headers):
+        self.statuses.append(status)
+
+    def _request(self, environ):
+        self.server._application(environ, self._startResponse)
+        return self.statuses[-1]
+
+    def test_unknownPathRefused(self):
+        """Requests for paths where nothing is mounted get 404"""
+        self.server.mount("/cii", self.handler)
+        self.assertEquals(self._request(makeEnviron("/flurble")), "404 Not Found")
+
+    def test_upgradesMountedPath(self):
+        """Requests for a mounted path are upgraded and the handler created is a subclass of the mounted handler"""
+        self.server.mount("/cii", self.handler)
+        environ = makeEnviron("/cii")
+        self.assertEquals(self._request(environ), "101 Switching Protocols")
+        self.assertTrue(isinstance(environ["ws4py.websocket"], self.handler))
+
+    def test_disabledEndpointRefused(self):
+        """Requests for a disabled endpoint get 403"""
+        self.handler.enabled = False
+        self.server.mount("/ts", self.handler)
+        self.assertEquals(self._request(makeEnviron("/ts")), "403 Forbidden")
+
+    def test_fullEndpointRefused(self):
+        """Requests for an endpoint at its connection limit get 503"""
+        self.handler.canAllocate = False
+        self.server.mount("/ts", self.handler)
+        self.assertEquals(self._request(makeEnviron("/ts")), "503 Service Unavailable")
+
+    def test_restrictedEndpointOnlyAllowsListedAddresses(self):
+        """Requests for a restricted endpoint are only upgraded if they come from an allowed address"""
+        self.server.mount("/server", self.handler, allowedAddrs=["127.0.0.1"])
+        self.assertEquals(self._request(makeEnviron("/server", "10.0.0.5")), "404 Not Found")
+        self.assertEquals(self._request(makeEnviron("/server", "127.0.0.1")), "101 Switching Protocols")
+
+    def test_resolverDeterminesEndpointUnderPrefix(self):
+        """Requests for paths under a prefix with a resolver are upgraded if the resolver supplies a handler class"""
+        calls = []
+        def resolver(path, remoteAddr):
+            calls.append((path, remoteAddr))
+            if path == "/cii/lounge":
+                return self.handler
+            return None
+        self.server.mountResolver("/cii", resolver)
+        self.assertEquals(self._request(makeEnviron("/cii/lounge")), "101 Switching Protocols")
+        self.assertEquals(self._request(makeEnviron("/cii/kitchen")), "404 Not Found")
+        self.assertEquals(self._request(makeEnviron("/ciii")), "404 Not Found")
+        self.assertEquals(calls, [("/cii/lounge", "127.0.0.1"), ("/cii/kitchen", "127.0.0.1")])
+
+    def test_pageServedOverPlainHttp(self):
+        """Plain HTTP requests for a mounted page get the page"""
+        self.server.mountPage("/metrics", lambda : "flurble 1\n", "text/plain")
+        environ = { "REQUEST_METHOD" : "GET", "PATH_INFO" : "/metrics", "REMOTE_ADDR" : "10.0.0.5" }
+        body = self.server._application(environ, self._startResponse)
+        self.assertEquals(self.statuses[-1], "200 OK")
+        self.assertEquals(body, ["flurble 1\n"])
+
+    def test_badHandshakeRefused(self):
+        """Requests that are not valid WebSocket handshakes get 400"""
+        self.server.mount("/cii", self.handler)
+        environ = makeEnviron("/cii")
+        del environ["HTTP_SEC_WEBSOCKET_VERSION"]
+        self.assertEquals(self._request(environ), "400 Bad Request")
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+import sys
+sys.path.append("../../src/python")
+import ProxyCodecs
+
+
+MSG = {
+    "cii" : { "contentId" : "dvb://1234", "presentationStatus" : "okay" },
+    "controlTimestamps" : {
+        "urn:dvb:css:timeline:pts" : { "contentTime":93824762, "wallClockTime":13184637468146, "timelineSpeedMultiplier":1.0 }
+    },
+    "options" : { "blockCii" : False }
+}
+
+
+class Test_ProxyCodecs(unittest.TestCase):
+    """Tests of the wire codecs"""
+
+    def test_jsonAlwaysAvailableAndLeastPreferred(self):
+        """JSON is always available, as the last resort"""
+        self.assertEquals(ProxyCodecs.availableCodecNames()[-1], "json")
+        self.assertIs(ProxyCodecs.getCodec("json"), ProxyCodecs.JSON)
+        self.assertFalse(ProxyCodecs.JSON.binary)
+
+    def test_unknownCodec(self):
+        """Asking for an unknown codec gives None"""
+        self.assertIsNone(ProxyCodecs.getCodec("flurble"))
+
+    def test_roundTrip(self):
+        """Every available codec decodes what it encodes"""
+        for codec in ProxyCodecs.CODECS:
+            self.assertEquals(codec.decode(codec.encode(MSG)), MSG, codec.name)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
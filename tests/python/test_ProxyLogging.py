@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import unittest
+import logging
+import threading
+
+import sys
+sys.path.append("../../src/python")
+from ProxyLogging import AsyncLogHandler, SampleFilter
+
+
+class MockHandler(logging.Handler):
+    """Handler that records the formatted messages it is asked to write, optionally waiting until its gate is open before writing each"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.written = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def emit(self, record):
+        self.gate.wait()
+        self.written.append(self.format(record))
+
+
+def makeLogger(name, handler):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    return logger
+
+
+class Test_AsyncLogHandler(unittest.TestCase):
+    """Tests of AsyncLogHandler"""
+
+    def test_recordsWrittenByBackgroundThread(self):
+        """Records are passed on to the target handler, in order, and all have been written once closed"""
+        target = MockHandler()
+        handler = AsyncLogHandler(target)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        logger = makeLogger("test_ProxyLogging.written", handler)
+        logger.info("one %d", 1)
+        logger.debug("two %s", "2")
+        handler.close()
+        self.assertEquals(target.written, ["INFO one 1", "DEBUG two 2"])
+
+    def test_messageResolvedWhenLogged(self):
+        """The message is formed when logged, not when written, so later changes to its arguments do not affect it"""
+        target = MockHandler()
+        target.gate.clear()
+        handler = AsyncLogHandler(target)
+        logger = makeLogger("test_ProxyLogging.resolved", handler)
+        arg = [1]
+        logger.info("%r", arg)
+        arg.append(2)
+        target.gate.set()
+        handler.close()
+        self.assertEquals(target.written, ["[1]"])
+
+    def test_loggingDoesNotWaitForWriting(self):
+        """When records cannot be written quickly enough, logging does not wait; records beyond the capacity are dropped"""
+        target = MockHandler()
+        target.gate.clear()
+        handler = AsyncLogHandler(target, capacity=2)
+        logger = makeLogger("test_ProxyLogging.dropped", handler)
+        for i in range(0,10):
+            logger.info("%d", i)
+        self.assertTrue(handler.dropped >= 7)
+        target.gate.set()
+        handler.close()
+        self.assertEquals(len(target.written) + handler.dropped, 10)
+        self.assertEquals(target.written[0], "0")
+
+
+class Test_SampleFilter(unittest.TestCase):
+    """Tests of SampleFilter"""
+
+    def test_oneInN(self):
+        """Only every Nth record is let through"""
+        f = SampleFilter(3)
+        record = logging.LogRecord("flurble", logging.DEBUG, __file__, 1, "hello", None, None)
+        self.assertEquals([ bool(f.filter(record)) for i in range(0,7) ], [False, False, True, False, False, True, False])
+
+    def test_everyRecordWhenOne(self):
+        """Every record is let through if N is 1"""
+        f = SampleFilter(1)
+        record = logging.LogRecord("flurble", logging.DEBUG, __file__, 1, "hello", None, None)
+        self.assertTrue(all(f.filter(record) for i in range(0,5)))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
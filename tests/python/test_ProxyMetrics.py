@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import unittest
+
+import sys
+sys.path.append("../../src/python")
+import ProxyMetrics
+from ProxyMetrics import MetricsRegistry
+
+
+class Test_MetricsRegistry(unittest.TestCase):
+    """Tests of MetricsRegistry and the metrics it holds"""
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        """Counters are exposed with their help, type and current value"""
+        c = self.registry.counter("flurble_total", "Number of flurbles.")
+        c.inc()
+        c.inc(2)
+        self.assertEquals(self.registry.expose(),
+            "# HELP flurble_total Number of flurbles.\n"
+            "# TYPE flurble_total counter\n"
+            "flurble_total 3\n")
+
+    def test_sameNameAndLabelsIsSameMetric(self):
+        """Asking for a metric with the same name and labels returns the existing one"""
+        a = self.registry.counter("flurble_total", "Number of flurbles.", endpoint="ts")
+        b = self.registry.counter("flurble_total", "Number of flurbles.", endpoint="ts")
+        c = self.registry.counter("flurble_total", "Number of flurbles.", endpoint="cii")
+        self.assertIs(a, b)
+        self.assertIsNot(a, c)
+
+    def test_labelledMetricsGroupedUnderOneName(self):
+        """Metrics with the same name but different labels are exposed together, under one HELP and TYPE"""
+        self.registry.counter("flurble_total", "Number of flurbles.", endpoint="ts").inc(5)
+        self.registry.counter("flurble_total", "Number of flurbles.", endpoint="cii").inc(2)
+        self.assertEquals(self.registry.expose(),
+            "# HELP flurble_total Number of flurbles.\n"
+            "# TYPE flurble_total counter\n"
+            'flurble_total{endpoint="cii"} 2\n'
+            'flurble_total{endpoint="ts"} 5\n')
+
+    def test_typeMismatchRefused(self):
+        """A name already used for one type of metric cannot be used for another"""
+        self.registry.counter("flurble", "Flurbles.")
+        self.assertRaises(ValueError, self.registry.gauge, "flurble", "Flurbles.")
+
+    def test_gaugeFromFunction(self):
+        """Gauges can take their value from a function, called when exposed"""
+        values = [4]
+        self.registry.gauge("connections", "Connections.", lambda : values[0])
+        self.assertTrue("\nconnections 4\n" in self.registry.expose())
+        values[0] = 1
+        self.assertTrue("\nconnections 1\n" in self.registry.expose())
+
+    def test_histogram(self):
+        """Histograms expose cumulative bucket counts, the sum and the count"""
+        h = self.registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+        h.observe(0.05)
+        h.observe(0.5, count=2)
+        h.observe(5.0)
+        self.assertEquals(self.registry.expose(),
+            "# HELP latency_seconds Latency.\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{le="0.1"} 1\n'
+            'latency_seconds_bucket{le="1.0"} 3\n'
+            'latency_seconds_bucket{le="+Inf"} 4\n'
+            "latency_seconds_sum 6.05\n"
+            "latency_seconds_count 4\n")
+
+    def test_histogramTime(self):
+        """Histograms can time a block of code"""
+        h = self.registry.histogram("duration_seconds", "Duration.")
+        with h.time():
+            pass
+        self.assertEquals(h.count, 1)
+        self.assertTrue(h.sum >= 0)
+
+
+class Test_countingHandlerClass(unittest.TestCase):
+    """Tests of countingHandlerClass"""
+
+    def test_countsMessagesAndBytesSent(self):
+        """Messages sent, and their size, are counted against the endpoint"""
+        class Handler(object):
+            def send(self, payload, binary=False):
+                self.sent = (payload, binary)
+
+        sent = ProxyMetrics.messagesSent("flurble")
+        sentBytes = ProxyMetrics.bytesSent("flurble")
+        before = sent.value, sentBytes.value
+
+        handler = ProxyMetrics.countingHandlerClass(Handler, "flurble")()
+        handler.send("hello")
+        handler.send("\x01\x02", binary=True)
+
+        self.assertEquals(handler.sent, ("\x01\x02", True))
+        self.assertEquals(sent.value - before[0], 2)
+        self.assertEquals(sentBytes.value - before[1], 7)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import unittest
+import json
+import time
+from StringIO import StringIO
+
+import sys
+sys.path.append("../../src/python")
+from CssProxyEngine import CssProxyEngine
+from CssProxy_ServerEndpoint import CssProxy_ServerEndpoint
+from ProxyRecorder import ProxyRecorder, ProxyReplayer, Entry, readRecording, RECEIVED, SENT, CONNECTED, DISCONNECTED
+
+from mock_ciiServer import MockCiiServer
+from mock_tsServer import MockTsServer
+from mock_wsServerBase import MockWSServerBase
+
+
+class UnclosableStringIO(StringIO):
+    def __init__(self):
+        StringIO.__init__(self)
+        self.flushed = ""
+
+    def flush(self):
+        self.flushed = self.getvalue()
+
+    def close(self):
+        pass
+
+
+class Test_ProxyRecorder(unittest.TestCase):
+    """Tests of recording the server/proxy interface"""
+
+    def setUp(self):
+        self._orig_ServerBase = CssProxy_ServerEndpoint.ServerBase
+        CssProxy_ServerEndpoint.ServerBase = MockWSServerBase
+        self.file = UnclosableStringIO()
+        self.recorder = ProxyRecorder(self.file)
+
+    def tearDown(self):
+        CssProxy_ServerEndpoint.ServerBase = self._orig_ServerBase
+        self.recorder.close()
+
+    def test_recordsAndReadsBack(self):
+        """Events for each session are recorded in order, and read back with their payloads intact"""
+        self.recorder.record("a", CONNECTED)
+        self.recorder.record("a", RECEIVED, '{"cii":{}}')
+        self.recorder.record("b", SENT, "\x00\xff\x81", binary=True)
+        self.recorder.record("a", DISCONNECTED)
+        self.recorder.flush()
+
+        entries = readRecording(StringIO(self.file.getvalue()))
+        self.assertEquals([ (e.sessionId, e.kind, e.payload, e.binary) for e in entries ], [
+            ("a", CONNECTED, None, False),
+            ("a", RECEIVED, '{"cii":{}}', False),
+            ("b", SENT, "\x00\xff\x81", True),
+            ("a", DISCONNECTED, None, False),
+        ])
+        whens = [ e.when for e in entries ]
+        self.assertEquals(whens, sorted(whens))
+
+        entries = readRecording(StringIO(self.file.getvalue()), sessionId="a")
+        self.assertEquals([ e.kind for e in entries ], [CONNECTED, RECEIVED, DISCONNECTED])
+
+    def test_flushedWhenNothingWaiting(self):
+        """Events are flushed to the file once there are no more waiting, without the recorder being flushed or closed"""
+        self.recorder.record("a", CONNECTED)
+        self.recorder.record("a", DISCONNECTED)
+        deadline = time.time() + 2.0
+        while len(readRecording(StringIO(self.file.flushed))) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEquals([ e.kind for e in readRecording(StringIO(self.file.flushed)) ], [CONNECTED, DISCONNECTED])
+
+    def test_invalidRecordingRejected(self):
+        """Reading a line that is not a recorded event fails"""
+        self.assertRaises(ValueError, readRecording, StringIO('{"flurble":1}\n'))
+
+    def test_endpointRecordsMessages(self):
+        """The server endpoint records the browser connecting and disconnecting, and the messages to and from it"""
+        endpoint = CssProxy_ServerEndpoint({ "ciiUrl" : "ws://flurble/cii" }, recorder=self.recorder.session("lounge"))
+        serverBase = endpoint._server
+        serverBase.mock_clientConnects()
+        serverBase.mock_clientSendsMessage('{ "cii" : { "contentId" : "dvb://1234" } }')
+        endpoint.updateNumberOfSlaves(2)
+        serverBase.mock_clientDisconnects()
+        self.recorder.flush()
+
+        entries = readRecording(StringIO(self.file.getvalue()))
+        self.assertEquals(set(e.sessionId for e in entries), set(["lounge"]))
+        self.assertEquals([ e.kind for e in entries ], [CONNECTED, SENT, SENT, RECEIVED, SENT, DISCONNECTED])
+        self.assertEquals(json.loads(entries[1].payload)["ciiUrl"], "ws://flurble/cii")
+        self.assertEquals(entries[3].payload, '{ "cii" : { "contentId" : "dvb://1234" } }')
+        self.assertEquals(json.loads(entries[4].payload), { "nrOfSlaves" : 2 })
+
+
+class Test_ProxyReplayer(unittest.TestCase):
+    """Tests of replaying a recording into a CssProxyEngine"""
+
+    def setUp(self):
+        self._orig_ServerBase = CssProxyEngine.Server.ServerBase
+        CssProxyEngine.Server.ServerBase = MockWSServerBase
+        self._orig_time = ProxyReplayer.__dict__["time"]
+        self._orig_sleep = ProxyReplayer.__dict__["sleep"]
+        self.now = 100.0
+        self.sleeps = []
+        ProxyReplayer.time = staticmethod(lambda : self.now)
+        ProxyReplayer.sleep = staticmethod(self._sleep)
+        self.ciiServer = MockCiiServer()
+        self.tsServer = MockTsServer()
+        self.engine = CssProxyEngine(self.ciiServer, self.tsServer, "ws://flurble/cii", "ws://flurble/ts", "udp://flurble:6677")
+
+    def tearDown(self):
+        CssProxyEngine.Server.ServerBase = self._orig_ServerBase
+        ProxyReplayer.time = self._orig_time
+        ProxyReplayer.sleep = self._orig_sleep
+        self.tsServer.cleanup()
+        self.ciiServer.cleanup()
+
+    def _sleep(self, duration):
+        self.sleeps.append(duration)
+        self.now += duration
+
+    def makeEntries(self):
+        return [
+            Entry(10.0, "", CONNECTED),
+            Entry(10.0, "", SENT, '{"ciiUrl":"ws://flurble/cii"}'),
+            Entry(10.5, "", RECEIVED, '{ "cii" : { "contentId" : "abc" } }'),
+            Entry(12.0, "", RECEIVED, '{ "cii" : { "contentId" : "def" } }'),
+        ]
+
+    def test_replayedAtRecordedSpeed(self):
+        """Messages from the browser are applied to the engine, at the times they were recorded relative to the first event"""
+        replayer = ProxyReplayer(self.engine, self.makeEntries())
+        replayer.run()
+        self.assertEquals(self.sleeps, [0.5, 1.5])
+        self.assertEquals(self.ciiServer.cii.contentId, "def")
+        self.assertEquals(replayer.messagesReplayed, 2)
+        self.assertEquals(replayer.duration, 2.0)
+        self.assertTrue(replayer.messagesSent >= 1)
+        self.assertTrue(self.engine.serverEndpoint.serverConnected)
+
+    def test_replayedFaster(self):
+        """A speed multiple shortens the waits between messages"""
+        ProxyReplayer(self.engine, self.makeEntries(), speed=4).run()
+        self.assertEquals(self.sleeps, [0.125, 0.375])
+
+    def test_replayedAsFastAsPossible(self):
+        """With no speed, messages are applied without waiting"""
+        ProxyReplayer(self.engine, self.makeEntries(), speed=None).run()
+        self.assertEquals(self.sleeps, [])
+        self.assertEquals(self.ciiServer.cii.contentId, "def")
+
+    def test_connectedFromStartIfNotRecorded(self):
+        """If the recording does not begin with the browser connecting, it is treated as connected from the start"""
+        entries = self.makeEntries()[2:] + [ Entry(13.0, "", DISCONNECTED) ]
+        replayer = ProxyReplayer(self.engine, entries, speed=None)
+        replayer.run()
+        self.assertEquals(replayer.messagesReplayed, 2)
+        self.assertFalse(self.engine.serverEndpoint.serverConnected)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import time
+
+import sys
+sys.path.append("../../src/python")
+from ProxyRelay import UpstreamFeed, UpstreamWallClock
+from ProxySessionRegistry import ProxySessionRegistry
+
+from dvbcss.protocol.client import ConnectionError
+from dvbcss.protocol.cii import CII
+from dvbcss.protocol.ts import ControlTimestamp, Timestamp
+from dvbcss.protocol import OMIT
+from dvbcss.clock import SysClock, TunableClock
+
+from mock_timer import MockTimer
+
+PTS = "urn:dvb:css:timeline:pts"
+TEMI = "urn:dvb:css:timeline:temi:1:1"
+
+
+class MockConnection(object):
+    """Stands in for the CSS-CII and CSS-TS client connections of pydvbcss"""
+
+    failConnect = False
+
+    def __init__(self, url, contentIdStem=None, timelineSelector=None):
+        self.url = url
+        self.contentIdStem = contentIdStem
+        self.timelineSelector = timelineSelector
+        self.connected = False
+        self.disconnected = False
+        MockConnection.made.append(self)
+
+    def connect(self):
+        if MockConnection.failConnect:
+            raise ConnectionError()
+        self.connected = True
+
+    def disconnect(self, code=1001, reason=''):
+        self.connected = False
+        self.disconnected = True
+
+
+def runTimers():
+    """Fire timers that fire immediately, including any they start, until none are left"""
+    while True:
+        due = [ timer for timer in MockTimer.mock_running() if timer.interval == 0 ]
+        if not due:
+            return
+        for timer in due:
+            timer.mock_fire()
+
+
+class Test_UpstreamFeed(unittest.TestCase):
+    """Tests of UpstreamFeed"""
+
+    def setUp(self):
+        self._orig = (UpstreamFeed.CIIConnection, UpstreamFeed.TSConnection, UpstreamFeed.__dict__["Timer"])
+        UpstreamFeed.CIIConnection = MockConnection
+        UpstreamFeed.TSConnection = MockConnection
+        UpstreamFeed.Timer = MockTimer
+        MockTimer.mock_reset()
+        MockConnection.made = []
+        MockConnection.failConnect = False
+
+        self.feed = UpstreamFeed("ws://upstream:7681/cii/lounge", retryInterval=5.0)
+        self.updates = []
+        self.events = []
+        self.feed.onUpdate = lambda cii, cts, options: self.updates.append((cii, cts, options))
+        self.feed.onServerConnected = lambda : self.events.append("connected")
+        self.feed.onServerDisconnected = lambda : self.events.append("disconnected")
+        self.feed.onWallClockUrlChanged = lambda wcUrl : self.events.append(wcUrl)
+
+    def tearDown(self):
+        UpstreamFeed.CIIConnection, UpstreamFeed.TSConnection, UpstreamFeed.Timer = self._orig
+
+    def _connect(self):
+        self.feed.enabled = True
+        runTimers()
+        ciiConn = MockConnection.made[0]
+        ciiConn.onConnected()
+        cii = CII(contentId="dvb://1234", tsUrl="ws://upstream:7681/ts/lounge", wcUrl="udp://upstream:6677")
+        ciiConn.onCII(cii)
+        runTimers()
+        return ciiConn
+
+    def test_connectsToUpstreamCii(self):
+        """When enabled, the feed connects to the upstream CII server, and is connected once that connection opens"""
+        self.assertEquals(MockConnection.made, [])
+        self.feed.enabled = True
+        runTimers()
+        self.assertEquals(len(MockConnection.made), 1)
+        self.assertEquals(MockConnection.made[0].url, "ws://upstream:7681/cii/lounge")
+        self.assertFalse(self.feed.serverConnected)
+
+        MockConnection.made[0].onConnected()
+        self.assertTrue(self.feed.serverConnected)
+        self.assertEquals(self.events, [ "connected" ])
+
+    def test_ciiPassedOnAsUpdate(self):
+        """CII messages from upstream are passed on as updates, and the wall clock URL reported"""
+        self._connect()
+        self.assertEquals(len(self.updates), 1)
+        cii, cts, options = self.updates[0]
+        self.assertEquals(cii.contentId, "dvb://1234")
+        self.assertEquals(cts, {})
+        self.assertEquals(self.events, [ "connected", "udp://upstream:6677" ])
+
+    def test_tsConnectionPerRequestedTimeline(self):
+        """A CSS-TS connection is opened to upstream for each timeline requested, and closed when it is no longer requested"""
+        self._connect()
+        self.feed.sendTimelinesRequest([PTS, TEMI], [PTS, TEMI], [])
+        runTimers()
+        tsConns = dict((conn.timelineSelector, conn) for conn in MockConnection.made[1:])
+        self.assertEquals(sorted(tsConns.keys()), [ PTS, TEMI ])
+        for conn in tsConns.values():
+            self.assertEquals(conn.url, "ws://upstream:7681/ts/lounge")
+            self.assertEquals(conn.contentIdStem, "")
+            self.assertTrue(conn.connected)
+
+        self.feed.sendTimelinesRequest([PTS], [], [TEMI])
+        runTimers()
+        self.assertTrue(tsConns[TEMI].disconnected)
+        self.assertFalse(tsConns[PTS].disconnected)
+
+    def test_timelinesRequestedBeforeConnectedAreOpenedLater(self):
+        """Timelines requested before the upstream TS URL is known are connected to once it is"""
+        self.feed.sendTimelinesRequest([PTS], [PTS], [])
+        self._connect()
+        self.assertEquals([ conn.timelineSelector for conn in MockConnection.made[1:] ], [ PTS ])
+
+    def test_controlTimestampPassedOnAsUpdate(self):
+        """Control Timestamps from upstream are passed on as updates for their timeline"""
+        self._connect()
+        self.feed.sendTimelinesRequest([PTS], [PTS], [])
+        runTimers()
+        ct = ControlTimestamp(Timestamp(1000, 2000), 1.0)
+        MockConnection.made[1].onControlTimestamp(ct)
+        cii, cts, options = self.updates[-1]
+        self.assertEquals(cts, { PTS : ct })
+        self.assertEquals(cii.contentId, OMIT)
+
+    def test_reconnectsAfterDisconnection(self):
+        """When the CII connection closes, TS connections are closed and the connection is retried after the retry interval"""
+        ciiConn = self._connect()
+        self.feed.sendTimelinesRequest([PTS], [PTS], [])
+        runTimers()
+        tsConn = MockConnection.made[1]
+
+        ciiConn.onDisconnected(1001)
+        self.assertFalse(self.feed.serverConnected)
+        self.assertEquals(self.events[-1], "disconnected")
+        self.assertEquals([ timer.interval for timer in MockTimer.mock_running() ], [ 5.0 ])
+
+        MockTimer.mock_running()[0].mock_fire()
+        self.assertTrue(tsConn.disconnected)
+        self.assertEquals(MockConnection.made[2].url, "ws://upstream:7681/cii/lounge")
+        self.assertTrue(MockConnection.made[2].connected)
+
+    def test_retriesFailedConnection(self):
+        """A connection that cannot be opened is retried after the retry interval"""
+        MockConnection.failConnect = True
+        self.feed.enabled = True
+        runTimers()
+        self.assertEquals([ timer.interval for timer in MockTimer.mock_running() ], [ 5.0 ])
+
+        MockConnection.failConnect = False
+        MockTimer.mock_running()[0].mock_fire()
+        self.assertTrue(MockConnection.made[-1].connected)
+
+    def test_disablingDisconnects(self):
+        """Disabling the feed closes all connections, and they are not retried"""
+        ciiConn = self._connect()
+        self.feed.sendTimelinesRequest([PTS], [PTS], [])
+        runTimers()
+
+        self.feed.enabled = False
+        self.assertTrue(ciiConn.disconnected)
+        self.assertTrue(MockConnection.made[1].disconnected)
+        self.assertEquals(self.events[-1], "disconnected")
+        self.assertEquals(MockTimer.mock_running(), [])
+
+
+class MockWallClockClient(object):
+    """Stands in for the pydvbcss WallClockClient"""
+
+    def __init__(self, bind, dest, wallClock, algorithm):
+        self.dest = dest
+        self.algorithm = algorithm
+        self.running = False
+        MockWallClockClient.made.append(self)
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+
+class Test_UpstreamWallClock(unittest.TestCase):
+    """Tests of UpstreamWallClock"""
+
+    def setUp(self):
+        self._orig = (UpstreamWallClock.Client, UpstreamWallClock.__dict__["Timer"])
+        UpstreamWallClock.Client = MockWallClockClient
+        UpstreamWallClock.Timer = MockTimer
+        MockTimer.mock_reset()
+        MockWallClockClient.made = []
+        self.sysClock = SysClock(tickRate=1000000000)
+        self.wallClock = TunableClock(self.sysClock, tickRate=1000000000)
+        self.clock = UpstreamWallClock(self.wallClock, refreshInterval=1.0)
+        self.reported = []
+        self.clock.onPrecisionChanged = self.reported.append
+
+    def tearDown(self):
+        UpstreamWallClock.Client, UpstreamWallClock.Timer = self._orig
+
+    def _adjust(self, error):
+        """Put the wall clock in step, with the given error growing at 500ppm, as the algorithm would"""
+        self.wallClock.correlation = self.wallClock.correlation.butWith(parentTicks=self.sysClock.ticks, childTicks=self.wallClock.ticks, initialError=error, errorGrowthRate=0.0005)
+        MockWallClockClient.made[-1].algorithm.onClockAdjusted(self.wallClock.ticks, 0, 0, error*1000000000, 0)
+
+    def test_followsWallClockServer(self):
+        """A wall clock client is started for the server, and replaced if the server changes"""
+        self.clock.follow("udp://upstream:6677")
+        self.clock.follow("udp://upstream:6677")
+        self.assertEquals([ (c.dest, c.running) for c in MockWallClockClient.made ], [ (("upstream", 6677), True) ])
+
+        self.clock.follow("udp://other:6678")
+        self.assertEquals([ (c.dest, c.running) for c in MockWallClockClient.made ], [ (("upstream", 6677), False), (("other", 6678), True) ])
+
+        self.clock.stop()
+        self.assertFalse(MockWallClockClient.made[1].running)
+
+    def test_precisionUntilInStep(self):
+        """Until the wall clock is in step with an upstream wall clock, the largest precision is reported"""
+        self.assertEquals(self.clock.precision, UpstreamWallClock.MAX_PRECISION)
+        self.clock.follow("udp://upstream:6677")
+        self.assertEquals(self.reported, [ UpstreamWallClock.MAX_PRECISION ])
+
+    def test_precisionIncludesDispersion(self):
+        """The precision reported when the clock is adjusted is its dispersion by the next refresh"""
+        self.clock.follow("udp://upstream:6677")
+        self._adjust(0.002)
+        self.assertEquals(len(self.reported), 2)
+        # the error grows for the refresh interval of 1 second, and the system clock adds its own precision
+        self.assertAlmostEquals(self.reported[-1], 0.002 + 0.0005 + self.sysClock.dispersionAtTime(self.sysClock.ticks), delta=0.00001)
+
+    def test_precisionRefreshedPeriodically(self):
+        """While following, the precision is reported again every refresh interval, and no longer once stopped"""
+        self.clock.follow("udp://upstream:6677")
+        self._adjust(0.002)
+        self.assertEquals([ timer.interval for timer in MockTimer.mock_running() ], [ 1.0 ])
+        MockTimer.mock_running()[0].mock_fire()
+        self.assertEquals(len(self.reported), 3)
+        self.assertEquals(len(MockTimer.mock_running()), 1)
+
+        self.clock.stop()
+        self.assertEquals(MockTimer.mock_running(), [])
+
+    def test_onlyUdp(self):
+        """Only UDP wall clock servers can be followed"""
+        self.assertRaises(ValueError, self.clock.follow, "ws://upstream:7681/wcws")
+
+
+def waitFor(condition):
+    """Wait (for up to 2 seconds) until the condition is true"""
+    deadline = time.time() + 2.0
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class Test_Relaying(unittest.TestCase):
+    """Tests of a relayed session, using real timers"""
+
+    def setUp(self):
+        self._orig = (UpstreamFeed.CIIConnection, UpstreamFeed.TSConnection, UpstreamWallClock.Client)
+        UpstreamFeed.CIIConnection = MockConnection
+        UpstreamFeed.TSConnection = MockConnection
+        UpstreamWallClock.Client = MockWallClockClient
+        MockConnection.made = []
+        MockConnection.failConnect = False
+        MockWallClockClient.made = []
+
+        self.wallClock = TunableClock(SysClock(tickRate=1000000000), tickRate=1000000000)
+        self.registry = ProxySessionRegistry(self.wallClock, "ws://flurble:7681", "udp://flurble:6677")
+        self.feed = UpstreamFeed("ws://upstream:7681/cii/lounge", retryInterval=0.05)
+        self.upstreamClock = UpstreamWallClock(self.wallClock, refreshInterval=0.02)
+        self.feed.onWallClockUrlChanged = self.upstreamClock.follow
+        self.engine = self.registry.createSession("", serverEndpoint=self.feed)
+
+    def tearDown(self):
+        self.feed.enabled = False
+        self.upstreamClock.stop()
+        self.registry.removeSession("")
+        UpstreamFeed.CIIConnection, UpstreamFeed.TSConnection, UpstreamWallClock.Client = self._orig
+
+    def test_relaysFromUpstream(self):
+        """The relay connects upstream, serves the CII it receives, opens TS connections for timelines, and follows the upstream wall clock"""
+        self.feed.enabled = True
+        self.assertTrue(waitFor(lambda : len(MockConnection.made) == 1 and MockConnection.made[0].connected))
+        ciiConn = MockConnection.made[0]
+        self.assertFalse(self.engine.ciiServer.enabled)
+
+        ciiConn.onConnected()
+        ciiConn.onCII(CII(contentId="dvb://1234", tsUrl="ws://upstream:7681/ts/lounge", wcUrl="udp://upstream:6677"))
+        self.assertTrue(self.engine.ciiServer.enabled)
+        self.assertTrue(waitFor(lambda : self.engine.ciiServer.cii.contentId == "dvb://1234"))
+        self.assertEquals([ c.dest for c in MockWallClockClient.made ], [ ("upstream", 6677) ])
+
+        reported = []
+        self.upstreamClock.onPrecisionChanged = reported.append
+        self.assertTrue(waitFor(lambda : len(reported) >= 2))
+
+        self.feed.sendTimelinesRequest([PTS], [PTS], [])
+        self.assertTrue(waitFor(lambda : [ c.timelineSelector for c in MockConnection.made[1:] if c.connected ] == [ PTS ]))
+
+    def test_retriesUpstream(self):
+        """A connection to the upstream proxy that cannot be opened is retried"""
+        MockConnection.failConnect = True
+        self.feed.enabled = True
+        self.assertTrue(waitFor(lambda : len(MockConnection.made) >= 2))
+        MockConnection.failConnect = False
+        self.assertTrue(waitFor(lambda : MockConnection.made[-1].connected))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
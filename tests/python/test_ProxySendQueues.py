@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import unittest
+import threading
+import time
+
+import sys
+sys.path.append("../../src/python")
+import ProxyMetrics
+from ProxySendQueues import ProxySendQueues
+
+
+class MockHandler(object):
+    """Stands in for a WebSocket handler. Sending can be held up until released, to simulate a slow client."""
+
+    def __init__(self):
+        super(MockHandler,self).__init__()
+        self.sent = []
+        self.terminated = False
+        self.release = threading.Event()
+        self.release.set()
+        self.sending = threading.Event()
+
+    def send(self, payload, binary=False):
+        self.sending.set()
+        self.release.wait()
+        self.sent.append(payload)
+
+    def terminate(self):
+        self.terminated = True
+        self.release.set()
+
+
+def waitUntil(condition, timeout=2.0):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.001)
+
+
+class Test_ProxySendQueues(unittest.TestCase):
+    """Tests of ProxySendQueues"""
+
+    def setUp(self):
+        self.queues = ProxySendQueues(numWriters=2, capacity=3, maxLag=10.0)
+
+    def tearDown(self):
+        self.queues.stop()
+
+    def test_messagesSentInOrder(self):
+        """Messages are sent by a writer thread, in the order they were queued"""
+        handler = self.queues.handlerClass(MockHandler, "flurble")()
+        handler.send("a")
+        handler.send("b")
+        waitUntil(lambda : len(handler.sent) == 2)
+        self.assertEquals(handler.sent, ["a", "b"])
+
+    def test_slowClientDoesNotHoldUpOthers(self):
+        """While sending to one client is held up, messages are still sent to another"""
+        cls = self.queues.handlerClass(MockHandler, "flurble")
+        slow = cls()
+        fast = cls()
+        slow.release.clear()
+        slow.send("a")
+        slow.sending.wait(2.0)
+        fast.send("b")
+        waitUntil(lambda : fast.sent == ["b"])
+        self.assertEquals(slow.sent, [])
+        slow.release.set()
+        waitUntil(lambda : slow.sent == ["a"])
+
+    def test_latestWins(self):
+        """With latest-wins, a newer message replaces those still waiting to be sent"""
+        handler = self.queues.handlerClass(MockHandler, "flurble-latest", latestWins=True)()
+        replaced = ProxyMetrics.sendQueueReplaced("flurble-latest")
+        before = replaced.value
+        handler.release.clear()
+        handler.send("1")
+        handler.sending.wait(2.0)
+        for payload in ["2", "3", "4", "5"]:
+            handler.send(payload)
+        handler.release.set()
+        waitUntil(lambda : handler.sent == ["1", "5"])
+        self.assertEquals(replaced.value - before, 3)
+        self.assertFalse(handler.terminated)
+
+    def test_evictedWhenQueueFull(self):
+        """A client is disconnected if its queue is full, and nothing more is sent to it"""
+        handler = self.queues.handlerClass(MockHandler, "flurble-full")()
+        evictions = ProxyMetrics.sendQueueEvictions("flurble-full")
+        before = evictions.value
+        handler.release.clear()
+        handler.send("1")
+        handler.sending.wait(2.0)
+        for payload in ["2", "3", "4"]:
+            handler.send(payload)
+        self.assertFalse(handler.terminated)
+        handler.send("5")
+        self.assertTrue(handler.terminated)
+        self.assertEquals(evictions.value - before, 1)
+        handler.send("6")
+        waitUntil(lambda : handler.sent == ["1"])
+        time.sleep(0.01)
+        self.assertEquals(handler.sent, ["1"])
+
+    def test_evictedWhenLagging(self):
+        """A client is disconnected if a message has been waiting to be sent to it for longer than the maximum lag"""
+        self.queues.maxLag = 0.05
+        handler = self.queues.handlerClass(MockHandler, "flurble-lag", latestWins=True)()
+        handler.release.clear()
+        handler.send("1")
+        handler.sending.wait(2.0)
+        handler.send("2")
+        self.assertFalse(handler.terminated)
+        time.sleep(0.1)
+        handler.send("3")
+        self.assertTrue(handler.terminated)
+
+    def test_evictedWhenLaggingMessageTakenFromQueue(self):
+        """A client is disconnected if the message a writer takes from its queue has waited longer than the maximum lag, even if nothing more is queued"""
+        self.queues.maxLag = 0.05
+        handler = self.queues.handlerClass(MockHandler, "flurble-lag-writer")()
+        evictions = ProxyMetrics.sendQueueEvictions("flurble-lag-writer")
+        before = evictions.value
+        handler.release.clear()
+        handler.send("1")
+        handler.sending.wait(2.0)
+        handler.send("2")
+        time.sleep(0.1)
+        handler.release.set()
+        waitUntil(lambda : handler.terminated)
+        self.assertEquals(handler.sent, ["1"])
+        self.assertEquals(evictions.value - before, 1)
+
+    def test_evictedWhenSendFails(self):
+        """A client is disconnected if sending to it fails, and nothing more is sent to it"""
+        class FailingHandler(MockHandler):
+            def send(self, payload, binary=False):
+                raise IOError("Connection reset")
+        handler = self.queues.handlerClass(FailingHandler, "flurble-fail")()
+        evictions = ProxyMetrics.sendQueueEvictions("flurble-fail")
+        before = evictions.value
+        handler.send("1")
+        waitUntil(lambda : handler.terminated)
+        self.assertEquals(evictions.value - before, 1)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
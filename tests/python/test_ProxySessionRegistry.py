@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import json
+
+import sys
+sys.path.append("../../src/python")
+from CssProxyEngine import CssProxyEngine
+from ProxySessionRegistry import ProxySessionRegistry, splitSessionPath
+from ProxyRecorder import ProxyRecorder, readRecording
+from ProxyRelay import UpstreamFeed
+from StringIO import StringIO
+
+from dvbcss.clock import SysClock
+
+from mock_wsServerBase import MockWSServerBase
+
+baseUrl = "ws://flurble:7681"
+wcUrl = "udp://flurble:6677"
+
+
+class Test_ProxySessionRegistry(unittest.TestCase):
+    """Tests of ProxySessionRegistry"""
+
+    def setUp(self):
+        self.mockServerBases = []
+        self._orig_ServerBase = CssProxyEngine.Server.ServerBase
+        CssProxyEngine.Server.ServerBase = self._mockWSServerBaseFactory
+        self.registry = ProxySessionRegistry(SysClock(), baseUrl, wcUrl)
+
+    def tearDown(self):
+        CssProxyEngine.Server.ServerBase = self._orig_ServerBase
+        for sessionId in self.registry.sessions:
+            self.registry.removeSession(sessionId)
+
+    def _mockWSServerBaseFactory(self, *args, **kwargs):
+        newServerBase = MockWSServerBase(*args, **kwargs)
+        self.mockServerBases.append(newServerBase)
+        return newServerBase
+
+    def test_splitSessionPath(self):
+        """Paths are split into endpoint name and session id, with the empty string for the default session"""
+        self.assertEquals(splitSessionPath("/cii"), ("cii", ""))
+        self.assertEquals(splitSessionPath("/cii/"), ("cii", ""))
+        self.assertEquals(splitSessionPath("/ts/lounge"), ("ts", "lounge"))
+
+    def test_companionCannotCreateSession(self):
+        """Connecting to the CII or TS endpoints of a session that does not exist is refused"""
+        self.assertIsNone(self.registry.handlerForPath("/cii/lounge"))
+        self.assertIsNone(self.registry.handlerForPath("/ts/lounge"))
+        self.assertEquals(self.registry.sessions, {})
+
+    def test_browserCreatesSession(self):
+        """A browser connecting to the server endpoint creates the session, and its CII and TS endpoints become available"""
+        handler = self.registry.handlerForPath("/server/lounge")
+        self.mockServerBases[-1].mock_clientConnects()
+        engine = self.registry.getSession("lounge")
+        self.assertIsNotNone(engine)
+        self.assertIs(handler, engine.serverEndpoint._server.handler)
+        self.assertIs(self.registry.handlerForPath("/cii/lounge"), engine.ciiServer.handler)
+        self.assertIs(self.registry.handlerForPath("/ts/lounge"), engine.tsServer.handler)
+
+    def test_sessionNotCreatedUntilBrowserConnects(self):
+        """A session is not created if the browser's connection never opens (e.g. the handshake fails)"""
+        self.assertIsNotNone(self.registry.handlerForPath("/server/lounge"))
+        self.assertEquals(self.registry.sessions, {})
+        self.assertIsNone(self.registry.handlerForPath("/cii/lounge"))
+
+    def test_secondNewBrowserForSessionRefused(self):
+        """If two browsers are each given a new session with the same ID, only the first to connect gets it"""
+        self.registry.handlerForPath("/server/lounge")
+        first = self.mockServerBases[-1]
+        self.registry.handlerForPath("/server/lounge")
+        second = self.mockServerBases[-1]
+        first.mock_clientConnects()
+        engine = self.registry.getSession("lounge")
+        second.mock_clientConnects()
+        self.assertIs(self.registry.getSession("lounge"), engine)
+        self.assertFalse(second.enabled)
+        self.assertTrue(first.enabled)
+
+    def test_browserOnlyFromAllowedAddresses(self):
+        """Sessions are only created for connections from the allowed addresses"""
+        self.assertIsNone(self.registry.handlerForPath("/server/lounge", "10.0.0.5", ["127.0.0.1"]))
+        self.assertIsNone(self.registry.getSession("lounge"))
+        self.assertIsNotNone(self.registry.handlerForPath("/server/lounge", "127.0.0.1", ["127.0.0.1"]))
+        self.mockServerBases[-1].mock_clientConnects()
+        self.assertIsNotNone(self.registry.getSession("lounge"))
+
+    def test_invalidSessionIdRefused(self):
+        """Session ids that cannot be safely used in a URL are refused"""
+        self.assertIsNone(self.registry.handlerForPath("/server/a b"))
+        self.assertIsNone(self.registry.handlerForPath("/server/a/b"))
+
+    def test_sessionsAreIndependent(self):
+        """Each session has its own CII and TS servers, advertised with session specific URLs"""
+        self.registry.handlerForPath("/server")
+        self.mockServerBases[-1].mock_clientConnects()
+        self.registry.handlerForPath("/server/lounge")
+        self.mockServerBases[-1].mock_clientConnects()
+        default = self.registry.getSession("")
+        lounge = self.registry.getSession("lounge")
+
+        self.assertIsNot(default.ciiServer, lounge.ciiServer)
+        self.assertIsNot(default.tsServer, lounge.tsServer)
+        self.assertIsNot(default.tsSource, lounge.tsSource)
+        self.assertEquals(default.ciiServer.cii.tsUrl, baseUrl+"/ts")
+        self.assertEquals(lounge.ciiServer.cii.tsUrl, baseUrl+"/ts/lounge")
+        self.assertEquals(lounge.ciiServer.cii.wcUrl, wcUrl)
+
+    def test_browserToldSessionCiiUrl(self):
+        """The browser is told the CII URL for its session when it connects"""
+        self.registry.handlerForPath("/server/lounge")
+        serverBase = self.mockServerBases[-1]
+        serverBase.mock_clientConnects()
+        msgs = serverBase.mock_popAllMessagesSentToClient()
+        self.assertEquals(json.loads(msgs[0])["ciiUrl"], baseUrl+"/cii/lounge")
+
+    def test_sessionDiscardedWhenBrowserDisconnects(self):
+        """When the browser disconnects, the session is discarded"""
+        self.registry.handlerForPath("/server/lounge")
+        serverBase = self.mockServerBases[-1]
+        serverBase.mock_clientConnects()
+        self.assertIsNotNone(self.registry.getSession("lounge"))
+
+        serverBase.mock_clientDisconnects()
+        self.assertIsNone(self.registry.getSession("lounge"))
+        self.assertIsNone(self.registry.handlerForPath("/cii/lounge"))
+
+    def test_engineOptionsPassedToSessions(self):
+        """Extra options given to the registry are passed to the engine of each session"""
+        registry = ProxySessionRegistry(SysClock(), baseUrl, wcUrl, tsTolerance=0.002)
+        registry.handlerForPath("/server/lounge")
+        self.mockServerBases[-1].mock_clientConnects()
+        self.assertEquals(registry.getSession("lounge").tsSource.tolerance, 0.002)
+        registry.removeSession("lounge")
+
+    def test_sessionsRecordedUnderTheirIds(self):
+        """With a recorder, the messages of each session are recorded against its session ID"""
+        f = StringIO()
+        recorder = ProxyRecorder(f)
+        registry = ProxySessionRegistry(SysClock(), baseUrl, wcUrl, recorder=recorder)
+        registry.handlerForPath("/server/lounge")
+        self.mockServerBases[-1].mock_clientConnects()
+        registry.handlerForPath("/server")
+        self.mockServerBases[-1].mock_clientConnects()
+        recorder.flush()
+        sessionIds = [ e.sessionId for e in readRecording(StringIO(f.getvalue())) ]
+        self.assertIn("lounge", sessionIds)
+        self.assertIn("", sessionIds)
+        for sessionId in registry.sessions:
+            registry.removeSession(sessionId)
+        recorder.close()
+
+    def test_relayedSessionKept(self):
+        """A session fed from an upstream proxy has no server endpoint, and is kept when the upstream proxy disconnects"""
+        feed = UpstreamFeed("ws://upstream:7681/cii/lounge")
+        engine = self.registry.createSession("lounge", serverEndpoint=feed)
+        self.assertIs(engine.serverEndpoint, feed)
+        self.assertIsNone(self.registry.handlerForPath("/server/lounge"))
+        self.assertIs(self.registry.handlerForPath("/cii/lounge"), engine.ciiServer.handler)
+
+        feed.onServerDisconnected()
+        self.assertIs(self.registry.getSession("lounge"), engine)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
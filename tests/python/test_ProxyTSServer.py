@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import json
+
+import sys
+sys.path.append("../../src/python")
+from CssProxyEngine import ProxyTSServer
+from ProxyTimelineSource import ProxyTimelineSource
+from ProxyTracer import ProxyTracer
+
+from dvbcss.clock import SysClock
+from dvbcss.protocol.server.ts import SimpleTimelineSource
+from dvbcss.protocol.ts import ControlTimestamp, Timestamp
+
+from mock_wsServerBase import Mock_WebSock
+
+PTS = "urn:dvb:css:timeline:pts"
+TEMI = "urn:dvb:css:timeline:temi:1:1"
+
+
+class Test_ProxyTSServer(unittest.TestCase):
+    """Tests of ProxyTSServer"""
+
+    def setUp(self):
+        self.tsServer = ProxyTSServer("dvb://1234", SysClock(), maxConnectionsAllowed=-1, enabled=True)
+        self.tsSource = ProxyTimelineSource()
+        self.tsServer.attachTimelineSource(self.tsSource)
+
+    def tearDown(self):
+        self.tsServer.enabled = False
+
+    def _clientConnects(self, timelineSelector, contentIdStem="dvb://1234", popMessages=True):
+        webSock = Mock_WebSock()
+        self.tsServer._addConnection(webSock)
+        self.tsServer._receivedMessage(webSock, json.dumps({ "contentIdStem":contentIdStem, "timelineSelector":timelineSelector }))
+        if popMessages:
+            webSock.mock_popReceivedMessages()
+        return webSock
+
+    def test_sameSerialisedMessageSentToAllClients(self):
+        """A Control Timestamp is serialised once and that same message sent to every client using the timeline"""
+        clients = [ self._clientConnects(PTS) for i in range(0,5) ]
+
+        self.tsSource.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0) })
+        self.tsServer.updateAllClients()
+
+        received = [ c.mock_popReceivedMessages() for c in clients ]
+        for msgs in received:
+            self.assertEquals(len(msgs), 1)
+            self.assertIs(msgs[0], received[0][0])
+        self.assertEquals(json.loads(received[0][0]), { "contentTime":"1000", "wallClockTime":"2000", "timelineSpeedMultiplier":1.0 })
+
+    def test_unchangedControlTimestampNotResent(self):
+        """Clients are not sent the Control Timestamp again if it has not changed"""
+        client = self._clientConnects(PTS)
+        self.tsSource.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0) })
+        self.tsServer.updateAllClients()
+        self.assertEquals(len(client.mock_popReceivedMessages()), 1)
+
+        self.tsServer.updateAllClients()
+        self.assertEquals(client.mock_popReceivedMessages(), [])
+
+    def test_clientsOnlySentTheirTimeline(self):
+        """Clients are sent the Control Timestamp for the timeline they asked for"""
+        ptsClient = self._clientConnects(PTS)
+        temiClient = self._clientConnects(TEMI)
+
+        self.tsSource.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0),
+                                        TEMI : ControlTimestamp(Timestamp(5, 2000), 0.0) })
+        self.tsServer.updateAllClients()
+        self.assertEquals(json.loads(ptsClient.mock_popReceivedMessages()[0])["contentTime"], "1000")
+        self.assertEquals(json.loads(temiClient.mock_popReceivedMessages()[0])["contentTime"], "5")
+
+    def test_unavailableIfContentIdDoesNotMatch(self):
+        """Clients whose content id stem does not match are told the timeline is unavailable"""
+        self.tsSource.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0) })
+        client = self._clientConnects(PTS, contentIdStem="dvb://9999", popMessages=False)
+        self.assertEquals(json.loads(client.mock_popReceivedMessages()[0])["contentTime"], None)
+
+    def test_otherTimelineSourcesStillSupported(self):
+        """Timeline sources that do not provide serialised messages are still supported"""
+        self.tsServer.removeTimelineSource(self.tsSource)
+        self.tsServer.attachTimelineSource(SimpleTimelineSource(TEMI, ControlTimestamp(Timestamp(7, 2000), 1.0)))
+        client = self._clientConnects(TEMI, popMessages=False)
+        self.assertEquals(json.loads(client.mock_popReceivedMessages()[0])["contentTime"], "7")
+
+    def test_updateClientsForSelectorsOnlyUpdatesThoseClients(self):
+        """Only clients using one of the specified timelines are updated"""
+        ptsClient = self._clientConnects(PTS)
+        temiClient = self._clientConnects(TEMI)
+        self.tsSource.timelinesUpdate({
+            PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0),
+            TEMI : ControlTimestamp(Timestamp(5, 2000), 1.0)
+        })
+
+        self.tsServer.updateClientsForSelectors([ TEMI ])
+        self.assertEquals(ptsClient.mock_popReceivedMessages(), [])
+        self.assertEquals(len(temiClient.mock_popReceivedMessages()), 1)
+
+    def test_eachSendBatchTraced(self):
+        """With a tracer, updating the clients of each timeline is marked"""
+        tracer = ProxyTracer()
+        self.tsServer = ProxyTSServer("dvb://1234", SysClock(), maxConnectionsAllowed=-1, enabled=True, tracer=tracer)
+        self.tsServer.attachTimelineSource(self.tsSource)
+        self._clientConnects(PTS)
+        self._clientConnects(PTS)
+        self._clientConnects(TEMI)
+
+        tracer.begin("update")
+        self.tsSource.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0), TEMI : ControlTimestamp(Timestamp(5, 2000), 1.0) })
+        self.tsServer.updateClientsForSelectors([PTS, TEMI])
+        tracer.end()
+
+        stages = tracer.dump()[0]["stages"]
+        self.assertEquals([ (s["stage"], s.get("timelineSelector"), s.get("clients")) for s in stages ], [
+            ("begin", None, None),
+            ("ts send batch", PTS, 2),
+            ("ts send batch", TEMI, 1),
+            ("end", None, None),
+        ])
+
+    def test_subscribersIndexedBySelector(self):
+        """The clients using each timeline are tracked as they set up and disconnect"""
+        ptsClients = [ self._clientConnects(PTS) for i in range(0,3) ]
+        self._clientConnects(TEMI)
+        self.assertEquals(self.tsServer.subscriberCount(PTS), 3)
+        self.assertEquals(self.tsServer.subscriberCount(TEMI), 1)
+
+        self.tsServer._removeConnection(ptsClients[0])
+        self.assertEquals(self.tsServer.subscriberCount(PTS), 2)
+
+        unsetup = Mock_WebSock()
+        self.tsServer._addConnection(unsetup)
+        self.tsServer._removeConnection(unsetup)
+        self.assertEquals(self.tsServer.subscriberCount(PTS), 2)
+
+    def test_updateClientsForSelectorsSkipsDiscardedConnections(self):
+        """Connections discarded when the server was disabled are not updated"""
+        client = self._clientConnects(PTS)
+        self.tsServer.enabled = False
+        self.tsServer.enabled = True
+        self.tsSource.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0) })
+
+        self.tsServer.updateClientsForSelectors([ PTS ])
+        self.assertEquals(client.mock_popReceivedMessages(), [])
+        self.assertEquals(self.tsServer.subscriberCount(PTS), 0)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
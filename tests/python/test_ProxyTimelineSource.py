@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import json
+import threading
+
+import sys
+sys.path.append("../../src/python")
+from ProxyTimelineSource import ProxyTimelineSource
+
+from dvbcss.protocol.ts import ControlTimestamp, Timestamp
+from dvbcss.protocol.cii import TimelineOption
+
+from mock_timer import MockTimer
+
+PTS = "urn:dvb:css:timeline:pts"
+
+
+class Test_ProxyTimelineSource(unittest.TestCase):
+    """Tests of ProxyTimelineSource"""
+
+    def test_noPackedControlTimestampUntilProvided(self):
+        """There is no serialised Control Timestamp for a timeline until one is provided"""
+        src = ProxyTimelineSource()
+        self.assertIsNone(src.getPackedControlTimestamp(PTS))
+        src.timelineSelectorNeeded(PTS)
+        self.assertIsNone(src.getPackedControlTimestamp(PTS))
+
+    def test_packedControlTimestampCached(self):
+        """The serialised Control Timestamp is only serialised once until it changes"""
+        src = ProxyTimelineSource()
+        src.timelineSelectorNeeded(PTS)
+        src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0) })
+
+        packed = src.getPackedControlTimestamp(PTS)
+        self.assertEquals(json.loads(packed), { "contentTime":"1000", "wallClockTime":"2000", "timelineSpeedMultiplier":1.0 })
+        self.assertIs(src.getPackedControlTimestamp(PTS), packed)
+
+    def test_packedControlTimestampInvalidatedByUpdate(self):
+        """The serialised Control Timestamp is updated when a new Control Timestamp is provided"""
+        src = ProxyTimelineSource()
+        src.timelineSelectorNeeded(PTS)
+        src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0) })
+        src.getPackedControlTimestamp(PTS)
+
+        src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1500, 3000), 0.5) })
+        self.assertEquals(json.loads(src.getPackedControlTimestamp(PTS)), { "contentTime":"1500", "wallClockTime":"3000", "timelineSpeedMultiplier":0.5 })
+
+    def test_packedControlTimestampForgottenWhenNotNeeded(self):
+        """The serialised Control Timestamp is discarded when the timeline is no longer needed"""
+        src = ProxyTimelineSource()
+        src.timelineSelectorNeeded(PTS)
+        src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0) })
+        src.getPackedControlTimestamp(PTS)
+
+        src.timelineSelectorNotNeeded(PTS)
+        self.assertIsNone(src.getPackedControlTimestamp(PTS))
+
+    def test_timelinesUpdateReportsChangedSelectors(self):
+        """timelinesUpdate returns the selectors of needed timelines whose Control Timestamps changed"""
+        src = ProxyTimelineSource()
+        src.timelineSelectorNeeded(PTS)
+        changed = src.timelinesUpdate({
+            PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0),
+            "urn:dvb:css:timeline:temi:1:1" : ControlTimestamp(Timestamp(5, 2000), 1.0)
+        })
+        self.assertEquals(changed, [ PTS ])
+
+    def test_extrapolationEquivalentControlTimestampIgnored(self):
+        """A Control Timestamp on the same line as the previous one (same speed, within a tick) is not a change"""
+        src = ProxyTimelineSource()
+        src.timelineSelectorNeeded(PTS)
+        first = ControlTimestamp(Timestamp(90000, 1000000000), 1.0)
+        src.timelinesUpdate({ PTS : first })
+        packed = src.getPackedControlTimestamp(PTS)
+
+        # 0.5 seconds later, 45000 ticks later at 90kHz (plus rounding)
+        changed = src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(135001, 1500000000), 1.0) })
+        self.assertEquals(changed, [])
+        self.assertIs(src.getControlTimestamp(PTS), first)
+        self.assertIs(src.getPackedControlTimestamp(PTS), packed)
+
+        # a jump, or a speed change, is a change
+        self.assertEquals(src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(140000, 1500000000), 1.0) }), [ PTS ])
+        self.assertEquals(src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(140000, 1500000000), 0.0) }), [ PTS ])
+
+    def test_unavailableTimelineUnchanged(self):
+        """Repeatedly saying a timeline is unavailable is not a change"""
+        src = ProxyTimelineSource()
+        src.timelineSelectorNeeded(PTS)
+        self.assertEquals(src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(None, 2000), None) }), [ PTS ])
+        self.assertEquals(src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(None, 9000), None) }), [])
+
+    def test_tickRateFromTimelineOptions(self):
+        """The tick rate for timelines not implied by their selector is taken from the CII timelines property"""
+        sel = "urn:dvb:css:timeline:temi:1:1"
+        src = ProxyTimelineSource()
+        src.timelineSelectorNeeded(sel)
+        src.timelinesUpdate({ sel : ControlTimestamp(Timestamp(100, 1000000000), 1.0) })
+
+        # without a known tick rate, only identical Control Timestamps are equivalent
+        self.assertEquals(src.timelinesUpdate({ sel : ControlTimestamp(Timestamp(101, 1020000000), 1.0) }), [ sel ])
+
+        src.setTimelineOptions([ TimelineOption(sel, unitsPerTick=1, unitsPerSecond=50) ])
+        self.assertEquals(src.timelinesUpdate({ sel : ControlTimestamp(Timestamp(102, 1040000000), 1.0) }), [])
+
+    def test_toleranceSuppressesSmallCorrections(self):
+        """With a tolerance set, Control Timestamps within that tolerance of the extrapolated timeline are not changes"""
+        src = ProxyTimelineSource(tolerance=0.001)
+        src.timelineSelectorNeeded(PTS)
+        src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(90000, 1000000000), 1.0) })
+
+        # 0.8ms (72 ticks) out is within tolerance
+        self.assertEquals(src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(135072, 1500000000), 1.0) }), [])
+        # 1.2ms (108 ticks) out is not
+        self.assertEquals(src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(135108, 1500000000), 1.0) }), [ PTS ])
+
+    def test_relayedAndSuppressedCounted(self):
+        """The number of Control Timestamps relayed and suppressed are counted"""
+        src = ProxyTimelineSource()
+        src.timelineSelectorNeeded(PTS)
+        src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(90000, 1000000000), 1.0) })
+        src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(135000, 1500000000), 1.0) })
+        src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(180000, 2000000000), 1.0) })
+        src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(180000, 2000000000), 0.0) })
+        self.assertEquals(src.relayedCount, 2)
+        self.assertEquals(src.suppressedCount, 2)
+
+    def test_lingerEndsWithRealTimer(self):
+        """The request for a timeline is withdrawn at the end of the linger period, using a real timer"""
+        src = ProxyTimelineSource(linger=0.05)
+        withdrawn = threading.Event()
+        src.onRequestedTimelinesChanged = lambda selectors, added, removed: removed and withdrawn.set()
+        src.timelineSelectorNeeded(PTS)
+        src.timelineSelectorNotNeeded(PTS)
+        self.assertTrue(withdrawn.wait(2.0))
+        self.assertFalse(src.recognisesTimelineSelector(PTS))
+
+
+class Test_Linger(unittest.TestCase):
+    """Tests of ProxyTimelineSource keeping timelines for a while after they are no longer needed"""
+
+    def setUp(self):
+        self._orig_Timer = ProxyTimelineSource.__dict__["Timer"]
+        ProxyTimelineSource.Timer = MockTimer
+        MockTimer.mock_reset()
+        self.src = ProxyTimelineSource(linger=5.0)
+        self.requests = []
+        self.src.onRequestedTimelinesChanged = lambda selectors, added, removed: self.requests.append((sorted(selectors), added, removed))
+
+    def tearDown(self):
+        ProxyTimelineSource.Timer = self._orig_Timer
+
+    def test_withdrawnImmediatelyWithoutLinger(self):
+        """Without a linger period, the request for a timeline is withdrawn as soon as it is not needed"""
+        self.src.linger = 0
+        self.src.timelineSelectorNeeded(PTS)
+        self.src.timelineSelectorNotNeeded(PTS)
+        self.assertEquals(self.requests, [ ([PTS], [PTS], []), ([], [], [PTS]) ])
+        self.assertEquals(MockTimer.mock_running(), [])
+
+    def test_withdrawnAtEndOfLinger(self):
+        """The request for a timeline is withdrawn when the linger period ends"""
+        self.src.timelineSelectorNeeded(PTS)
+        self.src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0) })
+        self.src.timelineSelectorNotNeeded(PTS)
+        self.assertEquals(self.requests, [ ([PTS], [PTS], []) ])
+        self.assertTrue(self.src.recognisesTimelineSelector(PTS))
+        self.assertEquals(self.src.lingeringTimelineSelectors(), [ PTS ])
+        self.assertEquals(MockTimer.mock_running()[0].interval, 5.0)
+
+        MockTimer.mock_running()[0].mock_fire()
+        self.assertEquals(self.requests, [ ([PTS], [PTS], []), ([], [], [PTS]) ])
+        self.assertFalse(self.src.recognisesTimelineSelector(PTS))
+        self.assertIsNone(self.src.getPackedControlTimestamp(PTS))
+        self.assertEquals(self.src.lingeringTimelineSelectors(), [])
+
+    def test_neededAgainWhileLingering(self):
+        """A timeline needed again during the linger period has its latest Control Timestamp available, without being requested again"""
+        self.src.timelineSelectorNeeded(PTS)
+        self.src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 2000), 1.0) })
+        self.src.timelineSelectorNotNeeded(PTS)
+        self.src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1500, 3000), 0.5) })
+
+        self.src.timelineSelectorNeeded(PTS)
+        self.assertEquals(self.requests, [ ([PTS], [PTS], []) ])
+        self.assertEquals(MockTimer.mock_running(), [])
+        self.assertEquals(self.src.lingeringTimelineSelectors(), [])
+        self.assertEquals(json.loads(self.src.getPackedControlTimestamp(PTS)), { "contentTime":"1500", "wallClockTime":"3000", "timelineSpeedMultiplier":0.5 })
+
+
+class Test_Unavailable(unittest.TestCase):
+    """Tests of ProxyTimelineSource remembering timelines the browser has reported as unavailable"""
+
+    def setUp(self):
+        self._orig_time = ProxyTimelineSource.__dict__["time"]
+        self.now = 100.0
+        ProxyTimelineSource.time = staticmethod(lambda: self.now)
+        self.src = ProxyTimelineSource(unavailableTtl=30.0)
+        self.src.setContentId("dvb://1234.5678.01ab")
+        self.requests = []
+        self.src.onRequestedTimelinesChanged = lambda selectors, added, removed: self.requests.append((sorted(selectors), added, removed))
+        self.src.timelineSelectorNeeded(PTS)
+        self.src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(None, 2000), None) })
+        self.src.timelineSelectorNotNeeded(PTS)
+        self.requests = []
+
+    def tearDown(self):
+        ProxyTimelineSource.time = self._orig_time
+
+    def test_answeredWithoutAskingBrowser(self):
+        """A timeline reported as unavailable is answered as unavailable when needed again, without asking the browser"""
+        self.now += 29
+        self.src.timelineSelectorNeeded(PTS)
+        self.assertEquals(self.requests, [])
+        self.assertEquals(json.loads(self.src.getPackedControlTimestamp(PTS)), { "contentTime":None, "wallClockTime":"2000", "timelineSpeedMultiplier":None })
+        self.assertEquals(self.src.unavailableAnsweredCount, 1)
+
+        self.src.timelineSelectorNotNeeded(PTS)
+        self.assertEquals(self.requests, [])
+        self.assertFalse(self.src.recognisesTimelineSelector(PTS))
+
+    def test_askedAgainAfterTtl(self):
+        """Once the TTL has passed, the browser is asked for the timeline again"""
+        self.now += 30
+        self.src.timelineSelectorNeeded(PTS)
+        self.assertEquals(self.requests, [ ([PTS], [PTS], []) ])
+        self.assertIsNone(self.src.getControlTimestamp(PTS))
+
+    def test_askedAgainForNewContent(self):
+        """The browser is asked for the timeline when the content ID changes, including if it is already needed"""
+        self.src.timelineSelectorNeeded(PTS)
+        self.src.setContentId("dvb://1234.5678.01ac")
+        self.assertEquals(self.requests, [ ([PTS], [PTS], []) ])
+
+        self.src.timelineSelectorNotNeeded(PTS)
+        self.assertEquals(self.requests, [ ([PTS], [PTS], []), ([], [], [PTS]) ])
+
+        self.src.timelineSelectorNeeded(PTS)
+        self.assertEquals(self.requests[-1], ([PTS], [PTS], []))
+
+    def test_forgottenWhenAvailable(self):
+        """A timeline is no longer remembered as unavailable once the browser provides it"""
+        self.src.timelineSelectorNeeded(PTS)
+        self.src.setContentId("dvb://1234.5678.01ac")
+        self.src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(1000, 3000), 1.0) })
+        self.src.setContentId("dvb://1234.5678.01ab")
+        self.src.timelinesUpdate({ PTS : ControlTimestamp(Timestamp(2000, 4000), 1.0) })
+        self.src.timelineSelectorNotNeeded(PTS)
+        self.requests = []
+
+        self.src.timelineSelectorNeeded(PTS)
+        self.assertEquals(self.requests, [ ([PTS], [PTS], []) ])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import unittest
+import threading
+
+import sys
+sys.path.append("../../src/python")
+from ProxyTracer import ProxyTracer
+
+
+class Test_ProxyTracer(unittest.TestCase):
+    """Tests of ProxyTracer"""
+
+    def test_noCurrentTraceInitially(self):
+        """There is no current trace until one is begun"""
+        tracer = ProxyTracer()
+        self.assertIsNone(tracer.current)
+        self.assertEquals(tracer.dump(), [])
+
+    def test_stagesRecordedInOrder(self):
+        """Stages marked on the current trace are dumped in order, with any extra information, once the trace ends"""
+        tracer = ProxyTracer()
+        trace = tracer.begin("flurble", "receive")
+        self.assertIs(tracer.current, trace)
+        tracer.current.mark("decode", timelines=2)
+        self.assertEquals(tracer.dump(), [])
+        tracer.end()
+        self.assertIsNone(tracer.current)
+
+        traces = tracer.dump()
+        self.assertEquals(len(traces), 1)
+        self.assertEquals(traces[0]["name"], "flurble")
+        self.assertEquals([ s["stage"] for s in traces[0]["stages"] ], ["receive", "decode", "end"])
+        self.assertEquals(traces[0]["stages"][1]["timelines"], 2)
+        offsets = [ s["offset"] for s in traces[0]["stages"] ]
+        self.assertEquals(offsets, sorted(offsets))
+        self.assertTrue(offsets[0] >= 0)
+
+    def test_endWithoutBeginDoesNothing(self):
+        """Ending when there is no current trace records nothing"""
+        tracer = ProxyTracer()
+        tracer.end()
+        self.assertEquals(tracer.dump(), [])
+
+    def test_ringBufferKeepsMostRecent(self):
+        """Only the most recent traces, up to the capacity, are kept"""
+        tracer = ProxyTracer(capacity=3)
+        for i in range(0,5):
+            tracer.begin(str(i))
+            tracer.end()
+        self.assertEquals([ t["name"] for t in tracer.dump() ], ["2", "3", "4"])
+        tracer.clear()
+        self.assertEquals(tracer.dump(), [])
+
+    def test_currentTraceIsPerThread(self):
+        """A trace begun in one thread is not the current trace in another"""
+        tracer = ProxyTracer()
+        tracer.begin("flurble")
+        seen = []
+        t = threading.Thread(target=lambda : seen.append(tracer.current))
+        t.start()
+        t.join()
+        self.assertEquals(seen, [None])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import socket
+import os
+import errno
+
+import sys
+sys.path.append("../../src/python")
+import BatchedWallClockServer as BWCS
+from BatchedWallClockServer import BatchedWallClockServer
+from WallClockWorkers import WallClockWorkers
+
+from dvbcss.clock import SysClock
+from dvbcss.protocol.wc import WCMessage
+
+
+def _unusedUdpPort():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+@unittest.skipIf(BWCS.SO_REUSEPORT is None or not hasattr(os, "fork"), "SO_REUSEPORT or fork not available")
+class Test_WallClockWorkers(unittest.TestCase):
+    """Tests of WallClockWorkers, using real processes and sockets on the loopback interface"""
+
+    def setUp(self):
+        self.wallClock = SysClock(tickRate=1000000000)
+        self.port = _unusedUdpPort()
+        self.workers = WallClockWorkers(2, lambda : BatchedWallClockServer(self.wallClock, 0.001, 500, bindaddr="127.0.0.1", bindport=self.port, reusePort=True))
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(0.5)
+
+    def tearDown(self):
+        self.workers.stop()
+        self.client.close()
+
+    def _request(self, originateNanos):
+        # requests sent before a worker has bound its socket are lost, so retry
+        for attempt in range(0, 10):
+            self.client.sendto(WCMessage(WCMessage.TYPE_REQUEST, 0, 0, originateNanos, 0, 0).pack(), ("127.0.0.1", self.port))
+            try:
+                return WCMessage.unpack(self.client.recv(100))
+            except socket.timeout:
+                pass
+        self.fail("No response from workers")
+
+    def test_workersRespond(self):
+        """Requests sent to the port are responded to by the workers"""
+        self.workers.start()
+        self.assertEquals(len(self.workers.pids), 2)
+
+        responses = [ self._request(i) for i in range(0, 10) ]
+        self.assertEquals([ r.originateNanos for r in responses ], range(0, 10))
+        for response in responses:
+            self.assertEquals(response.msgtype, WCMessage.TYPE_RESPONSE)
+
+    def test_stopEndsWorkers(self):
+        """Stopping ends the worker processes"""
+        self.workers.start()
+        pids = self.workers.pids
+        self.workers.stop()
+        self.assertEquals(self.workers.pids, [])
+        for pid in pids:
+            try:
+                os.kill(pid, 0)
+                self.fail("Worker process still exists")
+            except OSError as e:
+                self.assertEquals(e.errno, errno.ESRCH)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy
+# of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+import json
+
+import sys
+sys.path.append("../../src/python")
+from WebSocketWallClock_ServerEndpoint import WebSocketWallClock_ServerEndpoint
+
+from mock_wsServerBase import MockWSServerBase
+
+
+class MockClock(object):
+    """Clock that advances by 1000ns every time it is read"""
+    def __init__(self):
+        self._nanos = 5000000000
+    @property
+    def nanos(self):
+        self._nanos += 1000
+        return self._nanos
+
+
+class Test_WebSocketWallClock_ServerEndpoint(unittest.TestCase):
+    """Tests of WebSocketWallClock_ServerEndpoint"""
+
+    def setUp(self):
+        self._orig_ServerBase = WebSocketWallClock_ServerEndpoint.ServerBase
+        WebSocketWallClock_ServerEndpoint.ServerBase = MockWSServerBase
+        self.endpoint = WebSocketWallClock_ServerEndpoint(MockClock(), 0.001, 500)
+
+    def tearDown(self):
+        WebSocketWallClock_ServerEndpoint.ServerBase = self._orig_ServerBase
+
+    def test_response(self):
+        """The response is the request with the receive and send times, precision and max frequency error added"""
+        webSock = self.endpoint.server.mock_clientConnects()
+        self.endpoint.server.mock_clientSendsMessage('{ "ot" : 1.5, "tt" : 99 }')
+        response = json.loads(webSock.mock_popReceivedMessages()[0])
+        self.assertEquals(response, {
+            "ot" : 1.5, "t" : 1,
+            "rt" : 5.000001, "remoteReceiveTime" : 5000001000,
+            "tt" : 5.000002, "remoteSendTime" : 5000002000,
+            "p" : 0.001, "precision" : 0.001,
+            "mfe" : 500, "maxFrequencyError" : 500,
+        })
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=1)